@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+Benchmark: N llamadas concurrentes a sap_create_sales_order
+
+Simula el Service Layer con un transport httpx en memoria que responde
+después de una latencia fija. Con el cliente asíncrono y un pool de
+sesiones de tamaño N, N llamadas concurrentes deben terminar en
+aproximadamente el tiempo de una sola.
+
+Uso:
+    python -m benchmarks.concurrent_tool_calls --calls 20 --latency 0.5 --pool-size 20
+"""
+
+import argparse
+import asyncio
+import os
+import time
+
+import httpx
+
+import server
+from sap_client import SAPClient
+from sap_pool import SAPSessionPool
+from sap_registry import SAPPoolRegistry
+
+# Nodos simulados del Service Layer (cookie ROUTEID)
+ROUTES = [".node1", ".node2"]
+
+
+def build_fake_transport(latency: float) -> httpx.MockTransport:
+    """Transport falso que imita /Login y /Orders con una latencia fija"""
+    doc_entry = 0
+    logins = 0
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        nonlocal doc_entry, logins
+        await asyncio.sleep(latency)
+
+        if request.url.path.endswith("/Login"):
+            logins += 1
+            session_id = f"bench-session-{logins}"
+            return httpx.Response(
+                200,
+                json={"SessionId": session_id, "SessionTimeout": 30},
+                headers=[
+                    ("Set-Cookie", f"B1SESSION={session_id}; Path=/"),
+                    ("Set-Cookie", f"ROUTEID={ROUTES[logins % len(ROUTES)]}; Path=/")
+                ]
+            )
+
+        if request.url.path.endswith("/Logout"):
+            return httpx.Response(204)
+
+        if request.url.path.endswith("/Orders") and request.method == "POST":
+            doc_entry += 1
+            return httpx.Response(201, json={"DocEntry": doc_entry, "DocNum": doc_entry})
+
+        return httpx.Response(404, json={"error": "not found"})
+
+    return httpx.MockTransport(handler)
+
+
+async def run(calls: int, latency: float, pool_size: int):
+    os.environ.setdefault("SAP_COMPANY_DB", "BENCH")
+    os.environ.setdefault("SAP_USERNAME", "manager")
+    os.environ.setdefault("SAP_PASSWORD", "secret")
+
+    transport = build_fake_transport(latency)
+    pool = SAPSessionPool(
+        max_size=pool_size,
+        client_factory=lambda: SAPClient("https://sap.bench/b1s/v1", transport=transport)
+    )
+    server.sap_registry = SAPPoolRegistry(pool_factory=lambda credentials: pool)
+
+    order = {
+        "CardCode": "C00001",
+        "DocumentLines": [{"ItemCode": "A00001", "Quantity": "1", "UnitPrice": "10"}]
+    }
+
+    # Calentar el pool para no medir los logins
+    await asyncio.gather(*(
+        server.handle_call_tool("sap_create_sales_order", order) for _ in range(calls)
+    ))
+
+    start = time.perf_counter()
+    await server.handle_call_tool("sap_create_sales_order", order)
+    single = time.perf_counter() - start
+
+    start = time.perf_counter()
+    await asyncio.gather(*(
+        server.handle_call_tool("sap_create_sales_order", order) for _ in range(calls)
+    ))
+    concurrent = time.perf_counter() - start
+
+    print(f"Latencia simulada de SAP: {latency:.3f}s")
+    print(f"1 llamada:                {single:.3f}s")
+    print(f"{calls} llamadas concurrentes: {concurrent:.3f}s")
+    print(f"Relación concurrente/una:  {concurrent / single:.2f}x")
+    print(f"Pool de sesiones:          {pool.stats()}")
+
+    await server.sap_registry.close()
+    server.sap_registry = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=20, help="Número de llamadas concurrentes")
+    parser.add_argument("--latency", type=float, default=0.5, help="Latencia simulada de SAP en segundos")
+    parser.add_argument("--pool-size", type=int, default=None, help="Sesiones SAP máximas (default: --calls)")
+    args = parser.parse_args()
+    asyncio.run(run(args.calls, args.latency, args.pool_size or args.calls))
+
+
+if __name__ == "__main__":
+    main()
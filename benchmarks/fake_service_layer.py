@@ -0,0 +1,855 @@
+#!/usr/bin/env python3
+"""
+Service Layer de SAP Business One simulado, para pruebas de carga locales
+
+Implementa lo que usa el servidor MCP: /Login, /Logout, /Items,
+/BusinessPartners, /Orders (consulta y creación), /SalesTaxCodes,
+/PriceLists, /SpecialPrices, CompanyService_GetItemPrice, lectura por
+clave (ej: /Items('A00001')), paginación con odata.nextLink y
+Prefer: odata.maxpagesize, $apply (filter, groupby y aggregate) y $batch
+con change-sets atómicos. Los datos
+maestros se generan de forma determinista a partir de una semilla y las
+órdenes se valorizan con las mismas reglas de precios e impuestos que
+sap_pricing.
+
+Se puede configurar la latencia, la tasa de errores 5xx y la expiración de
+sesiones (por inactividad y por antigüedad máxima, para forzar 401). Los
+contadores de /_stats permiten calcular cuántas llamadas a SAP genera
+cada llamada a herramienta.
+
+Uso:
+    python -m benchmarks.fake_service_layer --port 50000 --latency 0.05 --error-rate 0.01
+
+    SAP_BASE_URL=http://localhost:50000/b1s/v1 python server.py
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import random
+import re
+import time
+import uuid
+from datetime import date, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl, quote, urlencode
+
+from fastapi import FastAPI, Request, Response
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import JSONResponse
+
+SERVICE_ROOT = "/b1s/v1"
+
+# Nodos simulados (cookie ROUTEID), repartidos entre logins
+ROUTES = [".node1", ".node2"]
+
+
+class FakeConfig:
+    """Parámetros del simulador"""
+
+    def __init__(self, latency: float = 0.0, latency_jitter: float = 0.2, error_rate: float = 0.0,
+                 session_timeout: float = 1800.0, session_max_age: Optional[float] = None,
+                 items: int = 2000, business_partners: int = 500, orders: int = 1000,
+                 page_size: int = 20, seed: int = 42, apply: bool = True,
+                 gzip: bool = False):
+        self.latency = latency
+        # Variación relativa de la latencia (0.2 = ±20%)
+        self.latency_jitter = latency_jitter
+        # Probabilidad de responder 503 a una request autenticada
+        self.error_rate = error_rate
+        # Segundos de inactividad antes de que SAP olvide la sesión
+        self.session_timeout = session_timeout
+        # Antigüedad máxima de una sesión, aunque se use (None = sin límite)
+        self.session_max_age = session_max_age
+        self.items = items
+        self.business_partners = business_partners
+        self.orders = orders
+        # Tamaño de página si el cliente no envía Prefer: odata.maxpagesize
+        self.page_size = page_size
+        self.seed = seed
+        # Si es False, $apply se rechaza con 400 (Service Layer sin agregación)
+        self.apply = apply
+        # Comprimir respuestas con gzip (como el Apache del Service Layer con mod_deflate)
+        self.gzip = gzip
+
+
+class ODataError(Exception):
+    """Error con el formato de respuesta del Service Layer"""
+
+    def __init__(self, status: int, message: str, code: int = -1):
+        super().__init__(message)
+        self.status = status
+        self.code = code
+
+    def body(self) -> dict:
+        return {"error": {"code": self.code, "message": {"lang": "en-us", "value": str(self)}}}
+
+
+# --- $filter ---------------------------------------------------------------
+
+_TOKEN = re.compile(r"\s*(?:(\()|(\))|'((?:[^']|'')*)'|(-?\d+(?:\.\d+)?)\b|([A-Za-z_][A-Za-z0-9_]*))")
+_COMPARISONS = {
+    "eq": lambda a, b: a == b, "ne": lambda a, b: a != b,
+    "gt": lambda a, b: a is not None and a > b, "ge": lambda a, b: a is not None and a >= b,
+    "lt": lambda a, b: a is not None and a < b, "le": lambda a, b: a is not None and a <= b,
+}
+
+
+def _tokenize(text: str) -> List[Tuple[str, Any]]:
+    tokens = []
+    position = 0
+    text = text.strip()
+    while position < len(text):
+        match = _TOKEN.match(text, position)
+        if not match or match.end() == position:
+            raise ODataError(400, f"Invalid $filter near: {text[position:]!r}")
+        position = match.end()
+        open_paren, close_paren, string, number, word = match.groups()
+        if open_paren:
+            tokens.append(("(", None))
+        elif close_paren:
+            tokens.append((")", None))
+        elif string is not None:
+            tokens.append(("value", string.replace("''", "'")))
+        elif number is not None:
+            tokens.append(("value", float(number)))
+        else:
+            tokens.append(("word", word))
+    return tokens
+
+
+def parse_filter(text: str):
+    """
+    Compilar un $filter OData simple a una función registro -> bool
+
+    Soporta comparaciones eq/ne/gt/ge/lt/le entre un campo y un literal,
+    and, or y paréntesis: lo que generan la réplica y las herramientas.
+    """
+    tokens = _tokenize(text)
+    position = 0
+
+    def peek():
+        return tokens[position] if position < len(tokens) else (None, None)
+
+    def take():
+        nonlocal position
+        token = peek()
+        position += 1
+        return token
+
+    def expression():
+        left = conjunction()
+        while peek() == ("word", "or"):
+            take()
+            right = conjunction()
+            left = (lambda l, r: lambda row: l(row) or r(row))(left, right)
+        return left
+
+    def conjunction():
+        left = comparison()
+        while peek() == ("word", "and"):
+            take()
+            right = comparison()
+            left = (lambda l, r: lambda row: l(row) and r(row))(left, right)
+        return left
+
+    def comparison():
+        kind, value = take()
+        if kind == "(":
+            inner = expression()
+            if take()[0] != ")":
+                raise ODataError(400, "Invalid $filter: missing ')'")
+            return inner
+        operator = take()
+        literal = take()
+        if kind != "word" or operator[0] != "word" or operator[1] not in _COMPARISONS or literal[0] != "value":
+            raise ODataError(400, f"Invalid $filter: {text!r}")
+        compare = _COMPARISONS[operator[1]]
+        field, expected = value, literal[1]
+        return lambda row: compare(row.get(field), expected)
+
+    predicate = expression()
+    if position != len(tokens):
+        raise ODataError(400, f"Invalid $filter: {text!r}")
+    return predicate
+
+
+# --- $apply ----------------------------------------------------------------
+
+_AGGREGATES = {"sum": sum, "average": lambda values: sum(values) / len(values) if values else None,
+               "min": lambda values: min(values) if values else None,
+               "max": lambda values: max(values) if values else None}
+
+
+def _split_top_level(text: str, separator: str) -> List[str]:
+    """Partir por separator fuera de paréntesis y literales"""
+    parts, depth, quoted, start = [], 0, False, 0
+    for i, char in enumerate(text):
+        if char == "'":
+            quoted = not quoted
+        elif not quoted and char == "(":
+            depth += 1
+        elif not quoted and char == ")":
+            depth -= 1
+        elif not quoted and depth == 0 and char == separator:
+            parts.append(text[start:i])
+            start = i + 1
+    parts.append(text[start:])
+    return [part.strip() for part in parts if part.strip()]
+
+
+def apply_transformations(rows: List[dict], text: str) -> List[dict]:
+    """Aplicar un $apply con filter(...), groupby((campos),aggregate(...)) y aggregate(...)"""
+    for step in _split_top_level(text, "/"):
+        name, _, inner = step.partition("(")
+        if not inner.endswith(")"):
+            raise ODataError(400, f"Invalid $apply: {text!r}")
+        inner = inner[:-1]
+        if name == "filter":
+            predicate = parse_filter(inner)
+            rows = [row for row in rows if predicate(row)]
+        elif name == "groupby":
+            fields_part, *aggregate = _split_top_level(inner, ",")
+            fields = [f.strip() for f in fields_part.strip("()").split(",") if f.strip()]
+            rows = _group(rows, fields, aggregate[0] if aggregate else None)
+        elif name == "aggregate":
+            rows = _group(rows, [], step)
+        else:
+            raise ODataError(400, f"Unsupported $apply transformation: {name!r}")
+    return rows
+
+
+def _group(rows: List[dict], fields: List[str], aggregate: Optional[str]) -> List[dict]:
+    clauses = []
+    if aggregate:
+        if not aggregate.startswith("aggregate(") or not aggregate.endswith(")"):
+            raise ODataError(400, f"Invalid aggregate: {aggregate!r}")
+        for clause in _split_top_level(aggregate[len("aggregate("):-1], ","):
+            match = re.fullmatch(r"(\$count|\w+ with (\w+)) as (\w+)", clause)
+            if not match or (match.group(2) and match.group(2) not in _AGGREGATES):
+                raise ODataError(400, f"Invalid aggregate expression: {clause!r}")
+            clauses.append((clause.split(" ", 1)[0], match.group(2), match.group(3)))
+
+    groups: Dict[tuple, List[dict]] = {}
+    for row in rows:
+        groups.setdefault(tuple(row.get(f) for f in fields), []).append(row)
+    if not fields and not groups:
+        groups[()] = []
+
+    result = []
+    for key, members in groups.items():
+        record = dict(zip(fields, key))
+        for field, function, alias in clauses:
+            if field == "$count":
+                record[alias] = len(members)
+            else:
+                value = _AGGREGATES[function]([m[field] for m in members if m.get(field) is not None])
+                record[alias] = round(value, 6) if isinstance(value, float) else value
+        result.append(record)
+    return result
+
+
+# --- Datos -----------------------------------------------------------------
+
+def _yes(flag: bool) -> str:
+    return "tYES" if flag else "tNO"
+
+
+def generate_data(config: FakeConfig) -> Tuple[List[dict], List[dict], List[dict]]:
+    """Items, Business Partners y Sales Orders deterministas para la semilla"""
+    rng = random.Random(config.seed)
+    updated = "2025-01-01"
+
+    items = []
+    for n in range(1, config.items + 1):
+        price = round(rng.uniform(1, 500), 2)
+        items.append({
+            "ItemCode": f"A{n:05d}",
+            "ItemName": f"Artículo {n}",
+            "ItemsGroupCode": 100 + n % 10,
+            "QuantityOnStock": float(rng.randint(0, 1000)),
+            "SalesUnit": "Unidad",
+            "Valid": "tYES",
+            "Frozen": _yes(n % 50 == 0),
+            "SalesItem": "tYES",
+            "InventoryItem": "tYES",
+            "SalesVATGroup": "IVA",
+            "ItemPrices": [
+                {"PriceList": 1, "Price": price, "Currency": "USD"},
+                {"PriceList": 2, "Price": round(price * 0.9, 2), "Currency": "USD"}
+            ],
+            "UpdateDate": updated,
+            "UpdateTime": "10:00:00"
+        })
+
+    partners = []
+    for n in range(1, config.business_partners + 1):
+        supplier = n % 10 == 0
+        partners.append({
+            "CardCode": f"{'V' if supplier else 'C'}{n:05d}",
+            "CardName": f"{'Proveedor' if supplier else 'Cliente'} {n}",
+            "CardType": "cSupplier" if supplier else "cCustomer",
+            "Phone1": f"555-{n:04d}",
+            "EmailAddress": f"contacto{n}@example.com",
+            "Currency": "USD",
+            "CurrentAccountBalance": round(rng.uniform(0, 10000), 2),
+            "PriceListNum": 1 + n % 2,
+            "VatGroup": "IVA",
+            "Valid": "tYES",
+            "Frozen": _yes(n % 97 == 0),
+            "UpdateDate": updated,
+            "UpdateTime": "10:00:00"
+        })
+
+    customers = [p for p in partners if p["CardType"] == "cCustomer"]
+    orders = []
+    start = date(2025, 1, 1)
+    for n in range(1, config.orders + 1):
+        partner = customers[rng.randrange(len(customers))] if customers else {"CardCode": "C00001", "CardName": ""}
+        lines = []
+        for line_num in range(rng.randint(1, 5)):
+            item = items[rng.randrange(len(items))] if items else {"ItemCode": "A00001", "ItemPrices": [{"Price": 1}]}
+            quantity = float(rng.randint(1, 20))
+            price = item["ItemPrices"][0]["Price"]
+            lines.append({"LineNum": line_num, "ItemCode": item["ItemCode"], "Quantity": quantity,
+                          "UnitPrice": price, "LineTotal": round(quantity * price, 2)})
+        doc_date = start + timedelta(days=n % 365)
+        orders.append(_order_record(n, partner, lines, doc_date, rng.random() < 0.3))
+
+    return items, partners, orders
+
+
+def generate_special_prices(items: List[dict], partners: List[dict]) -> List[dict]:
+    """
+    Precios especiales deterministas: 15% (20% desde 10 unidades) sobre los
+    primeros 10 artículos para uno de cada 7 clientes, y 5% sobre los
+    artículos 11 a 20 para todos los clientes de la lista 2 (CardCode '*2')
+    """
+    special = []
+
+    def add(card_code: str, item: dict, discount: float, tier: Optional[Tuple[float, float]] = None):
+        base = item["ItemPrices"][0]["Price"]
+        price = round(base * (1 - discount / 100), 2)
+        area = {"DateFrom": "2025-01-01", "Dateto": None, "Discount": discount, "SpecialPrice": price,
+                "PriceCurrency": "USD", "SpecialPriceQuantityAreas": []}
+        if tier:
+            quantity, tier_discount = tier
+            area["SpecialPriceQuantityAreas"].append({
+                "Quantity": quantity, "Discountin": tier_discount,
+                "SpecialPrice": round(base * (1 - tier_discount / 100), 2), "PriceCurrency": "USD"})
+        special.append({"CardCode": card_code, "ItemCode": item["ItemCode"], "Price": price, "Currency": "USD",
+                        "DiscountPercent": discount, "PriceListNum": 1, "Valid": "tYES",
+                        "SpecialPriceDataAreas": [area]})
+
+    for n, partner in enumerate(partners, start=1):
+        if partner["CardType"] == "cCustomer" and n % 7 == 0:
+            for item in items[:10]:
+                add(partner["CardCode"], item, 15.0, (10.0, 20.0))
+    for item in items[10:20]:
+        add("*2", item, 5.0)
+    return special
+
+
+def _order_record(doc_entry: int, partner: dict, lines: List[dict], doc_date: date, closed: bool = False,
+                  due_date: Optional[str] = None, currency: str = "USD", discount_percent: float = 0.0,
+                  vat_sum: float = 0.0) -> dict:
+    subtotal = round(sum(line["LineTotal"] for line in lines), 2)
+    total_discount = round(subtotal * discount_percent / 100, 2)
+    return {
+        "DocEntry": doc_entry,
+        "DocNum": doc_entry,
+        "CardCode": partner["CardCode"],
+        "CardName": partner["CardName"],
+        "DocDate": doc_date.isoformat(),
+        "DocDueDate": due_date or (doc_date + timedelta(days=30)).isoformat(),
+        "DiscountPercent": discount_percent,
+        "TotalDiscount": total_discount,
+        "VatSum": vat_sum,
+        "DocTotal": round(subtotal - total_discount + vat_sum, 2),
+        "DocCurrency": currency,
+        "DocRate": 1.0,
+        "DocumentStatus": "bost_Close" if closed else "bost_Open",
+        "DocumentLines": lines
+    }
+
+
+# --- Simulador ---------------------------------------------------------------
+
+class FakeServiceLayer:
+    """Estado del Service Layer simulado: datos, sesiones y contadores"""
+
+    # colección -> (atributo con los registros, campo clave)
+    COLLECTIONS = {
+        "Items": ("items", "ItemCode"),
+        "BusinessPartners": ("partners", "CardCode"),
+        "Orders": ("orders", "DocEntry"),
+        "SalesTaxCodes": ("tax_codes", "Code"),
+        "PriceLists": ("price_lists", "PriceListNo"),
+        # Clave compuesta (ItemCode, CardCode): solo se consulta la colección
+        "SpecialPrices": ("special_prices", None),
+    }
+
+    def __init__(self, config: Optional[FakeConfig] = None):
+        self.config = config or FakeConfig()
+        self.items, self.partners, self.orders = generate_data(self.config)
+        self.tax_codes = [{"Code": "IVA", "Name": "IVA 16%", "Rate": 16.0, "Inactive": "tNO"},
+                          {"Code": "EXE", "Name": "Exento", "Rate": 0.0, "Inactive": "tNO"},
+                          {"Code": "OLD", "Name": "Obsoleto", "Rate": 10.0, "Inactive": "tYES"}]
+        self.price_lists = [{"PriceListNo": 1, "PriceListName": "Lista base", "IsGrossPrice": "tNO",
+                             "Active": "tYES", "DefaultPrimeCurrency": "USD"},
+                            {"PriceListNo": 2, "PriceListName": "Mayoreo", "IsGrossPrice": "tNO",
+                             "Active": "tYES", "DefaultPrimeCurrency": "USD"}]
+        self.special_prices = generate_special_prices(self.items, self.partners)
+        self._special = {(s["CardCode"], s["ItemCode"]): s for s in self.special_prices}
+        self._index = {name: {row[key]: row for row in getattr(self, attr)} if key else {}
+                       for name, (attr, key) in self.COLLECTIONS.items()}
+        self._rng = random.Random(self.config.seed + 1)
+        # session_id -> [creada_en, último_uso]
+        self.sessions: Dict[str, List[float]] = {}
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.requests = 0
+        self.by_endpoint: Dict[str, int] = {}
+        self.logins = 0
+        self.batch_operations = 0
+        self.injected_errors = 0
+        self.expired_sessions = 0
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "by_endpoint": dict(self.by_endpoint),
+            "logins": self.logins,
+            "batch_operations": self.batch_operations,
+            "injected_errors": self.injected_errors,
+            "expired_sessions": self.expired_sessions,
+            "active_sessions": len(self.sessions),
+            "orders": len(self.orders)
+        }
+
+    def _count(self, method: str, path: str):
+        label = f"{method} /{re.sub(r'[(].*', '', path.split('?', 1)[0])}"
+        self.requests += 1
+        self.by_endpoint[label] = self.by_endpoint.get(label, 0) + 1
+
+    async def delay(self):
+        if self.config.latency > 0:
+            jitter = self.config.latency * self.config.latency_jitter
+            await asyncio.sleep(max(0.0, self.config.latency + self._rng.uniform(-jitter, jitter)))
+
+    # --- Sesiones --------------------------------------------------------
+
+    def login(self, payload: dict) -> Tuple[dict, str, str]:
+        if not payload.get("CompanyDB") or not payload.get("UserName") or not payload.get("Password"):
+            raise ODataError(401, "Fail to get DB Credentials from SLD server", code=-304)
+        self.logins += 1
+        session_id = str(uuid.uuid4())
+        now = time.monotonic()
+        self.sessions[session_id] = [now, now]
+        route = ROUTES[self.logins % len(ROUTES)]
+        return ({"odata.metadata": f"{SERVICE_ROOT}/$metadata#B1Sessions/@Element",
+                 "SessionId": session_id, "Version": "1000190",
+                 "SessionTimeout": max(1, math.ceil(self.config.session_timeout / 60))},
+                session_id, route)
+
+    def check_session(self, session_id: Optional[str]):
+        session = self.sessions.get(session_id) if session_id else None
+        now = time.monotonic()
+        if session is not None:
+            created, last_used = session
+            expired = now - last_used > self.config.session_timeout or (
+                self.config.session_max_age is not None and now - created > self.config.session_max_age)
+            if expired:
+                del self.sessions[session_id]
+                self.expired_sessions += 1
+                session = None
+        if session is None:
+            raise ODataError(401, "Invalid session or session already timeout.", code=301)
+        session[1] = now
+
+    def logout(self, session_id: Optional[str]):
+        self.sessions.pop(session_id, None)
+
+    # --- Operaciones -----------------------------------------------------
+
+    def handle(self, method: str, path: str, query: Dict[str, str], headers: Dict[str, str],
+               body: Any) -> Tuple[int, Any, Dict[str, str]]:
+        """
+        Ejecutar una operación ya autenticada (también las de un $batch)
+
+        Returns:
+            tuple: (status, cuerpo JSON o None, headers extra)
+        """
+        if method == "POST" and path.strip("/") == "CompanyService_GetItemPrice":
+            return 200, self._get_item_price(body), {}
+
+        match = re.fullmatch(r"/?([A-Za-z]+)(?:\((.+)\))?", path)
+        if not match or match.group(1) not in self.COLLECTIONS:
+            raise ODataError(404, f"Resource not found for the segment '{path}'")
+        collection, key = match.groups()
+
+        if method == "GET" and key is not None:
+            return 200, self._get_by_key(collection, key, query), {}
+        if method == "GET":
+            return self._query(collection, query, headers)
+        if method == "POST" and collection == "Orders" and key is None:
+            return 201, self._create_order(body), {}
+        raise ODataError(405, f"Method {method} not allowed for '{path}'")
+
+    def _get_by_key(self, collection: str, key: str, query: Dict[str, str]) -> dict:
+        key = key[1:-1].replace("''", "'") if key.startswith("'") else int(key)
+        row = self._index[collection].get(key)
+        if row is None:
+            raise ODataError(404, "No matching records found (ODBC -2028)", code=-2028)
+        return self._project(collection, [row], query.get("$select"))[0]
+
+    def _project(self, collection: str, rows: List[dict], select: Optional[str]) -> List[dict]:
+        if not select:
+            return [dict(row) for row in rows]
+        fields = [f.strip() for f in select.split(",") if f.strip()]
+        sample = getattr(self, self.COLLECTIONS[collection][0])
+        known = set(sample[0]) if sample else set(fields)
+        for field in fields:
+            if field not in known:
+                raise ODataError(400, f"Property '{field}' of '{collection}' is invalid", code=-1000)
+        return [{field: row.get(field) for field in fields} for row in rows]
+
+    def _query(self, collection: str, query: Dict[str, str],
+               headers: Dict[str, str]) -> Tuple[int, dict, Dict[str, str]]:
+        rows = getattr(self, self.COLLECTIONS[collection][0])
+
+        if query.get("$apply"):
+            if not self.config.apply:
+                raise ODataError(400, "Query option '$apply' is not supported", code=-1000)
+            rows = apply_transformations(rows, query["$apply"])
+
+        if query.get("$filter"):
+            predicate = parse_filter(query["$filter"])
+            rows = [row for row in rows if predicate(row)]
+
+        if query.get("$orderby"):
+            field, _, direction = query["$orderby"].strip().partition(" ")
+            rows = sorted(rows, key=lambda row: (row.get(field) is None, row.get(field)),
+                          reverse=direction.strip().lower() == "desc")
+
+        skip = int(query.get("$skip", 0))
+        top = int(query["$top"]) if query.get("$top") else None
+        page_size = self.config.page_size
+        preference = re.search(r"odata\.maxpagesize=(\d+)", headers.get("prefer", ""))
+        if preference:
+            page_size = int(preference.group(1))
+
+        end = len(rows) if top is None else min(len(rows), skip + top)
+        page_end = min(end, skip + page_size)
+        body: Dict[str, Any] = {
+            "odata.metadata": f"{SERVICE_ROOT}/$metadata#{collection}",
+            "value": self._project(collection, rows[skip:page_end], query.get("$select"))
+        }
+        extra = {"Preference-Applied": f"odata.maxpagesize={page_size}"} if preference else {}
+
+        if page_end < end:
+            # El nextLink conserva la consulta y ajusta $skip/$top a lo que falta
+            next_query = {k: v for k, v in query.items() if k not in ("$skip", "$top")}
+            if top is not None:
+                next_query["$top"] = str(end - page_end)
+            next_query["$skip"] = str(page_end)
+            body["odata.nextLink"] = collection + "?" + urlencode(next_query, safe="$',()", quote_via=quote)
+        return 200, body, extra
+
+    def _create_order(self, order: Any) -> dict:
+        if not isinstance(order, dict):
+            raise ODataError(400, "Invalid request body")
+        partner = self._index["BusinessPartners"].get(order.get("CardCode"))
+        if partner is None or partner["CardType"] != "cCustomer":
+            raise ODataError(400, f"Invalid BP code '{order.get('CardCode')}'", code=-10)
+        if not order.get("DocumentLines"):
+            raise ODataError(400, "Document must contain at least one line", code=-5002)
+
+        try:
+            doc_discount = float(order.get("DiscountPercent") or 0.0)
+        except (TypeError, ValueError):
+            raise ODataError(400, "Invalid DiscountPercent", code=-5002)
+
+        lines = []
+        for line_num, line in enumerate(order["DocumentLines"]):
+            item = self._index["Items"].get(line.get("ItemCode"))
+            if item is None:
+                raise ODataError(400, f"Invalid item code '{line.get('ItemCode')}'", code=-10)
+            try:
+                quantity = float(line.get("Quantity"))
+                unit_price, discount, price, _ = self.item_price(partner, item, quantity, date.today())
+                if line.get("UnitPrice") is not None:
+                    unit_price, discount = float(line["UnitPrice"]), 0.0
+                if line.get("DiscountPercent") is not None:
+                    discount = float(line["DiscountPercent"])
+                if line.get("UnitPrice") is not None or line.get("DiscountPercent") is not None:
+                    price = unit_price * (1 - discount / 100)
+            except (TypeError, ValueError):
+                raise ODataError(400, f"Invalid numeric value in line {line_num}", code=-5002)
+            tax_code = line.get("TaxCode") or item.get("SalesVATGroup") or partner.get("VatGroup")
+            tax = self._index["SalesTaxCodes"].get(tax_code)
+            if tax_code and (tax is None or tax["Inactive"] == "tYES"):
+                raise ODataError(400, f"Invalid tax code '{tax_code}'", code=-10)
+            line_total = round(quantity * price, 2)
+            rate = tax["Rate"] if tax else 0.0
+            lines.append({"LineNum": line_num, "ItemCode": item["ItemCode"], "Quantity": quantity,
+                          "UnitPrice": round(unit_price, 2), "DiscountPercent": discount, "Price": round(price, 2),
+                          "TaxCode": tax_code, "LineTotal": line_total,
+                          "TaxTotal": round(line_total * (1 - doc_discount / 100) * rate / 100, 2)})
+
+        doc_entry = (self.orders[-1]["DocEntry"] if self.orders else 0) + 1
+        record = _order_record(doc_entry, partner, lines, date.today(),
+                               due_date=order.get("DocDueDate"), currency=order.get("DocCurrency") or "USD",
+                               discount_percent=doc_discount,
+                               vat_sum=round(sum(line["TaxTotal"] for line in lines), 2))
+        self.orders.append(record)
+        self._index["Orders"][doc_entry] = record
+        return record
+
+    def item_price(self, partner: dict, item: dict, quantity: float,
+                   on_date: date) -> Tuple[float, float, float, str]:
+        """(precio de lista, descuento %, precio neto, moneda) del artículo para el cliente"""
+        list_no = partner.get("PriceListNum") or 1
+        base = next((p for p in item["ItemPrices"] if p["PriceList"] == list_no), None)
+        base_price = base["Price"] if base else 0.0
+        special = (self._special.get((partner["CardCode"], item["ItemCode"]))
+                   or self._special.get((f"*{list_no}", item["ItemCode"])))
+        if special is None:
+            return base_price, 0.0, base_price, base["Currency"] if base else "USD"
+
+        price, discount = special["Price"], special["DiscountPercent"]
+        day = on_date.isoformat()
+        for area in special["SpecialPriceDataAreas"]:
+            if area["DateFrom"] <= day and (not area["Dateto"] or day <= area["Dateto"]):
+                price, discount = area["SpecialPrice"], area["Discount"]
+                tiers = [q for q in area["SpecialPriceQuantityAreas"] if q["Quantity"] <= quantity]
+                if tiers:
+                    tier = max(tiers, key=lambda q: q["Quantity"])
+                    price, discount = tier["SpecialPrice"], tier["Discountin"]
+                break
+        return base_price, discount, price, special["Currency"]
+
+    def _get_item_price(self, body: Any) -> dict:
+        """CompanyService_GetItemPrice: precio que SAP propondría para una línea"""
+        params = (body or {}).get("ItemPriceParams") if isinstance(body, dict) else None
+        if not params:
+            raise ODataError(400, "Missing ItemPriceParams", code=-5002)
+        partner = self._index["BusinessPartners"].get(params.get("CardCode"))
+        item = self._index["Items"].get(params.get("ItemCode"))
+        if partner is None or item is None:
+            raise ODataError(400, "Invalid CardCode or ItemCode", code=-10)
+        try:
+            on_date = date.fromisoformat(str(params.get("Date") or date.today().isoformat())[:10])
+            quantity = float(params.get("Quantity") or 1)
+        except ValueError:
+            raise ODataError(400, "Invalid Date or Quantity", code=-5002)
+        _, discount, price, currency = self.item_price(partner, item, quantity, on_date)
+        return {"odata.metadata": f"{SERVICE_ROOT}/$metadata#SAPB1.ItemPriceReturnParams",
+                "Price": price, "Currency": currency, "Discount": discount}
+
+    def _rollback_orders(self, doc_entries: List[int]):
+        for doc_entry in doc_entries:
+            self._index["Orders"].pop(doc_entry, None)
+        self.orders = [o for o in self.orders if o["DocEntry"] not in doc_entries]
+
+    # --- $batch ------------------------------------------------------------
+
+    def batch(self, content_type: str, text: str) -> Tuple[str, str]:
+        """Ejecutar un $batch multipart y devolver (content-type, cuerpo)"""
+        boundary = f"batchresponse_{uuid.uuid4()}"
+        out: List[str] = []
+
+        for headers, body in _split_multipart(content_type, text):
+            part_type = headers.get("content-type", "")
+            out.append(f"--{boundary}")
+            if part_type.startswith("multipart/mixed"):
+                out.extend(self._changeset(part_type, body))
+            else:
+                out.extend(_http_part(*self._batch_operation(body)))
+        out.append(f"--{boundary}--")
+        out.append("")
+        return f"multipart/mixed;boundary={boundary}", "\r\n".join(out)
+
+    def _batch_operation(self, text: str) -> Tuple[int, Any]:
+        method, path, query, headers, body = _parse_http_request(text)
+        self.batch_operations += 1
+        try:
+            status, payload, _ = self.handle(method, path, query, headers, body)
+            return status, payload
+        except ODataError as e:
+            return e.status, e.body()
+
+    def _changeset(self, content_type: str, text: str) -> List[str]:
+        """Change-set atómico: si una operación falla se deshace y se responde un único error"""
+        boundary = f"changesetresponse_{uuid.uuid4()}"
+        responses = []
+        created: List[int] = []
+        for _, body in _split_multipart(content_type, text):
+            status, payload = self._batch_operation(body)
+            if status >= 400:
+                self._rollback_orders(created)
+                return _http_part(status, payload)
+            if isinstance(payload, dict) and "DocEntry" in payload:
+                created.append(payload["DocEntry"])
+            responses.append((status, payload))
+
+        lines = [f"Content-Type: multipart/mixed;boundary={boundary}", ""]
+        for status, payload in responses:
+            lines.append(f"--{boundary}")
+            lines.extend(_http_part(status, payload))
+        lines.append(f"--{boundary}--")
+        return lines
+
+
+_REASONS = {200: "OK", 201: "Created", 204: "No Content", 400: "Bad Request", 401: "Unauthorized",
+            404: "Not Found", 405: "Method Not Allowed", 503: "Service Unavailable"}
+
+
+def _http_part(status: int, payload: Any) -> List[str]:
+    lines = ["Content-Type: application/http", "Content-Transfer-Encoding: binary", "",
+             f"HTTP/1.1 {status} {_REASONS.get(status, '')}"]
+    if payload is not None:
+        lines.extend(["Content-Type: application/json;odata=minimalmetadata;charset=utf-8", "",
+                      json.dumps(payload, ensure_ascii=False)])
+    else:
+        lines.append("")
+    lines.append("")
+    return lines
+
+
+def _split_multipart(content_type: str, text: str) -> List[Tuple[Dict[str, str], str]]:
+    match = re.search(r'boundary="?([^";]+)"?', content_type)
+    if not match:
+        raise ODataError(400, "Missing multipart boundary")
+    delimiter = f"--{match.group(1)}"
+    parts = []
+    for raw in text.replace("\r\n", "\n").split(delimiter)[1:]:
+        if raw.startswith("--"):
+            break
+        head, _, body = raw.lstrip("\n").partition("\n\n")
+        parts.append((_parse_headers(head), body))
+    return parts
+
+
+def _parse_headers(head: str) -> Dict[str, str]:
+    headers = {}
+    for line in head.split("\n"):
+        name, sep, value = line.partition(":")
+        if sep:
+            headers[name.strip().lower()] = value.strip()
+    return headers
+
+
+def _parse_http_request(text: str) -> Tuple[str, str, Dict[str, str], Dict[str, str], Any]:
+    """Request HTTP embebida en un $batch: (método, ruta, query, headers, cuerpo JSON)"""
+    request_line, _, rest = text.lstrip("\n").partition("\n")
+    head, _, body = rest.partition("\n\n")
+    method, _, target = request_line.strip().partition(" ")
+    target = target.split(" ", 1)[0]
+    path, _, query_string = target.partition("?")
+    if path.startswith(SERVICE_ROOT):
+        path = path[len(SERVICE_ROOT):]
+    query = dict(parse_qsl(query_string))
+    body = body.strip()
+    return method.upper(), path, query, _parse_headers(head), json.loads(body) if body else None
+
+
+# --- Aplicación HTTP -----------------------------------------------------------
+
+def create_app(config: Optional[FakeConfig] = None) -> FastAPI:
+    """Aplicación ASGI del simulador; el estado queda en app.state.service_layer"""
+    service_layer = FakeServiceLayer(config)
+    app = FastAPI(title="Fake SAP Business One Service Layer")
+    app.state.service_layer = service_layer
+    if service_layer.config.gzip:
+        app.add_middleware(GZipMiddleware, minimum_size=1024)
+
+    def error(e: ODataError) -> JSONResponse:
+        return JSONResponse(e.body(), status_code=e.status)
+
+    @app.get("/_stats")
+    async def stats():
+        return service_layer.stats()
+
+    @app.post("/_reset")
+    async def reset():
+        service_layer.reset_stats()
+        return service_layer.stats()
+
+    @app.api_route(SERVICE_ROOT + "/{path:path}", methods=["GET", "POST", "PATCH", "DELETE"])
+    async def dispatch(path: str, request: Request):
+        method = request.method
+        service_layer._count(method, path)
+        await service_layer.delay()
+
+        raw = await request.body()
+        try:
+            if path == "Login" and method == "POST":
+                body, session_id, route = service_layer.login(json.loads(raw or b"{}"))
+                response = JSONResponse(body)
+                response.set_cookie("B1SESSION", session_id, path=SERVICE_ROOT, httponly=True)
+                response.set_cookie("ROUTEID", route, path="/")
+                return response
+
+            session_id = request.cookies.get("B1SESSION")
+            if path == "Logout" and method == "POST":
+                service_layer.logout(session_id)
+                return Response(status_code=204)
+
+            service_layer.check_session(session_id)
+            if service_layer._rng.random() < service_layer.config.error_rate:
+                service_layer.injected_errors += 1
+                raise ODataError(503, "Service Unavailable (simulado)", code=-5000)
+
+            if path == "$batch" and method == "POST":
+                content_type, text = service_layer.batch(request.headers.get("content-type", ""),
+                                                         raw.decode("utf-8"))
+                return Response(text, status_code=202, media_type=content_type)
+
+            status, body, headers = service_layer.handle(
+                method, "/" + path, dict(request.query_params), dict(request.headers),
+                json.loads(raw) if raw else None
+            )
+            return JSONResponse(body, status_code=status, headers=headers)
+        except ODataError as e:
+            return error(e)
+        except ValueError as e:
+            return error(ODataError(400, f"Invalid request: {e}"))
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Service Layer de SAP B1 simulado")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=50000)
+    parser.add_argument("--latency", type=float, default=0.05, help="Latencia base por request (segundos)")
+    parser.add_argument("--latency-jitter", type=float, default=0.2, help="Variación relativa de la latencia")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Probabilidad de responder 503")
+    parser.add_argument("--session-timeout", type=float, default=1800.0, help="Segundos de inactividad por sesión")
+    parser.add_argument("--session-max-age", type=float, default=None,
+                        help="Antigüedad máxima de una sesión en segundos (fuerza 401)")
+    parser.add_argument("--items", type=int, default=2000)
+    parser.add_argument("--business-partners", type=int, default=500)
+    parser.add_argument("--orders", type=int, default=1000)
+    parser.add_argument("--page-size", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--no-apply", action="store_true", help="Rechazar $apply (Service Layer sin agregación)")
+    parser.add_argument("--gzip", action="store_true", help="Comprimir las respuestas con gzip")
+    args = parser.parse_args()
+
+    config = FakeConfig(
+        latency=args.latency, latency_jitter=args.latency_jitter, error_rate=args.error_rate,
+        session_timeout=args.session_timeout, session_max_age=args.session_max_age,
+        items=args.items, business_partners=args.business_partners, orders=args.orders,
+        page_size=args.page_size, seed=args.seed, apply=not args.no_apply, gzip=args.gzip
+    )
+
+    import uvicorn
+    uvicorn.run(create_app(config), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+"""
+Generador de carga para /mcp con mezclas realistas de llamadas a herramientas
+
+Por defecto todo corre en el mismo proceso: el servidor MCP (server.app) y
+el Service Layer simulado (benchmarks.fake_service_layer) se conectan con
+transports ASGI, sin red ni SAP real, así el resultado es repetible entre
+cambios. Con --url se mide un servidor ya levantado (apuntado a un
+simulador externo, cuyos contadores se leen de --sap-stats).
+
+Reporta throughput, latencias p50/p95/p99 (global y por herramienta),
+errores y llamadas a SAP por llamada a herramienta.
+
+Uso:
+    python -m benchmarks.load_mcp --mix mixed --requests 500 --concurrency 20 --latency 0.02
+    python -m benchmarks.load_mcp --url http://localhost:8000/mcp --sap-stats http://localhost:50000/_stats
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import httpx
+
+# Pesos relativos de cada herramienta por mezcla
+MIXES: Dict[str, Dict[str, int]] = {
+    "read": {"sap_query_items": 5, "sap_query_business_partners": 3, "sap_query_orders": 2,
+             "sap_aggregate_orders": 1, "sap_get_order_detail": 1},
+    "mixed": {"sap_query_items": 4, "sap_query_business_partners": 2, "sap_query_orders": 2,
+              "sap_create_sales_order": 2},
+    "write": {"sap_create_sales_order": 8, "sap_create_sales_orders_bulk": 2},
+    # Preguntas de precio: cotización local frente a crear la orden para ver el total
+    "quote": {"sap_quote_order": 8, "sap_create_sales_order": 2},
+}
+
+# Prefijos del texto de las herramientas que indican un error
+ERROR_PREFIXES = ("Error", "No se pudo", "Sales Order inválida", "Consulta inválida", "Cotización inválida",
+                  "Herramienta desconocida")
+
+
+class Workload:
+    """Genera argumentos de herramientas con códigos que existen en el simulador"""
+
+    def __init__(self, items: int, business_partners: int, seed: int):
+        self.rng = random.Random(seed)
+        self.items = items
+        # Los códigos múltiplos de 10 son proveedores (ver fake_service_layer)
+        self.customers = [n for n in range(1, business_partners + 1) if n % 10]
+
+    def item_code(self) -> str:
+        return f"A{self.rng.randint(1, self.items):05d}"
+
+    def card_code(self) -> str:
+        return f"C{self.rng.choice(self.customers):05d}"
+
+    def order(self) -> dict:
+        return {
+            "CardCode": self.card_code(),
+            "DocumentLines": [
+                {"ItemCode": self.item_code(), "Quantity": str(self.rng.randint(1, 20))}
+                for _ in range(self.rng.randint(1, 4))
+            ]
+        }
+
+    def arguments(self, tool: str) -> dict:
+        rng = self.rng
+        if tool == "sap_query_items":
+            return {"select": ["ItemCode", "ItemName", "QuantityOnStock"],
+                    "filter": f"ItemCode ge '{self.item_code()}'", "top": rng.choice([10, 20, 50])}
+        if tool == "sap_query_business_partners":
+            return {"filter": f"CardCode eq '{self.card_code()}'"}
+        if tool == "sap_query_orders":
+            return {"filter": f"CardCode eq '{self.card_code()}'", "top": 20}
+        if tool == "sap_get_order_detail":
+            # Órdenes generadas por el simulador (DocEntry desde 1)
+            return {"doc_entry": rng.randint(1, 500)}
+        if tool == "sap_aggregate_orders":
+            month = rng.randint(1, 12)
+            return {"group_by": ["CardCode"], "top": 10,
+                    "filter": f"DocDate ge '2025-{month:02d}-01' and DocDate le '2025-{month:02d}-28'"}
+        if tool in ("sap_create_sales_order", "sap_quote_order"):
+            return self.order()
+        if tool == "sap_create_sales_orders_bulk":
+            return {"orders": [self.order() for _ in range(rng.randint(5, 20))]}
+        return {}
+
+    def pick(self, mix: Dict[str, int]) -> str:
+        tools = list(mix)
+        return self.rng.choices(tools, weights=[mix[t] for t in tools])[0]
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    """Percentil por rango más cercano (values ordenada)"""
+    if not values:
+        return 0.0
+    index = max(0, min(len(values) - 1, int(round(fraction * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+def is_error(reply: Any) -> bool:
+    if not isinstance(reply, dict) or "error" in reply:
+        return True
+    content = reply.get("result", {}).get("content") or []
+    text = content[-1].get("text", "") if content else ""
+    return text.startswith(ERROR_PREFIXES)
+
+
+async def drive(client: httpx.AsyncClient, url: str, workload: Workload, mix: Dict[str, int],
+                requests: int, concurrency: int) -> Tuple[List[Tuple[str, float, bool]], float]:
+    """Enviar las llamadas con `concurrency` workers; devuelve (muestras, segundos)"""
+    calls = [workload.pick(mix) for _ in range(requests)]
+    payloads = [(tool, {"jsonrpc": "2.0", "id": i, "method": "tools/call",
+                        "params": {"name": tool, "arguments": workload.arguments(tool)}})
+                for i, tool in enumerate(calls)]
+    queue: asyncio.Queue = asyncio.Queue()
+    for payload in payloads:
+        queue.put_nowait(payload)
+    samples: List[Tuple[str, float, bool]] = []
+
+    async def worker():
+        while not queue.empty():
+            tool, payload = queue.get_nowait()
+            start = time.perf_counter()
+            try:
+                response = await client.post(url, json=payload)
+                failed = response.status_code != 200 or is_error(response.json())
+            except httpx.HTTPError:
+                failed = True
+            samples.append((tool, time.perf_counter() - start, failed))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return samples, time.perf_counter() - start
+
+
+def summarize(samples: List[Tuple[str, float, bool]], elapsed: float, sap_before: dict, sap_after: dict,
+              mix_name: str, concurrency: int) -> dict:
+    def latency_stats(latencies: List[float]) -> dict:
+        latencies = sorted(latencies)
+        return {
+            "count": len(latencies),
+            "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+            "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+            "p99_ms": round(percentile(latencies, 0.99) * 1000, 2)
+        }
+
+    by_tool: Dict[str, List[float]] = {}
+    for tool, latency, _ in samples:
+        by_tool.setdefault(tool, []).append(latency)
+
+    sap_calls = sap_after.get("requests", 0) - sap_before.get("requests", 0)
+    by_endpoint = {
+        endpoint: count - sap_before.get("by_endpoint", {}).get(endpoint, 0)
+        for endpoint, count in sap_after.get("by_endpoint", {}).items()
+    }
+    return {
+        "mix": mix_name,
+        "calls": len(samples),
+        "concurrency": concurrency,
+        "seconds": round(elapsed, 3),
+        "throughput": round(len(samples) / elapsed, 2) if elapsed else 0.0,
+        "errors": sum(1 for _, _, failed in samples if failed),
+        "latency": latency_stats([latency for _, latency, _ in samples]),
+        "tools": {tool: latency_stats(latencies) for tool, latencies in sorted(by_tool.items())},
+        "sap_calls": sap_calls,
+        "sap_calls_per_tool_call": round(sap_calls / len(samples), 3) if samples else 0.0,
+        "sap_batch_operations": sap_after.get("batch_operations", 0) - sap_before.get("batch_operations", 0),
+        "sap_logins": sap_after.get("logins", 0) - sap_before.get("logins", 0),
+        "sap_by_endpoint": {k: v for k, v in sorted(by_endpoint.items()) if v}
+    }
+
+
+def print_report(report: dict):
+    latency = report["latency"]
+    print(f"Mezcla: {report['mix']}  Llamadas: {report['calls']}  Concurrencia: {report['concurrency']}  "
+          f"Duración: {report['seconds']:.2f}s  Throughput: {report['throughput']:.1f} llamadas/s  "
+          f"Errores: {report['errors']}")
+    print(f"{'herramienta':32} {'n':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for tool, stats in [("(todas)", latency)] + list(report["tools"].items()):
+        print(f"{tool:32} {stats['count']:>6} {stats['p50_ms']:>9.2f} {stats['p95_ms']:>9.2f} {stats['p99_ms']:>9.2f}")
+    print(f"Llamadas a SAP: {report['sap_calls']} ({report['sap_calls_per_tool_call']:.3f} por llamada a "
+          f"herramienta, {report['sap_batch_operations']} operaciones en $batch, {report['sap_logins']} logins)")
+    for endpoint, count in report["sap_by_endpoint"].items():
+        print(f"  {endpoint:30} {count:>8}")
+
+
+async def run_in_process(args) -> dict:
+    """Servidor MCP y simulador en el mismo proceso, conectados por ASGI"""
+    os.environ.setdefault("SAP_COMPANY_DB", "SBODEMO")
+    os.environ.setdefault("SAP_USERNAME", "manager")
+    os.environ.setdefault("SAP_PASSWORD", "manager")
+
+    import server
+    from benchmarks.fake_service_layer import FakeConfig, create_app
+    from sap_client import SAPClient
+    from sap_guard import SAPGuard
+    from sap_pool import SAPSessionPool
+    from sap_registry import SAPPoolRegistry
+
+    config = FakeConfig(latency=args.latency, error_rate=args.error_rate, session_max_age=args.session_max_age,
+                        items=args.items, business_partners=args.business_partners, seed=args.seed, gzip=args.gzip)
+    fake_app = create_app(config)
+    service_layer = fake_app.state.service_layer
+    sap_transport = httpx.ASGITransport(app=fake_app)
+
+    guard = SAPGuard()
+    server.sap_registry = SAPPoolRegistry(
+        pool_factory=lambda credentials: SAPSessionPool(
+            max_size=args.pool_size,
+            client_factory=lambda: SAPClient("http://fake-sap/b1s/v1", transport=sap_transport, guard=guard),
+            guard=guard,
+            credentials=credentials
+        ),
+        guard=guard
+    )
+    workload = Workload(args.items, args.business_partners, args.seed)
+    mix = MIXES[args.mix]
+
+    try:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app), base_url="http://mcp",
+                                     timeout=args.timeout) as client:
+            # Calentamiento: logins del pool y primera carga de estructuras
+            await drive(client, "/mcp", workload, mix, args.pool_size * 2, args.pool_size)
+            before = service_layer.stats()
+            samples, elapsed = await drive(client, "/mcp", workload, mix, args.requests, args.concurrency)
+            after = service_layer.stats()
+    finally:
+        # Sin lifespan: los contrastes de cotizaciones se cancelan antes de cerrar los pools
+        if server.pricing_engine is not None:
+            await server.pricing_engine.close()
+            server.pricing_engine = None
+        if server.master_data is not None:
+            await server.master_data.close()
+            server.master_data = None
+        await server.sap_registry.close()
+        server.sap_registry = None
+
+    return summarize(samples, elapsed, before, after, args.mix, args.concurrency)
+
+
+async def run_external(args) -> dict:
+    """Servidor MCP ya levantado en --url; contadores SAP desde --sap-stats si se indica"""
+    workload = Workload(args.items, args.business_partners, args.seed)
+    mix = MIXES[args.mix]
+
+    async with httpx.AsyncClient(timeout=args.timeout) as client:
+        async def sap_stats() -> dict:
+            if not args.sap_stats:
+                return {}
+            return (await client.get(args.sap_stats)).json()
+
+        await drive(client, args.url, workload, mix, args.concurrency, args.concurrency)
+        before = await sap_stats()
+        samples, elapsed = await drive(client, args.url, workload, mix, args.requests, args.concurrency)
+        after = await sap_stats()
+
+    return summarize(samples, elapsed, before, after, args.mix, args.concurrency)
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Carga sobre /mcp con mezclas de herramientas")
+    parser.add_argument("--mix", choices=sorted(MIXES), default="mixed")
+    parser.add_argument("--requests", type=int, default=500, help="Llamadas a herramientas a medir")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--items", type=int, default=2000, help="Items del simulador")
+    parser.add_argument("--business-partners", type=int, default=500, help="Business Partners del simulador")
+    parser.add_argument("--json", action="store_true", help="Imprimir el reporte como JSON")
+    local = parser.add_argument_group("modo en proceso")
+    local.add_argument("--latency", type=float, default=0.02, help="Latencia simulada de SAP (segundos)")
+    local.add_argument("--error-rate", type=float, default=0.0, help="Probabilidad de 503 en SAP")
+    local.add_argument("--session-max-age", type=float, default=None, help="Forzar 401 tras N segundos de sesión")
+    local.add_argument("--pool-size", type=int, default=8, help="Sesiones SAP máximas del pool")
+    local.add_argument("--gzip", action="store_true", help="El simulador comprime sus respuestas con gzip")
+    external = parser.add_argument_group("servidor externo")
+    external.add_argument("--url", help="URL de /mcp de un servidor ya levantado")
+    external.add_argument("--sap-stats", help="URL de /_stats del simulador usado por ese servidor")
+    args = parser.parse_args(argv)
+
+    runner: Callable = run_external if args.url else run_in_process
+    report = asyncio.run(runner(args))
+    if args.json:
+        print(json.dumps(report, indent=2, ensure_ascii=False))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
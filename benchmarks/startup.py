@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+Tiempo de arranque en frío del servidor MCP
+
+Mide, en procesos nuevos como los de un escalado desde cero:
+
+- Importación de server.py (mediana de --runs procesos) y los paquetes
+  que más tardan según python -X importtime.
+- Tiempo hasta que /ready responde 200: levanta el Service Layer simulado
+  y server.py como subprocesos y sondea /ready, que recién responde 200
+  con la sesión SAP abierta (login en el lifespan).
+
+Uso:
+    python -m benchmarks.startup --runs 5
+    python -m benchmarks.startup --skip-ready --top 15
+"""
+
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT_SNIPPET = "import time; t = time.perf_counter(); import server; print(time.perf_counter() - t)"
+
+
+def _env(**extra: str) -> Dict[str, str]:
+    env = dict(os.environ, PYTHONPATH=ROOT, LOG_LEVEL="WARNING")
+    env.update(extra)
+    return env
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def measure_import(runs: int) -> List[float]:
+    """Segundos de `import server` en procesos nuevos"""
+    times = []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, "-c", IMPORT_SNIPPET], cwd=ROOT, env=_env(),
+                             capture_output=True, text=True, check=True)
+        times.append(float(out.stdout.strip().splitlines()[-1]))
+    return times
+
+
+def import_breakdown(top: int) -> List[Dict]:
+    """Importaciones directas de server.py que más tardan, por paquete (tiempo acumulado, ms)"""
+    out = subprocess.run([sys.executable, "-X", "importtime", "-c", "import server"], cwd=ROOT, env=_env(),
+                         capture_output=True, text=True, check=True)
+    # La sangría indica la profundidad y cada módulo aparece después de sus
+    # dependencias: las de profundidad 1 previas a la línea de server son sus
+    # importaciones directas, cuyo acumulado ya incluye lo que arrastran
+    totals: Dict[str, int] = {}
+    pending: Dict[str, int] = {}
+    for line in out.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 0:
+            if name.strip() == "server":
+                totals = pending
+                break
+            pending = {}
+        elif depth == 1:
+            package = name.strip().split(".")[0]
+            pending[package] = pending.get(package, 0) + int(cumulative)
+    ranked = sorted(totals.items(), key=lambda item: item[1], reverse=True)[:top]
+    return [{"module": module, "ms": round(us / 1000, 1)} for module, us in ranked]
+
+
+def _wait_http(url: str, timeout: float, status: int = 200) -> Optional[float]:
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        try:
+            if httpx.get(url, timeout=1.0).status_code == status:
+                return time.perf_counter() - start
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.02)
+    return None
+
+
+def measure_ready(latency: float, timeout: float) -> Dict:
+    """Segundos desde el lanzamiento de server.py hasta /health y /ready en 200"""
+    sap_port, port = _free_port(), _free_port()
+    fake = subprocess.Popen([sys.executable, "-m", "benchmarks.fake_service_layer", "--port", str(sap_port),
+                             "--latency", str(latency)], cwd=ROOT, env=_env(),
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    server = None
+    try:
+        if _wait_http(f"http://127.0.0.1:{sap_port}/_stats", timeout) is None:
+            raise RuntimeError("El Service Layer simulado no arrancó")
+
+        env = _env(SAP_BASE_URL=f"http://127.0.0.1:{sap_port}/b1s/v1", SAP_COMPANY_DB="SBODEMO",
+                   SAP_USERNAME="manager", SAP_PASSWORD="manager", SERVER_HOST="127.0.0.1",
+                   SERVER_PORT=str(port), SERVER_WORKERS="1")
+        server = subprocess.Popen([sys.executable, "server.py"], cwd=ROOT, env=env,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        health = _wait_http(f"http://127.0.0.1:{port}/health", timeout)
+        ready = _wait_http(f"http://127.0.0.1:{port}/ready", timeout) if health is not None else None
+        stats = httpx.get(f"http://127.0.0.1:{sap_port}/_stats").json()
+        return {
+            "health_s": round(health, 3) if health is not None else None,
+            "ready_s": round(health + ready, 3) if ready is not None else None,
+            "sap_logins": stats["logins"]
+        }
+    finally:
+        for process in (server, fake):
+            if process is not None:
+                process.terminate()
+                process.wait(timeout=10)
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Tiempo de arranque en frío del servidor MCP")
+    parser.add_argument("--runs", type=int, default=5, help="Procesos para medir la importación")
+    parser.add_argument("--top", type=int, default=10, help="Paquetes a listar por tiempo de importación")
+    parser.add_argument("--latency", type=float, default=0.2, help="Latencia simulada de SAP (segundos)")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--skip-ready", action="store_true", help="Medir solo la importación")
+    parser.add_argument("--json", action="store_true", help="Imprimir el reporte como JSON")
+    args = parser.parse_args(argv)
+
+    times = measure_import(args.runs)
+    report = {
+        "import_s": {"median": round(statistics.median(times), 3), "min": round(min(times), 3),
+                     "max": round(max(times), 3), "runs": len(times)},
+        "import_breakdown": import_breakdown(args.top),
+        "ready": None if args.skip_ready else measure_ready(args.latency, args.timeout)
+    }
+
+    if args.json:
+        print(json.dumps(report, indent=2, ensure_ascii=False))
+        return
+
+    imports = report["import_s"]
+    print(f"import server: mediana {imports['median'] * 1000:.0f} ms "
+          f"(min {imports['min'] * 1000:.0f}, max {imports['max'] * 1000:.0f}, {imports['runs']} procesos)")
+    for entry in report["import_breakdown"]:
+        print(f"  {entry['module']:30} {entry['ms']:>8.1f} ms")
+    if report["ready"] is not None:
+        ready = report["ready"]
+        print(f"/health en 200: {ready['health_s']} s  /ready en 200: {ready['ready_s']} s  "
+              f"(logins en SAP: {ready['sap_logins']})")
+
+
+if __name__ == "__main__":
+    main()
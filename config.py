@@ -0,0 +1,17 @@
+"""
+Lectura de configuración desde variables de entorno
+"""
+
+import os
+
+
+def env_int(name: str, default: int) -> int:
+    """Leer un entero desde variable de entorno con valor por defecto"""
+    value = os.getenv(name)
+    return int(value) if value else default
+
+
+def env_float(name: str, default: float) -> float:
+    """Leer un float desde variable de entorno con valor por defecto"""
+    value = os.getenv(name)
+    return float(value) if value else default
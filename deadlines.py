@@ -0,0 +1,111 @@
+"""
+Plazos de extremo a extremo y reintentos de requests al Service Layer
+
+Cada tools/call abre un plazo (deadline_scope) que viaja en una ContextVar
+hasta todas las requests a SAP que hace la herramienta, también las que
+corren en tareas hijas. El cliente SAP acota el timeout de cada request
+al tiempo restante y reintenta fallas transitorias con backoff
+exponencial y jitter mientras quede plazo.
+
+Reglas de reintento (RetryPolicy):
+- Errores de conexión (la request no llegó a SAP): se reintentan siempre,
+  también los POST.
+- Timeouts de lectura, conexiones cortadas y respuestas 429/502/503/504:
+  solo en requests idempotentes. Un POST pudo haberse procesado y repetirlo
+  podría duplicar el documento.
+"""
+
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator, Optional
+
+import httpx
+
+from config import env_int, env_float
+
+# Instante (time.monotonic) en que vence el plazo de la llamada en curso
+_deadline: ContextVar[Optional[float]] = ContextVar("sap_deadline", default=None)
+
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "OPTIONS", "PUT", "DELETE"})
+
+RETRIABLE_STATUS = frozenset({429, 502, 503, 504})
+
+# La request no llegó a enviarse: repetirla es seguro para cualquier método
+_NOT_SENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+class DeadlineExceeded(TimeoutError):
+    """Se agotó el plazo de la llamada antes de completar la request a SAP"""
+
+
+@contextmanager
+def deadline_scope(seconds: Optional[float]) -> Iterator[None]:
+    """
+    Fijar un plazo de `seconds` para el código del bloque
+
+    Un plazo anidado nunca extiende al exterior: vale el que vence antes.
+    None o un valor no positivo no agrega plazo.
+    """
+    if not seconds or seconds <= 0:
+        yield
+        return
+
+    deadline = time.monotonic() + seconds
+    current = _deadline.get()
+    token = _deadline.set(deadline if current is None else min(current, deadline))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining() -> Optional[float]:
+    """Segundos que quedan del plazo actual (None si no hay plazo)"""
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def check_deadline():
+    """
+    Raises:
+        DeadlineExceeded: Si el plazo actual ya venció
+    """
+    left = remaining()
+    if left is not None and left <= 0:
+        raise DeadlineExceeded("Se agotó el plazo de la llamada")
+
+
+class RetryPolicy:
+    """
+    Reintentos con backoff exponencial y jitter completo
+
+    Variables de entorno:
+        SAP_RETRY_MAX_ATTEMPTS: Intentos totales por request, incluido el primero (default 3)
+        SAP_RETRY_BASE_DELAY: Espera base en segundos, se duplica por intento (default 0.2)
+        SAP_RETRY_MAX_DELAY: Espera máxima entre intentos en segundos (default 2)
+    """
+
+    def __init__(self, max_attempts: Optional[int] = None, base_delay: Optional[float] = None,
+                 max_delay: Optional[float] = None):
+        self.max_attempts = max_attempts if max_attempts is not None else env_int('SAP_RETRY_MAX_ATTEMPTS', 3)
+        self.base_delay = base_delay if base_delay is not None else env_float('SAP_RETRY_BASE_DELAY', 0.2)
+        self.max_delay = max_delay if max_delay is not None else env_float('SAP_RETRY_MAX_DELAY', 2.0)
+
+    def retry_status(self, status: int, idempotent: bool) -> bool:
+        return idempotent and status in RETRIABLE_STATUS
+
+    def retry_error(self, error: Exception, idempotent: bool) -> bool:
+        if isinstance(error, _NOT_SENT_ERRORS):
+            return True
+        return idempotent and isinstance(error, httpx.TransportError)
+
+    def backoff(self, attempt: int) -> float:
+        """Espera antes del intento attempt + 1 (jitter completo sobre la exponencial)"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** (attempt - 1))))
+
+    def fits(self, delay: float) -> bool:
+        """Queda plazo para esperar delay y volver a intentar"""
+        left = remaining()
+        return left is None or delay < left
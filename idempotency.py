@@ -0,0 +1,159 @@
+"""
+Idempotencia para operaciones de escritura en SAP
+
+Los clientes MCP reintentan tools/call cuando vence su timeout. Sin
+deduplicación, una respuesta lenta de SAP termina en dos Sales Orders
+idénticas. Este módulo asocia cada operación a una clave de idempotencia:
+las llamadas concurrentes con la misma clave esperan la operación en curso,
+y los resultados exitosos se guardan un tiempo limitado para que un
+reintento reciba el resultado original sin llamar a SAP. Reusar una clave
+explícita con otro contenido es un error del cliente y se rechaza.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from config import env_int, env_float
+
+logger = logging.getLogger(__name__)
+
+# Campo de los argumentos de la herramienta con la clave explícita
+IDEMPOTENCY_KEY_FIELD = "idempotency_key"
+
+
+def payload_fingerprint(payload: dict) -> str:
+    """Hash SHA-256 de la representación canónica del payload (sin la clave explícita)"""
+    canonical = json.dumps(
+        {k: v for k, v in payload.items() if k != IDEMPOTENCY_KEY_FIELD},
+        sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def idempotency_key(operation: str, arguments: dict) -> str:
+    """
+    Clave de idempotencia de una operación
+
+    Usa la clave explícita de los argumentos si existe; si no, la deriva del
+    hash canónico del payload, de modo que un reintento idéntico coincide.
+    """
+    explicit = arguments.get(IDEMPOTENCY_KEY_FIELD)
+    if explicit:
+        return f"{operation}:key:{explicit}"
+    return f"{operation}:sha256:{payload_fingerprint(arguments)}"
+
+
+class IdempotencyConflictError(ValueError):
+    """La clave de idempotencia ya se usó con otro payload"""
+
+
+class IdempotencyStore:
+    """
+    Resultados recientes por clave más operaciones en curso
+
+    Variables de entorno:
+        SAP_IDEMPOTENCY_TTL: Segundos que se conserva un resultado exitoso (default 900)
+        SAP_IDEMPOTENCY_MAX_ENTRIES: Resultados máximos guardados (default 10000)
+    """
+
+    def __init__(self, ttl: Optional[float] = None, max_entries: Optional[int] = None,
+                 clock: Callable[[], float] = time.monotonic):
+        self.ttl = ttl if ttl is not None else env_float('SAP_IDEMPOTENCY_TTL', 900.0)
+        self.max_entries = max_entries if max_entries is not None else env_int('SAP_IDEMPOTENCY_MAX_ENTRIES', 10000)
+        self._clock = clock
+        # clave -> (expira_en, huella del payload, resultado), en orden de inserción
+        self._completed: "OrderedDict[str, Tuple[float, Optional[str], Any]]" = OrderedDict()
+        # clave -> (operación en curso, huella del payload)
+        self._in_flight: Dict[str, Tuple[asyncio.Future, Optional[str]]] = {}
+
+        self.replays = 0
+        self.coalesced = 0
+
+    async def run(self, key: str, operation: Callable[[], Awaitable[Any]],
+                  fingerprint: Optional[str] = None) -> Tuple[Any, bool]:
+        """
+        Ejecutar la operación una sola vez por clave
+
+        Solo se guardan los resultados exitosos: si la operación falla, el
+        error se propaga a todos los que esperaban y un reintento vuelve a
+        ejecutarla.
+
+        Args:
+            fingerprint: Huella del payload (payload_fingerprint); si la clave
+                ya se usó con otra huella, la llamada se rechaza
+
+        Returns:
+            tuple: (resultado, repetido) donde repetido indica que el
+                resultado viene de una ejecución anterior o en curso
+
+        Raises:
+            IdempotencyConflictError: Si la clave ya se usó con otro payload
+        """
+        entry = self._get_completed(key)
+        if entry is not None:
+            self._check_fingerprint(key, entry[0], fingerprint)
+            self.replays += 1
+            logger.info("Idempotencia: resultado previo para %s", key)
+            return entry[1], True
+
+        in_flight = self._in_flight.get(key)
+        if in_flight is not None:
+            self._check_fingerprint(key, in_flight[1], fingerprint)
+            self.coalesced += 1
+            logger.info("Idempotencia: esperando operación en curso para %s", key)
+            return await asyncio.shield(in_flight[0]), True
+
+        future = asyncio.ensure_future(operation())
+        self._in_flight[key] = (future, fingerprint)
+        try:
+            result = await asyncio.shield(future)
+        finally:
+            if future.done():
+                self._in_flight.pop(key, None)
+            else:
+                # El llamador se canceló: la operación sigue para los demás
+                future.add_done_callback(lambda f: self._finish_detached(key, fingerprint, f))
+
+        self._store(key, fingerprint, result)
+        return result, False
+
+    @staticmethod
+    def _check_fingerprint(key: str, stored: Optional[str], fingerprint: Optional[str]):
+        if stored is not None and fingerprint is not None and stored != fingerprint:
+            raise IdempotencyConflictError(
+                "La clave de idempotencia ya se usó con otro contenido; usar una clave nueva")
+
+    def _finish_detached(self, key: str, fingerprint: Optional[str], future: asyncio.Future):
+        self._in_flight.pop(key, None)
+        if not future.cancelled() and future.exception() is None:
+            self._store(key, fingerprint, future.result())
+
+    def _get_completed(self, key: str) -> Optional[Tuple[Optional[str], Any]]:
+        """(huella, resultado) vigente de la clave, o None"""
+        entry = self._completed.get(key)
+        if entry is None:
+            return None
+        expires_at, fingerprint, result = entry
+        if self._clock() >= expires_at:
+            del self._completed[key]
+            return None
+        return fingerprint, result
+
+    def _store(self, key: str, fingerprint: Optional[str], result: Any):
+        self._completed[key] = (self._clock() + self.ttl, fingerprint, result)
+        self._completed.move_to_end(key)
+        while len(self._completed) > self.max_entries:
+            self._completed.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {
+            "stored": len(self._completed),
+            "in_flight": len(self._in_flight),
+            "replays": self.replays,
+            "coalesced": self.coalesced
+        }
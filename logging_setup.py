@@ -0,0 +1,237 @@
+"""
+Logging sin bloquear el event loop
+
+El event loop solo interpola el mensaje y encola el LogRecord en una cola
+acotada; un hilo en segundo plano (QueueListener) formatea, redacta y
+escribe. Además:
+
+- Muestreo por logger de las líneas INFO/DEBUG de alto volumen; WARNING y
+  superiores se registran siempre.
+- Redacción de ids de sesión, cookies B1SESSION y credenciales.
+- Mensajes truncados a un tamaño máximo (payloads de órdenes completas).
+- Salida en texto o JSON estructurado (una línea por registro).
+
+Variables de entorno:
+    LOG_LEVEL: Nivel del logger raíz (default INFO)
+    LOG_FORMAT: "text" o "json" (default text)
+    LOG_SAMPLE_RATES: Fracción de INFO/DEBUG a registrar por logger, ej: "sap_client=0.1,server=0.5"
+    LOG_MAX_MESSAGE_LENGTH: Caracteres máximos por mensaje (default 2000)
+    LOG_QUEUE_SIZE: Registros en cola antes de descartar (default 10000)
+"""
+
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+from config import env_int
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+REDACTED = "***"
+
+# Claves cuyo valor nunca debe llegar al log: SessionId, B1SESSION=..., "Password": "..."
+_SECRET_PATTERN = re.compile(
+    r"""(?i)((?:session[ _]?id|b1session|password|passwd|client[_-]?secret|secret|token|authorization)"""
+    r"""['"]?\s*[:=]\s*['"]?)([^'",;\s}&]+)"""
+)
+
+# Variables de entorno cuyo valor literal se redacta donde aparezca
+_SECRET_ENV_VARS = ("SAP_PASSWORD", "AZURE_CLIENT_SECRET")
+
+
+def redact(text: str) -> str:
+    """Reemplazar ids de sesión y credenciales por ***"""
+    text = _SECRET_PATTERN.sub(lambda m: m.group(1) + REDACTED, text)
+    for name in _SECRET_ENV_VARS:
+        secret = os.getenv(name)
+        if secret and len(secret) >= 4 and secret in text:
+            text = text.replace(secret, REDACTED)
+    return text
+
+
+def parse_sample_rates(spec: Optional[str]) -> Dict[str, float]:
+    """Parsear "logger=fracción,..." ignorando entradas mal formadas"""
+    rates: Dict[str, float] = {}
+    for entry in (spec or "").split(","):
+        name, _, rate = entry.partition("=")
+        try:
+            rates[name.strip()] = min(max(float(rate), 0.0), 1.0)
+        except ValueError:
+            continue
+    return rates
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Deja pasar una fracción de los INFO/DEBUG de cada logger configurado
+
+    Se aplica al logger más específico configurado (ej: "sap_client" cubre
+    "sap_client.x"). Corre en el hilo que loguea, por eso es solo un
+    random() y una búsqueda en dict cacheada por nombre de logger.
+    """
+
+    def __init__(self, rates: Dict[str, float]):
+        super().__init__()
+        self.rates = rates
+        self._resolved: Dict[str, Optional[float]] = {}
+
+    def _rate(self, name: str) -> Optional[float]:
+        if name not in self._resolved:
+            rate = None
+            candidate = name
+            while candidate:
+                if candidate in self.rates:
+                    rate = self.rates[candidate]
+                    break
+                candidate = candidate.rpartition(".")[0]
+            self._resolved[name] = rate
+        return self._resolved[name]
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self._rate(record.name)
+        return rate is None or random.random() < rate
+
+
+# Traceback a texto en el hilo que loguea (sin redactar: eso lo hace el formatter)
+_EXCEPTION_FORMATTER = logging.Formatter()
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler que nunca espera
+
+    Como QueueHandler, el mensaje se interpola con sus args en el hilo que
+    loguea (los args pueden cambiar o no ser seguros de leer desde otro
+    hilo) y la excepción se convierte a texto; formato, redacción y
+    escritura quedan para el hilo del listener. Si la cola está llena el
+    registro se descarta y se cuenta en dropped.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = _EXCEPTION_FORMATTER.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class RedactingFormatter(logging.Formatter):
+    """Formato de texto con redacción y truncado del mensaje"""
+
+    def __init__(self, fmt: str = TEXT_FORMAT, max_length: int = 2000):
+        super().__init__(fmt)
+        self.max_length = max_length
+
+    def _message(self, record: logging.LogRecord) -> str:
+        message = record.getMessage()
+        if self.max_length and len(message) > self.max_length:
+            message = f"{message[:self.max_length]}... [{len(message) - self.max_length} caracteres omitidos]"
+        return redact(message)
+
+    def _exception(self, record: logging.LogRecord) -> Optional[str]:
+        # La cola entrega la excepción ya convertida a texto (exc_text)
+        if record.exc_info:
+            return redact(self.formatException(record.exc_info))
+        return redact(record.exc_text) if record.exc_text else None
+
+    def format(self, record: logging.LogRecord) -> str:
+        record.message = self._message(record)
+        record.asctime = self.formatTime(record)
+        text = self.formatMessage(record)
+        exception = self._exception(record)
+        if exception:
+            text = f"{text}\n{exception}"
+        return text
+
+
+class JSONFormatter(RedactingFormatter):
+    """Un objeto JSON por línea: ts, level, logger, message (y exc_info)"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": self._message(record)
+        }
+        exception = self._exception(record)
+        if exception:
+            entry["exc_info"] = exception
+        return json.dumps(entry, ensure_ascii=False)
+
+
+_listener: Optional[logging.handlers.QueueListener] = None
+_queue_handler: Optional[NonBlockingQueueHandler] = None
+
+
+def setup_logging():
+    """
+    Reemplazar los handlers del logger raíz por la cola con listener en segundo plano
+
+    Es idempotente: una segunda llamada no crea otro listener.
+    """
+    global _listener, _queue_handler
+
+    if _listener is not None:
+        return
+
+    max_length = env_int('LOG_MAX_MESSAGE_LENGTH', 2000)
+    if os.getenv('LOG_FORMAT', 'text').lower() == 'json':
+        formatter: logging.Formatter = JSONFormatter(max_length=max_length)
+    else:
+        formatter = RedactingFormatter(max_length=max_length)
+
+    output = logging.StreamHandler()
+    output.setFormatter(formatter)
+
+    log_queue: queue.Queue = queue.Queue(maxsize=env_int('LOG_QUEUE_SIZE', 10000))
+    _queue_handler = NonBlockingQueueHandler(log_queue)
+    rates = parse_sample_rates(os.getenv('LOG_SAMPLE_RATES'))
+    if rates:
+        _queue_handler.addFilter(SamplingFilter(rates))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_queue_handler)
+    root.setLevel(os.getenv('LOG_LEVEL', 'INFO').upper())
+
+    _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown_logging)
+
+
+def shutdown_logging():
+    """Vaciar la cola y detener el listener"""
+    global _listener
+
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def dropped_records() -> int:
+    """Registros descartados por cola llena desde el inicio"""
+    return _queue_handler.dropped if _queue_handler is not None else 0
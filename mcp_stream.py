@@ -0,0 +1,230 @@
+"""
+Respuestas MCP incrementales (Streamable HTTP)
+
+Una herramienta en ejecución puede reportar avance (notifications/progress)
+y emitir bloques de contenido a medida que los obtiene, sin conocer el
+transporte: ambas funciones usan el canal de la llamada actual.
+
+- Con un cliente que acepta text/event-stream, el canal es un ToolStream:
+  una cola acotada que el endpoint /mcp vacía como eventos SSE. Si el
+  cliente lee lento, la herramienta espera (backpressure) y la memoria del
+  servidor queda acotada sin importar cuántas filas devuelva SAP.
+  Si el cliente pidió avance (progressToken), el contenido se retiene hasta
+  que la herramienta termina: una vez abierto el evento de respuesta ya no
+  se pueden enviar notificaciones de avance. La retención tiene el mismo
+  tope que la cola; al llenarse se abre la respuesta con lo retenido y el
+  resto del avance se descarta.
+- En cualquier otro caso el canal es un ContentCollector que acumula el
+  contenido para la respuesta JSON completa, como antes.
+"""
+
+import asyncio
+import logging
+from contextvars import ContextVar
+from typing import Any, AsyncIterator, Awaitable, Callable, List, Optional
+
+from config import env_int, env_float
+from payload import dumps_text
+
+logger = logging.getLogger(__name__)
+
+SSE_MEDIA_TYPE = "text/event-stream"
+
+
+class ContentCollector:
+    """Canal sin streaming: acumula el contenido y descarta el avance"""
+
+    def __init__(self):
+        self.items: List[Any] = []
+
+    async def progress(self, progress: float, total: Optional[float] = None, message: Optional[str] = None):
+        pass
+
+    async def content(self, item: Any):
+        self.items.append(item)
+
+
+class ToolStream:
+    """
+    Canal con streaming: cola acotada de eventos hacia la respuesta SSE
+
+    Variables de entorno:
+        MCP_STREAM_MAX_PENDING: Eventos máximos en cola antes de frenar a la herramienta,
+            y bloques de contenido retenidos mientras se envía avance (default 16)
+    """
+
+    def __init__(self, progress_token: Any = None, max_pending: Optional[int] = None):
+        self.progress_token = progress_token
+        self.max_pending = max(1, max_pending if max_pending is not None else env_int('MCP_STREAM_MAX_PENDING', 16))
+        # Contenido retenido mientras la herramienta puede seguir reportando avance
+        self._held: List[Any] = []
+        self._holding = progress_token is not None
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=self.max_pending)
+
+    async def progress(self, progress: float, total: Optional[float] = None, message: Optional[str] = None):
+        # Sin progressToken el cliente no pidió avance (especificación MCP); con
+        # el contenido ya en camino el evento de respuesta está abierto
+        if not self._holding:
+            return
+        params = {"progressToken": self.progress_token, "progress": progress}
+        if total is not None:
+            params["total"] = total
+        if message:
+            params["message"] = message
+        await self._queue.put(("progress", {"jsonrpc": "2.0", "method": "notifications/progress", "params": params}))
+
+    async def content(self, item: Any):
+        if self._holding:
+            if len(self._held) < self.max_pending:
+                self._held.append(item)
+                return
+            # Tope de retención: lo retenido sale primero y se deja de reportar avance
+            held, self._held, self._holding = self._held, [], False
+            for previous in held:
+                await self._queue.put(("content", previous))
+        await self._queue.put(("content", item))
+
+    async def finish(self, result: List[Any]):
+        held, self._held = self._held, []
+        await self._queue.put(("result", held + list(result)))
+
+    async def fail(self, error: Exception):
+        await self._queue.put(("error", error))
+
+    async def next_event(self, timeout: float):
+        return await asyncio.wait_for(self._queue.get(), timeout)
+
+
+# Canal de la llamada a herramienta en curso
+_current_channel: ContextVar[Optional[Any]] = ContextVar("mcp_tool_channel", default=None)
+
+
+async def report_progress(progress: float, total: Optional[float] = None, message: Optional[str] = None):
+    """Reportar avance de la herramienta en curso (no-op fuera de una llamada)"""
+    channel = _current_channel.get()
+    if channel is not None:
+        await channel.progress(progress, total, message)
+
+
+async def emit_content(item: Any):
+    """
+    Emitir un bloque de contenido de la herramienta en curso
+
+    Los bloques emitidos preceden, en orden, al contenido que devuelve la
+    herramienta al terminar.
+    """
+    channel = _current_channel.get()
+    if channel is None:
+        raise RuntimeError("emit_content fuera de una llamada a herramienta")
+    await channel.content(item)
+
+
+async def collect_tool_call(call: Callable[[], Awaitable[List[Any]]]) -> List[Any]:
+    """Ejecutar una herramienta sin streaming y devolver todo su contenido"""
+    collector = ContentCollector()
+    token = _current_channel.set(collector)
+    try:
+        result = await call()
+    finally:
+        _current_channel.reset(token)
+    return collector.items + list(result)
+
+
+def wants_event_stream(accept: Optional[str]) -> bool:
+    """El cliente acepta SSE según su header Accept"""
+    return bool(accept) and SSE_MEDIA_TYPE in accept
+
+
+def _sse(data: str) -> bytes:
+    return f"event: message\ndata: {data}\n\n".encode("utf-8")
+
+
+def _dump(value: Any) -> str:
+    return dumps_text(value)
+
+
+async def stream_tool_call(request_id: Any, progress_token: Any,
+                           call: Callable[[], Awaitable[List[Any]]],
+                           dump_content: Callable[[Any], Any],
+                           error_reply: Callable[[Any, Exception], dict]) -> AsyncIterator[bytes]:
+    """
+    Ejecutar una herramienta y producir la respuesta como eventos SSE
+
+    Las notificaciones de avance se envían como eventos propios. La
+    respuesta JSON-RPC final es un único evento, pero se escribe por partes:
+    cada bloque de contenido va en su propia línea "data:". El cliente SSE
+    une las líneas del evento y obtiene el JSON completo, así nunca se arma
+    el resultado entero en memoria. Sin progressToken cada bloque sale
+    apenas la herramienta lo emite. Con progressToken los bloques esperan a
+    que la herramienta termine o a que se llene el tope de ToolStream.
+    Mientras no hay eventos se envían comentarios de keep-alive para que los
+    proxies no corten la conexión.
+
+    Si la herramienta falla antes de emitir contenido, la respuesta es el
+    error JSON-RPC de error_reply (el mismo que sin streaming, ej: -32001
+    reintentable); si el evento de respuesta ya estaba abierto, el resultado
+    se cierra con el mensaje de error e isError.
+
+    Variables de entorno:
+        MCP_STREAM_KEEPALIVE: Segundos sin eventos antes de enviar un keep-alive (default 15)
+    """
+    keepalive = env_float('MCP_STREAM_KEEPALIVE', 15.0)
+    stream = ToolStream(progress_token)
+
+    async def run():
+        token = _current_channel.set(stream)
+        try:
+            result = await call()
+        except Exception as e:
+            await stream.fail(e)
+            return
+        finally:
+            _current_channel.reset(token)
+        await stream.finish(result)
+
+    task = asyncio.create_task(run())
+    head = _dump({"jsonrpc": "2.0", "id": request_id})[:-1] + ',"result":{"content":['
+    opened = False
+    separator = ""
+
+    try:
+        while True:
+            try:
+                kind, payload = await stream.next_event(keepalive)
+            except asyncio.TimeoutError:
+                yield b": keep-alive\n"
+                continue
+
+            if kind == "progress":
+                # Dentro del evento de respuesta ya no se pueden intercalar eventos
+                if not opened:
+                    yield _sse(_dump(payload))
+                continue
+
+            if kind == "error":
+                if not opened:
+                    yield _sse(_dump(error_reply(request_id, payload)))
+                    return
+                logger.error("Error en herramienta con streaming después de emitir contenido: %s", payload)
+                error_item = {"type": "text", "text": f"Error: {str(payload)}"}
+                yield f"data: {separator}{_dump(error_item)}\n".encode("utf-8")
+                yield b'data: ],"isError":true}}\n\n'
+                return
+
+            if not opened:
+                yield f"event: message\ndata: {head}\n".encode("utf-8")
+                opened = True
+
+            items = [payload] if kind == "content" else payload
+            for item in items:
+                yield f"data: {separator}{_dump(dump_content(item))}\n".encode("utf-8")
+                separator = ","
+
+            if kind == "result":
+                yield b"data: ]}}\n\n"
+                return
+    finally:
+        # El cliente se desconectó o terminó la respuesta
+        if not task.done():
+            task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
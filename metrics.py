@@ -0,0 +1,233 @@
+"""
+Métricas en formato de exposición de Prometheus
+
+Registro mínimo de contadores, gauges e histogramas con etiquetas, sin
+dependencias externas. Registrar una muestra es una búsqueda en un dict y
+una búsqueda binaria sobre los buckets, sin locks: todo ocurre en el
+event loop. El texto de exposición solo se arma cuando se consulta
+/metrics.
+"""
+
+import re
+from bisect import bisect_left
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+# Buckets de latencia en segundos: de requests OData rápidas a $batch lentos
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Claves de entidad en rutas OData: Items('A001'), Orders(123)
+_ENTITY_KEY = re.compile(r"\([^)]*\)")
+
+
+def endpoint_label(path: str) -> str:
+    """
+    Etiqueta de endpoint de baja cardinalidad
+
+    Quita la query string y reemplaza las claves de entidad, así
+    /Items('A001') y /Items('B002') comparten serie.
+    """
+    path = path.split("?", 1)[0]
+    if not path.startswith("/"):
+        path = "/" + path
+    return _ENTITY_KEY.sub("({key})", path)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class Metric:
+    """Base: nombre, ayuda y nombres de etiquetas"""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _samples(self) -> Iterable[str]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}", *self._samples()]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        if not self.labelnames:
+            # Sin etiquetas la serie existe desde el inicio (se expone en 0)
+            self._values[()] = 0
+
+    def inc(self, *labelvalues: str, amount: float = 1):
+        self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def value(self, *labelvalues: str) -> float:
+        return self._values.get(labelvalues, 0)
+
+    def _samples(self) -> Iterable[str]:
+        for labels, value in self._values.items():
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, *labelvalues: str):
+        self._values[labelvalues] = value
+
+    def dec(self, *labelvalues: str, amount: float = 1):
+        self.inc(*labelvalues, amount=-amount)
+
+    def clear(self):
+        self._values.clear()
+        if not self.labelnames:
+            self._values[()] = 0
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # etiquetas -> [conteos por bucket (no acumulados) + desborde, suma]
+        self._series: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, *labelvalues: str):
+        series = self._series.get(labelvalues)
+        if series is None:
+            series = self._series[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def count(self, *labelvalues: str) -> int:
+        series = self._series.get(labelvalues)
+        return sum(series[0]) if series else 0
+
+    def _samples(self) -> Iterable[str]:
+        for labels, (counts, total) in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(total)}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"Métrica duplicada: {metric.name}")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# --- Herramientas MCP ----------------------------------------------------
+
+TOOL_DURATION = REGISTRY.register(Histogram(
+    "mcp_tool_duration_seconds", "Duración de las llamadas a herramientas MCP", ["tool"]))
+TOOL_ERRORS = REGISTRY.register(Counter(
+    "mcp_tool_errors_total", "Llamadas a herramientas MCP que terminaron con excepción", ["tool"]))
+TOOLS_IN_FLIGHT = REGISTRY.register(Gauge(
+    "mcp_tool_calls_in_flight", "Llamadas a herramientas MCP en curso"))
+
+# --- Service Layer -------------------------------------------------------
+
+SAP_REQUEST_DURATION = REGISTRY.register(Histogram(
+    "sap_request_duration_seconds", "Duración de las requests al Service Layer", ["method", "endpoint"]))
+SAP_REQUESTS = REGISTRY.register(Counter(
+    "sap_requests_total", "Requests al Service Layer por status HTTP (error = sin respuesta)",
+    ["method", "endpoint", "status"]))
+SAP_REQUESTS_IN_FLIGHT = REGISTRY.register(Gauge(
+    "sap_requests_in_flight", "Requests al Service Layer en curso"))
+SAP_LOGINS = REGISTRY.register(Counter(
+    "sap_logins_total", "Logins al Service Layer por resultado", ["result"]))
+SAP_LOGIN_DURATION = REGISTRY.register(Histogram(
+    "sap_login_duration_seconds", "Duración de los logins al Service Layer"))
+SAP_RELOGINS = REGISTRY.register(Counter(
+    "sap_relogins_total", "Re-autenticaciones (sesión expirada, 401 o renovación)"))
+SAP_RETRIES = REGISTRY.register(Counter(
+    "sap_retries_total", "Reintentos de requests a SAP por falla transitoria", ["method", "reason"]))
+
+# --- Pool de sesiones (se actualizan al consultar /metrics) ---------------
+
+SAP_POOL_SESSIONS = REGISTRY.register(Gauge(
+    "sap_pool_sessions", "Sesiones SAP del pool por estado", ["state"]))
+SAP_SESSION_AGE = REGISTRY.register(Gauge(
+    "sap_session_age_seconds", "Antigüedad de la sesión SAP más vieja y más nueva del pool", ["stat"]))
+SAP_COMPANY_POOLS = REGISTRY.register(Gauge(
+    "sap_company_pools", "Compañías SAP con pool de sesiones abierto"))
+
+# --- Protección del Service Layer (sap_guard) --------------------------------
+
+SAP_CONCURRENCY_LIMIT = REGISTRY.register(Gauge(
+    "sap_concurrency_limit", "Límite adaptativo de requests concurrentes hacia SAP"))
+SAP_CIRCUIT_STATE = REGISTRY.register(Gauge(
+    "sap_circuit_state", "Estado del circuit breaker de SAP (0 cerrado, 1 half-open, 2 abierto)"))
+SAP_REJECTED = REGISTRY.register(Counter(
+    "sap_rejected_total", "Requests a SAP rechazadas sin enviarse, por motivo", ["reason"]))
+
+# --- Logging (logging_setup) -------------------------------------------------
+
+LOG_RECORDS_DROPPED = REGISTRY.register(Gauge(
+    "log_records_dropped", "Registros de log descartados por cola llena desde el inicio "
+    "(se actualiza al consultar /metrics)"))
+
+# --- Trabajos en segundo plano (sap_jobs) -----------------------------------
+
+SAP_JOB_DOCUMENTS = REGISTRY.register(Counter(
+    "sap_job_documents_total", "Documentos de trabajos en segundo plano procesados, por resultado", ["status"]))
+SAP_JOB_QUEUE = REGISTRY.register(Gauge(
+    "sap_job_documents_queued", "Documentos de trabajos sin terminar por estado (se actualiza al consultar /metrics)",
+    ["state"]))
+
+# --- Cotizaciones locales (sap_pricing) ---------------------------------------
+
+SAP_QUOTE_CHECKS = REGISTRY.register(Counter(
+    "sap_quote_checks_total", "Cotizaciones locales contrastadas con el precio de SAP, por resultado", ["result"]))
+
+# --- Compresión de respuestas (payload) -----------------------------------------
+
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+SAP_RESPONSE_BYTES = REGISTRY.register(Counter(
+    "sap_response_bytes_total", "Bytes recibidos del Service Layer (en el cable) por Content-Encoding", ["encoding"]))
+SAP_RESPONSE_SAVED_BYTES = REGISTRY.register(Histogram(
+    "sap_response_saved_bytes", "Bytes ahorrados por respuesta comprimida de SAP", ["encoding"], BYTES_BUCKETS))
+MCP_RESPONSE_BYTES = REGISTRY.register(Counter(
+    "mcp_response_bytes_total", "Bytes enviados en respuestas de /mcp por Content-Encoding", ["encoding"]))
+MCP_RESPONSE_SAVED_BYTES = REGISTRY.register(Histogram(
+    "mcp_response_saved_bytes", "Bytes ahorrados por respuesta comprimida de /mcp", ["encoding"], BYTES_BUCKETS))
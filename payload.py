@@ -0,0 +1,112 @@
+"""
+Serialización JSON y compresión de cuerpos en ambos tramos
+
+Hacia el Service Layer: ACCEPT_ENCODING anuncia los formatos que httpx sabe
+decodificar (gzip y deflate siempre; br y zstd si están instalados brotli y
+zstandard), así las respuestas grandes de Items y Orders viajan comprimidas
+por el enlace WAN.
+
+Hacia el cliente MCP: dumps usa orjson si está instalado (bastante más
+rápido que json) y compress_body comprime con br o gzip las respuestas que
+superan MCP_COMPRESS_MIN_SIZE bytes, según el Accept-Encoding del cliente.
+Los bytes ahorrados por respuesta se registran en las métricas.
+"""
+
+import gzip
+import json
+from typing import Any, Optional, Tuple
+
+from config import env_int
+from metrics import MCP_RESPONSE_BYTES, MCP_RESPONSE_SAVED_BYTES, SAP_RESPONSE_BYTES, SAP_RESPONSE_SAVED_BYTES
+
+try:
+    import orjson
+except ImportError:  # dependencia opcional
+    orjson = None
+
+try:
+    import brotli
+except ImportError:  # dependencia opcional
+    try:
+        import brotlicffi as brotli
+    except ImportError:
+        brotli = None
+
+try:
+    import zstandard
+except ImportError:  # dependencia opcional
+    zstandard = None
+
+# Formatos que httpx decodifica con lo instalado, en orden de preferencia
+ACCEPT_ENCODING = ", ".join(["gzip", "deflate"] + (["br"] if brotli else []) + (["zstd"] if zstandard else []))
+
+
+def dumps(value: Any) -> bytes:
+    """JSON compacto en UTF-8 (orjson si está instalado)"""
+    if orjson is not None:
+        return orjson.dumps(value, default=str, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"), default=str).encode("utf-8")
+
+
+def dumps_text(value: Any) -> str:
+    """JSON compacto como texto, para el contenido de las herramientas (sin indentación)"""
+    return dumps(value).decode("utf-8")
+
+
+def _accepted(accept_encoding: Optional[str]) -> set:
+    """Codificaciones aceptadas por el cliente (q > 0)"""
+    accepted = set()
+    for part in (accept_encoding or "").lower().split(","):
+        name, _, params = part.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                continue
+        if name and quality > 0:
+            accepted.add(name)
+    return accepted
+
+
+def compress_body(body: bytes, accept_encoding: Optional[str]) -> Tuple[bytes, Optional[str]]:
+    """
+    Comprimir un cuerpo de respuesta si el cliente lo acepta y vale la pena
+
+    Variables de entorno:
+        MCP_COMPRESS_MIN_SIZE: Bytes mínimos para comprimir; 0 desactiva la compresión (default 1024)
+        MCP_COMPRESS_LEVEL: Nivel de gzip (1-9, default 5); br usa una calidad equivalente
+
+    Returns:
+        tuple: (cuerpo, Content-Encoding o None si va sin comprimir)
+    """
+    min_size = env_int('MCP_COMPRESS_MIN_SIZE', 1024)
+    encoding = None
+    if min_size > 0 and len(body) >= min_size:
+        accepted = _accepted(accept_encoding)
+        if brotli is not None and "br" in accepted:
+            encoding = "br"
+        elif "gzip" in accepted or "*" in accepted:
+            encoding = "gzip"
+
+    if encoding == "br":
+        compressed = brotli.compress(body, quality=min(11, env_int('MCP_COMPRESS_LEVEL', 5)))
+    elif encoding == "gzip":
+        compressed = gzip.compress(body, compresslevel=env_int('MCP_COMPRESS_LEVEL', 5))
+    else:
+        MCP_RESPONSE_BYTES.inc("identity", amount=len(body))
+        return body, None
+
+    MCP_RESPONSE_BYTES.inc(encoding, amount=len(compressed))
+    MCP_RESPONSE_SAVED_BYTES.observe(max(0, len(body) - len(compressed)), encoding)
+    return compressed, encoding
+
+
+def record_sap_response(response) -> None:
+    """Registrar bytes recibidos de SAP y los ahorrados por la compresión (httpx.Response ya leída)"""
+    encoding = response.headers.get("content-encoding", "identity").lower() or "identity"
+    wire = response.num_bytes_downloaded
+    SAP_RESPONSE_BYTES.inc(encoding, amount=wire)
+    if encoding != "identity":
+        SAP_RESPONSE_SAVED_BYTES.observe(max(0, len(response.content) - wire), encoding)
@@ -0,0 +1,123 @@
+"""
+Caché en memoria para datos maestros del Service Layer (Items, BusinessPartners)
+
+Caché read-through con expiración por TTL y desalojo LRU al superar el
+máximo de entradas. Los contadores de aciertos y fallos permiten
+dimensionarla.
+"""
+
+import logging
+import re
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Iterable, Optional, Tuple
+
+from config import env_int, env_float
+
+logger = logging.getLogger(__name__)
+
+# Valor devuelto por get() cuando la clave no está en caché
+MISSING = object()
+
+
+def master_data_key(entity: str, filter_query: Optional[str] = None,
+                    select: Optional[Iterable[str]] = None, top: Optional[int] = None) -> Tuple:
+    """
+    Clave normalizada de una consulta de datos maestros
+
+    Consultas equivalentes comparten entrada: se colapsan los espacios del
+    $filter (sin cambiar mayúsculas, los literales OData las distinguen) y
+    los campos de $select se ordenan sin duplicados.
+    """
+    normalized_filter = re.sub(r"\s+", " ", filter_query).strip() if filter_query else None
+    normalized_select = tuple(sorted({f.strip() for f in select if f.strip()})) if select else None
+    return (entity, normalized_filter or None, normalized_select, top or None)
+
+
+class MasterDataCache:
+    """
+    Caché TTL + LRU
+
+    Variables de entorno:
+        SAP_CACHE_TTL: Segundos de vida de cada entrada; 0 desactiva la caché (default 300)
+        SAP_CACHE_MAX_ENTRIES: Entradas máximas antes de desalojar la menos usada (default 1000)
+    """
+
+    def __init__(self, ttl: Optional[float] = None, max_entries: Optional[int] = None,
+                 clock: Callable[[], float] = time.monotonic):
+        self.ttl = ttl if ttl is not None else env_float('SAP_CACHE_TTL', 300.0)
+        self.max_entries = max_entries if max_entries is not None else env_int('SAP_CACHE_MAX_ENTRIES', 1000)
+        self._clock = clock
+        # clave -> (expira_en, valor); el orden refleja el uso (último = más reciente)
+        self._entries: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0 and self.max_entries > 0
+
+    def get(self, key: Hashable) -> Any:
+        """Devolver el valor en caché o MISSING"""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return MISSING
+
+        expires_at, value = entry
+        if self._clock() >= expires_at:
+            del self._entries[key]
+            self.expirations += 1
+            self.misses += 1
+            return MISSING
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any):
+        if not self.enabled:
+            return
+
+        self._entries[key] = (self._clock() + self.ttl, value)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, entity: Optional[str] = None) -> int:
+        """
+        Eliminar entradas de una entidad (ej: '/Items') o todas si entity es None
+
+        Returns:
+            int: Número de entradas eliminadas
+        """
+        if entity is None:
+            removed = len(self._entries)
+            self._entries.clear()
+        else:
+            keys = [k for k in self._entries if isinstance(k, tuple) and k and k[0] == entity]
+            for k in keys:
+                del self._entries[k]
+            removed = len(keys)
+
+        if removed:
+            logger.info("Caché de datos maestros invalidada: %s (%s entradas)", entity or 'todas', removed)
+        return removed
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations
+        }
@@ -1,24 +1,88 @@
 
 
-import requests
+import httpx
 import logging
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Tuple, List, AsyncIterator, Awaitable, Callable
 from datetime import datetime, timedelta
-import urllib3
+from urllib.parse import quote, urlencode, urlsplit
+import asyncio
+import json
+import math
 import os
+import re
+import time
+import uuid
 
-# Desactivar advertencias SSL para desarrollo local
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+from config import env_int, env_float
+from sap_cache import MISSING, MasterDataCache, master_data_key
+from sap_guard import SAPGuard, ServiceUnavailableError
+from deadlines import (_NOT_SENT_ERRORS, IDEMPOTENT_METHODS, DeadlineExceeded, RetryPolicy, check_deadline,
+                       remaining)
+from metrics import (SAP_LOGIN_DURATION, SAP_LOGINS, SAP_RELOGINS, SAP_REQUEST_DURATION, SAP_REQUESTS,
+                     SAP_REQUESTS_IN_FLIGHT, SAP_RETRIES, endpoint_label)
+from payload import ACCEPT_ENCODING, record_sap_response
 
-# Configurar logging
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+def build_http_limits() -> httpx.Limits:
+    """
+    Construir los límites del pool de conexiones keep-alive hacia el Service Layer
+
+    Variables de entorno:
+        SAP_HTTP_MAX_CONNECTIONS: Conexiones simultáneas máximas (default 20)
+        SAP_HTTP_MAX_KEEPALIVE: Conexiones keep-alive ociosas a conservar (default 10)
+        SAP_HTTP_KEEPALIVE_EXPIRY: Segundos antes de cerrar una conexión ociosa (default 30)
+    """
+    return httpx.Limits(
+        max_connections=env_int('SAP_HTTP_MAX_CONNECTIONS', 20),
+        max_keepalive_connections=env_int('SAP_HTTP_MAX_KEEPALIVE', 10),
+        keepalive_expiry=env_float('SAP_HTTP_KEEPALIVE_EXPIRY', 30.0)
+    )
+
+
+def build_http_timeout() -> httpx.Timeout:
+    """
+    Construir los timeouts por defecto de las requests al Service Layer
+
+    Cada request además se acota al plazo restante de la llamada MCP
+    (ver deadlines.py).
+
+    Variables de entorno:
+        SAP_HTTP_CONNECT_TIMEOUT: Segundos para establecer la conexión (default 5)
+        SAP_HTTP_READ_TIMEOUT: Segundos máximos sin recibir datos de SAP (default 60)
+        SAP_HTTP_WRITE_TIMEOUT: Segundos máximos enviando el cuerpo (default 30)
+        SAP_HTTP_POOL_TIMEOUT: Segundos esperando una conexión libre del pool (default 10)
+    """
+    return httpx.Timeout(
+        connect=env_float('SAP_HTTP_CONNECT_TIMEOUT', 5.0),
+        read=env_float('SAP_HTTP_READ_TIMEOUT', 60.0),
+        write=env_float('SAP_HTTP_WRITE_TIMEOUT', 30.0),
+        pool=env_float('SAP_HTTP_POOL_TIMEOUT', 10.0)
+    )
+
+
+# Campos del detalle de una Sales Order (sap_get_order_detail)
+ORDER_DETAIL_FIELDS = ["DocEntry", "DocNum", "CardCode", "CardName", "DocDate", "DocDueDate", "DocTotal",
+                       "VatSum", "DocCurrency", "DocumentStatus", "DocumentLines"]
+DETAIL_PARTNER_FIELDS = ["CardCode", "CardName", "CardType", "Phone1", "EmailAddress", "Currency",
+                         "CurrentAccountBalance"]
+DETAIL_ITEM_FIELDS = ["ItemCode", "ItemName", "SalesUnit", "QuantityOnStock", "ItemsGroupCode"]
+
+# Códigos por consulta $filter=ItemCode eq ... or ... (cabe en la página por defecto de SAP)
+LOOKUP_CHUNK_SIZE = 20
+
+
 class SAPClient:
 
     
-    def __init__(self, base_url: Optional[str] = None):
+    def __init__(self, base_url: Optional[str] = None,
+                 limits: Optional[httpx.Limits] = None,
+                 transport: Optional[httpx.AsyncBaseTransport] = None,
+                 cache: Optional[MasterDataCache] = None,
+                 guard: Optional[SAPGuard] = None,
+                 timeout: Optional[httpx.Timeout] = None,
+                 retry_policy: Optional[RetryPolicy] = None):
     
         
         # Obtener URL desde variable de entorno si no se proporciona
@@ -28,20 +92,46 @@ class SAPClient:
         self.base_url = base_url
         self.session_id: Optional[str] = None
         self.session_timeout: Optional[datetime] = None
-        self.session = requests.Session()
+        self.company_db: Optional[str] = None
+        # Nodo del Service Layer al que está fijada la sesión (cookie ROUTEID)
+        self.route_id: Optional[str] = None
+        # Timeout de inactividad informado por SAP en el login (minutos)
+        self.session_timeout_minutes: int = 30
+        # Momento del último login exitoso (time.monotonic), para la antigüedad de la sesión
+        self.logged_in_at: Optional[float] = None
+        # Última respuesta exitosa de SAP con esta sesión (time.monotonic), para la sonda /ready
+        self.last_ok_at: Optional[float] = None
+        # Credenciales del último login exitoso, para re-autenticar sin intervención
+        self._credentials: Optional[Tuple[str, str, str]] = None
+        # Login en curso compartido por todos los que esperan (single-flight)
+        self._login_task: Optional[asyncio.Task] = None
+        # Caché de datos maestros, compartida entre las sesiones de un pool
+        self.cache = cache
+        # Límite de concurrencia y circuit breaker hacia el Service Layer (compartidos por el pool)
+        self.guard = guard
+        # Timeouts por defecto y reintentos ante fallas transitorias
+        self.timeout = timeout or build_http_timeout()
+        self.retry_policy = retry_policy or RetryPolicy()
         
-        # Configurar session para HTTPS sin verificación (solo desarrollo local)
-        self.session.verify = False
-        
-        # Headers por defecto
-        self.session.headers.update({
-            'Content-Type': 'application/json',
-            'Accept': 'application/json'
-        })
+        # Cliente HTTP asíncrono con pool de conexiones keep-alive.
+        # HTTPS sin verificación (solo desarrollo local), igual que antes.
+        # El transport es inyectable para pruebas y benchmarks.
+        self.session = httpx.AsyncClient(
+            verify=False,
+            limits=limits or build_http_limits(),
+            timeout=self.timeout,
+            transport=transport,
+            headers={
+                'Content-Type': 'application/json',
+                'Accept': 'application/json',
+                # httpx descomprime de forma transparente; se anuncia todo lo que sabe decodificar
+                'Accept-Encoding': ACCEPT_ENCODING
+            }
+        )
         
-        logger.info(f"SAP Client inicializado para {base_url}")
+        logger.info("SAP Client inicializado para %s", base_url)
     
-    def login_from_env(self) -> bool:
+    async def login_from_env(self) -> bool:
        
 
         
@@ -60,13 +150,13 @@ class SAPClient:
             missing_vars.append('SAP_PASSWORD')
         
         if missing_vars:
-            logger.error(f"Variables de entorno faltantes: {', '.join(missing_vars)}")
+            logger.error("Variables de entorno faltantes: %s", ', '.join(missing_vars))
             return False
         
         # Realizar login con credenciales obtenidas
-        return self.login(company_db, username, password)
+        return await self.login(company_db, username, password)
 
-    def login(self, company_db: str, username: str, password: str) -> bool:
+    async def login(self, company_db: str, username: str, password: str) -> bool:
         """Realizar login a SAP Business One Service Layer"""
         if not self.base_url:
             logger.error("URL base no configurada")
@@ -81,13 +171,23 @@ class SAPClient:
             "UserName": username
         }
         
+        start = time.perf_counter()
         try:
-            logger.info(f"Intentando login a SAP: {login_url}")
-            logger.info(f"Company DB: {company_db}, Username: {username}")
+            logger.info("Intentando login a SAP: %s (Company DB: %s, Username: %s)", login_url, company_db, username)
             
-            response = self.session.post(login_url, json=payload)
+            try:
+                response = await self.session.post(login_url, json=payload)
+            except Exception:
+                if self.guard is not None:
+                    self.guard.record(time.perf_counter() - start, failed=True)
+                raise
+            finally:
+                SAP_LOGIN_DURATION.observe(time.perf_counter() - start)
             
-            logger.info(f"Respuesta del login: Status {response.status_code}")
+            if self.guard is not None:
+                self.guard.record(time.perf_counter() - start, failed=response.status_code >= 500)
+            
+            logger.debug("Respuesta del login: Status %s", response.status_code)
             
             if response.status_code == 200:
                 # Obtener session ID del response body
@@ -100,66 +200,145 @@ class SAPClient:
                 routeid = response.cookies.get('ROUTEID')
                 
                 if self.session_id:
-                    logger.info(f"Login exitoso. Session ID: {self.session_id}")
+                    logger.info("Login exitoso")
                     
                     # Agregar B1SESSION cookie a headers para futuras requests
                     if b1session:
                         self.session.cookies.set('B1SESSION', b1session)
-                        logger.info("Cookie B1SESSION configurada")
+                        logger.debug("Cookie B1SESSION configurada")
                     
                     if routeid:
                         self.session.cookies.set('ROUTEID', routeid)
-                        logger.info("Cookie ROUTEID configurada")
+                        self.route_id = routeid
+                        logger.debug("Cookie ROUTEID configurada")
                     
                     # Configurar timeout de sesión
                     # Por defecto SAP usa 30 minutos, pero puede ser configurado en b1s.conf
                     session_timeout = response_data.get('SessionTimeout', 30)
+                    self.session_timeout_minutes = session_timeout
                     self.session_timeout = datetime.now() + timedelta(minutes=session_timeout)
+                    self._credentials = (company_db, username, password)
+                    self.logged_in_at = self.last_ok_at = time.monotonic()
+                    SAP_LOGINS.inc("success")
                     
-                    logger.info(f"Sesión configurada - Timeout: {session_timeout} minutos")
-                    logger.info(f"Sesión expira: {self.session_timeout}")
+                    logger.info("Sesión configurada - Timeout: %s minutos, expira: %s",
+                                session_timeout, self.session_timeout)
                     
                     return True
                 else:
                     logger.error("Login falló: No se recibió Session ID")
+                    SAP_LOGINS.inc("failure")
                     return False
             else:
-                logger.error(f"Login falló: {response.status_code} - {response.text}")
+                logger.error("Login falló: %s - %s", response.status_code, response.text)
+                SAP_LOGINS.inc("failure")
                 return False
                 
         except Exception as e:
-            logger.error(f"Error durante login: {e}")
+            logger.error("Error durante login: %s", e)
+            SAP_LOGINS.inc("failure")
             return False
-            logger.info(f"Intentando login en SAP para usuario: {username}")
-            
-            response = self.session.post(login_url, json=payload, timeout=30)
+    
+    async def relogin(self, stale_session_id: Optional[str] = None) -> bool:
+        """
+        Re-autenticar con las credenciales del último login (o del entorno)
+        
+        Solo hay un login en curso por cliente: las llamadas concurrentes
+        esperan ese mismo login y comparten su resultado.
+        
+        Args:
+            stale_session_id: Sesión que el llamador vio fallar. Si otro login
+                ya la reemplazó, no se vuelve a hacer login.
             
-            if response.status_code == 200:
-                # SAP devuelve el SessionId en las cookies
-                session_cookie = response.cookies.get('B1SESSION')
-                if session_cookie:
-                    self.session_id = session_cookie
-                    # Establecer timeout de sesión (SAP típicamente 30 minutos)
-                    self.session_timeout = datetime.now() + timedelta(minutes=30)
-                    
-                    # Agregar cookie a futuras peticiones
-                    self.session.cookies.set('B1SESSION', session_cookie)
-                    
-                    logger.info("Login exitoso en SAP")
-                    return True
-                else:
-                    logger.error("Login exitoso pero no se recibió SessionId")
-                    return False
-            else:
-                logger.error(f"Error en login SAP: {response.status_code} - {response.text}")
-                return False
-                
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Error de conexión al hacer login: {str(e)}")
-            return False
-        except Exception as e:
-            logger.error(f"Error inesperado en login: {str(e)}")
-            return False
+        Returns:
+            bool: True si hay una sesión válida al terminar
+        """
+        if stale_session_id is not None and self.session_id != stale_session_id and self.is_session_valid():
+            return True
+        
+        if self._login_task is None:
+            self._login_task = asyncio.ensure_future(self._relogin_once())
+        
+        # shield: si un llamador se cancela, el login sigue para los demás
+        return await asyncio.shield(self._login_task)
+    
+    async def _relogin_once(self) -> bool:
+        try:
+            if self._credentials:
+                SAP_RELOGINS.inc()
+                return await self.login(*self._credentials)
+            return await self.login_from_env()
+        finally:
+            self._login_task = None
+    
+    async def ensure_session(self) -> bool:
+        """Garantizar una sesión válida, re-autenticando si hace falta"""
+        if self.is_session_valid():
+            return True
+        return await self.relogin()
+    
+    def expires_within(self, seconds: float) -> bool:
+        """Indica si la sesión expira (o ya expiró) dentro de los próximos segundos"""
+        if not self.session_timeout:
+            return True
+        return datetime.now() + timedelta(seconds=seconds) >= self.session_timeout
+    
+    async def refresh_session(self) -> bool:
+        """
+        Renovar la sesión antes de que expire
+        
+        Cierra la sesión actual para liberar la licencia y abre una nueva.
+        Lo invoca la tarea de mantenimiento del pool sobre sesiones ociosas,
+        así ninguna llamada de usuario paga el costo del login.
+        """
+        if self.session_id:
+            await self.logout()
+        return await self.relogin()
+    
+    def _touch(self):
+        """El timeout de SAP es por inactividad: cada request exitosa lo extiende"""
+        self.last_ok_at = time.monotonic()
+        if self.session_id:
+            self.session_timeout = datetime.now() + timedelta(minutes=self.session_timeout_minutes)
+    
+    def session_state(self) -> Optional[dict]:
+        """
+        Estado de la sesión actual para compartirla con otros procesos
+        
+        Returns:
+            dict: Cookies, compañía, usuario y expiración (epoch), o None sin sesión
+        """
+        if not self.session_id or not self.session_timeout or not self._credentials:
+            return None
+        return {
+            "session_id": self.session_id,
+            # La cookie puede estar dos veces en el jar (con y sin dominio), con el mismo valor
+            "b1session": next((c.value for c in self.session.cookies.jar if c.name == 'B1SESSION'),
+                              self.session_id),
+            "route_id": self.route_id,
+            "company_db": self._credentials[0],
+            "username": self._credentials[1],
+            "timeout_minutes": self.session_timeout_minutes,
+            "expires_at": self.session_timeout.timestamp()
+        }
+    
+    def adopt_session(self, state: dict, password: Optional[str] = None):
+        """
+        Usar una sesión abierta por otro proceso (ver session_store.py)
+        
+        La contraseña no se comparte por el almacén: un re-login posterior
+        usa la indicada o, sin ella, SAP_PASSWORD.
+        """
+        self.session_id = state["session_id"]
+        self.company_db = state["company_db"]
+        self.route_id = state.get("route_id")
+        self.session_timeout_minutes = state["timeout_minutes"]
+        self.session_timeout = datetime.fromtimestamp(state["expires_at"])
+        self.logged_in_at = time.monotonic()
+        self.session.cookies.set('B1SESSION', state["b1session"])
+        if self.route_id:
+            self.session.cookies.set('ROUTEID', self.route_id)
+        self._credentials = (state["company_db"], state["username"], password or os.getenv('SAP_PASSWORD'))
     
     def is_session_valid(self) -> bool:
         """
@@ -178,7 +357,7 @@ class SAPClient:
         
         return True
     
-    def logout(self) -> bool:
+    async def logout(self) -> bool:
         """
         Cierra la sesión en SAP usando POST según documentación oficial
         
@@ -194,12 +373,12 @@ class SAPClient:
         
         try:
             logout_url = f"{self.base_url}/Logout"
-            logger.info(f"Haciendo logout: {logout_url}")
+            logger.info("Haciendo logout: %s", logout_url)
             
             # POST al endpoint de Logout según documentación SAP
-            response = self.session.post(logout_url, timeout=10)
+            response = await self.session.post(logout_url, timeout=10)
             
-            logger.info(f"Logout response: {response.status_code}")
+            logger.info("Logout response: %s", response.status_code)
             
             # SAP puede devolver diferentes códigos según la implementación
             if response.status_code in [200, 204]:
@@ -207,37 +386,35 @@ class SAPClient:
             elif response.status_code == 401:
                 logger.info("Sesión ya expirada (logout implícito)")
             else:
-                logger.warning(f"Logout con código inesperado: {response.status_code}")
+                logger.warning("Logout con código inesperado: %s", response.status_code)
                 # Mostrar respuesta para debugging
                 if response.text:
-                    logger.warning(f"Respuesta logout: {response.text[:200]}")
+                    logger.warning("Respuesta logout: %s", response.text[:200])
             
             # Limpiar sesión local independientemente del resultado
             self.session_id = None
             self.session_timeout = None
+            self.route_id = None
+            self.logged_in_at = None
             self.session.cookies.clear()
             
             logger.info("Sesión local limpiada")
             return True
             
         except Exception as e:
-            logger.error(f"Error en logout: {str(e)}")
+            logger.error("Error en logout: %s", e)
             # Limpiar sesión local aunque haya error de comunicación
             self.session_id = None
             self.session_timeout = None
+            self.route_id = None
+            self.logged_in_at = None
             self.session.cookies.clear()
             logger.info("Sesión local limpiada por error")
             return False
-            
-        except Exception as e:
-            logger.error(f"Error en logout: {str(e)}")
-            # Limpiar sesión local aunque haya error
-            self.session_id = None
-            self.session_timeout = None
-            self.session.cookies.clear()
-            return False
     
-    def make_request(self, method: str, endpoint: str, data: dict = None, params: dict = None, json_data: dict = None) -> any:
+    async def make_request(self, method: str, endpoint: str, data: dict = None, params: dict = None, json_data: dict = None,
+                           extra_headers: dict = None, content: bytes = None, raw_response: bool = False,
+                           idempotent: Optional[bool] = None) -> any:
         """
         Hacer una request al SAP Service Layer con autenticación
         
@@ -247,16 +424,26 @@ class SAPClient:
             data: Datos para POST/PUT (form data)
             params: Parámetros de query string
             json_data: Datos JSON para POST/PUT
+            extra_headers: Headers adicionales (ej: Prefer: odata.maxpagesize)
+            content: Cuerpo crudo (ej: multipart de $batch)
+            raw_response: Devolver el httpx.Response sin interpretar
+            idempotent: Si repetir la request es seguro (default: según el método;
+                POST no lo es salvo que el llamador lo indique)
             
         Returns:
-            dict or requests.Response: Para GET devuelve dict, para POST devuelve dict o Response
+            dict: Respuesta JSON de SAP (o un resumen si SAP no devuelve cuerpo)
             
         Raises:
             ValueError: Si no hay sesión válida
-            requests.RequestException: Si hay error en la request
+            DeadlineExceeded: Si se agotó el plazo de la llamada
+            httpx.HTTPError: Si hay error en la request
         """
+        if idempotent is None:
+            idempotent = method.upper() in IDEMPOTENT_METHODS
+        check_deadline()
+        
         # Verificar sesión válida
-        if not self.is_session_valid():
+        if not await self.ensure_session():
             raise ValueError("No hay sesión válida. Ejecutar login() primero.")
         
         # Construir URL completa
@@ -267,23 +454,34 @@ class SAPClient:
             'Content-Type': 'application/json',
             'Accept': 'application/json'
         }
+        if extra_headers:
+            headers.update(extra_headers)
         
         try:
-            logger.info(f"SAP Request: {method} {url}")
+            logger.info("SAP Request: %s %s", method, url)
+            
+            session_id = self.session_id
+            response = await self._send_with_retries(method, url, data, params, json_data, headers, content,
+                                                     idempotent)
+            
+            # El timeout local puede desfasarse del de SAP: ante un 401 se
+            # re-autentica una sola vez y se repite la request
+            if response.status_code == 401:
+                logger.info("SAP respondió 401, re-autenticando y repitiendo la request")
+                if await self.relogin(stale_session_id=session_id):
+                    response = await self._send_with_retries(method, url, data, params, json_data, headers,
+                                                             content, idempotent)
+            
+            response.raise_for_status()
+            self._touch()
+            
+            if raw_response:
+                return response
             
             if method.upper() == "GET":
-                response = self.session.get(url, params=params, headers=headers)
-                response.raise_for_status()
                 return response.json()
                 
             elif method.upper() == "POST":
-                if json_data:
-                    response = self.session.post(url, json=json_data, headers=headers)
-                else:
-                    response = self.session.post(url, data=data, params=params, headers=headers)
-                
-                response.raise_for_status()
-                
                 # SAP puede retornar 204 No Content en algunos casos
                 if response.status_code == 204:
                     return {"status": "created", "message": "Document created successfully"}
@@ -294,14 +492,6 @@ class SAPClient:
                     return {"status": "created", "response": response.text}
                     
             else:
-                # Para otros métodos HTTP
-                if json_data:
-                    response = self.session.request(method, url, json=json_data, headers=headers)
-                else:
-                    response = self.session.request(method, url, data=data, params=params, headers=headers)
-                
-                response.raise_for_status()
-                
                 if response.status_code == 204:
                     return {"status": "success"}
                 
@@ -310,55 +500,192 @@ class SAPClient:
                 except:
                     return {"status": "success", "response": response.text}
                     
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Error en request SAP: {e}")
+        except httpx.HTTPError as e:
+            logger.error("Error en request SAP: %s", e)
             raise
         except Exception as e:
-            logger.error(f"Error inesperado en request: {e}")
+            logger.error("Error inesperado en request: %s", e)
             raise
-    def get_business_partners(self, filter_query: str = "", top: int = 10) -> dict:
+    
+    async def _send_with_retries(self, method: str, url: str, data: dict, params: dict, json_data: dict,
+                                 headers: dict, content: bytes, idempotent: bool) -> httpx.Response:
+        """
+        Enviar la request reintentando fallas transitorias dentro del plazo
+
+        Devuelve la última respuesta (aunque sea 5xx) o propaga el último
+        error de red cuando no corresponde o no alcanza el plazo para
+        otro intento.
         """
-        Obtener Business Partners de SAP
+        policy = self.retry_policy
+        attempt = 1
+        while True:
+            error: Optional[httpx.TransportError] = None
+            try:
+                response = await self._send(method, url, data, params, json_data, headers, content)
+                retry = policy.retry_status(response.status_code, idempotent)
+                reason = str(response.status_code)
+            except httpx.TransportError as e:
+                left = remaining()
+                if left is not None and left <= 0:
+                    raise DeadlineExceeded(f"Se agotó el plazo esperando a SAP: {method} {url}") from e
+                error = e
+                retry = policy.retry_error(e, idempotent)
+                reason = type(e).__name__
+            
+            delay = policy.backoff(attempt)
+            if not retry or attempt >= policy.max_attempts or not policy.fits(delay):
+                if error is not None:
+                    raise error
+                return response
+            
+            logger.warning("Falla transitoria en %s %s (%s), reintento %d en %.2fs",
+                           method, url, reason, attempt, delay)
+            SAP_RETRIES.inc(method.upper(), reason)
+            await asyncio.sleep(delay)
+            attempt += 1
+    
+    def _request_timeout(self) -> Any:
+        """Timeouts de la request acotados al plazo restante de la llamada"""
+        left = remaining()
+        if left is None:
+            return httpx.USE_CLIENT_DEFAULT
+        if left <= 0:
+            raise DeadlineExceeded("Se agotó el plazo de la llamada")
+        
+        def bound(value: Optional[float]) -> float:
+            return left if value is None else min(value, left)
+        
+        return httpx.Timeout(connect=bound(self.timeout.connect), read=bound(self.timeout.read),
+                             write=bound(self.timeout.write), pool=bound(self.timeout.pool))
+    
+    async def _send(self, method: str, url: str, data: dict, params: dict, json_data: dict, headers: dict,
+                    content: bytes = None) -> httpx.Response:
+        """Enviar la request HTTP registrando latencia y status en las métricas"""
+        method = method.upper()
+        endpoint = endpoint_label(url[len(self.base_url):])
+        # Sin plazo no se ocupa lugar en el guard ni se cuenta como fallo de SAP
+        check_deadline()
+        # Falla rápido (ServiceUnavailableError) si SAP está saturado o el circuito abierto
+        probe = await self.guard.acquire() if self.guard is not None else False
+        status = "error"
+        cancelled = False
+        SAP_REQUESTS_IN_FLIGHT.inc()
+        start = time.perf_counter()
+        try:
+            response = await self._send_raw(method, url, data, params, json_data, headers, content)
+            status = str(response.status_code)
+            record_sap_response(response)
+            return response
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            SAP_REQUESTS_IN_FLIGHT.dec()
+            SAP_REQUEST_DURATION.observe(elapsed, method, endpoint)
+            SAP_REQUESTS.inc(method, endpoint, status)
+            if self.guard is not None:
+                # 5xx, 429 y errores de red cuentan como sobrecarga; 4xx no
+                failed = status == "error" or status == "429" or status.startswith("5")
+                await self.guard.release(None if cancelled else elapsed, failed, probe)
+    
+    async def _send_raw(self, method: str, url: str, data: dict, params: dict, json_data: dict, headers: dict,
+                        content: bytes = None) -> httpx.Response:
+        """Enviar la request HTTP sin interpretar la respuesta"""
+        timeout = self._request_timeout()
+        try:
+            # Los timeouts de httpx son por operación (cada lectura del
+            # socket); el plazo de la llamada acota la request completa
+            async with asyncio.timeout(remaining()):
+                if method == "GET":
+                    return await self.session.get(url, params=params, headers=headers, timeout=timeout)
+                
+                if content is not None:
+                    return await self.session.request(method, url, content=content, params=params,
+                                                      headers=headers, timeout=timeout)
+                if json_data:
+                    return await self.session.request(method, url, json=json_data, headers=headers,
+                                                      timeout=timeout)
+                return await self.session.request(method, url, data=data, params=params, headers=headers,
+                                                  timeout=timeout)
+        except TimeoutError as e:
+            raise DeadlineExceeded(f"Se agotó el plazo esperando a SAP: {method} {url}") from e
+    
+    async def ping(self):
+        """
+        Request mínima que confirma que SAP acepta la sesión (sonda /ready)
+        
+        Va directo al Service Layer, sin pasar por la caché de datos maestros.
+        
+        Raises:
+            httpx.HTTPError: Si SAP no responde o rechaza la request
+        """
+        await self.make_request("GET", "/Items", params={"$top": 1, "$select": "ItemCode"})
+    
+    async def get_business_partners(self, filter_query: str = "", top: int = 10,
+                                    select: Optional[List[str]] = None) -> dict:
+        """
+        Obtener Business Partners de SAP (con caché de datos maestros)
         
         Args:
             filter_query: Filtro OData (ej: "CardCode eq 'C20000'")
             top: Número máximo de registros
+            select: Campos a devolver ($select)
             
         Returns:
             dict: Datos de Business Partners
         """
-        endpoint = "/BusinessPartners"
-        
-        params = {}
-        if filter_query:
-            params['$filter'] = filter_query
-        if top:
-            params['$top'] = top
-            
-        return self.make_request("GET", endpoint, params=params)
+        return await self._get_master_data("/BusinessPartners", filter_query, top, select)
     
-    def get_items(self, filter_query: str = None, top: int = None) -> dict:
+    async def get_items(self, filter_query: str = None, top: int = None,
+                        select: Optional[List[str]] = None) -> dict:
         """
-        Obtener Items de SAP
+        Obtener Items de SAP (con caché de datos maestros)
         
         Args:
             filter_query: Filtro OData
             top: Número máximo de registros
+            select: Campos a devolver ($select)
             
         Returns:
             dict: Datos de Items
         """
-        endpoint = "/Items"
+        return await self._get_master_data("/Items", filter_query, top, select)
+    
+    async def _get_master_data(self, endpoint: str, filter_query: Optional[str], top: Optional[int],
+                               select: Optional[List[str]]) -> dict:
+        """GET de datos maestros con lectura a través de la caché, si hay una configurada"""
+        key = master_data_key(endpoint, filter_query, select, top)
+        if self.cache is not None:
+            cached = self.cache.get(key)
+            if cached is not MISSING:
+                return cached
         
         params = {}
         if filter_query:
             params['$filter'] = filter_query
+        if select:
+            params['$select'] = ",".join(select)
         if top:
             params['$top'] = top
             
-        return self.make_request("GET", endpoint, params=params)
+        result = await self.make_request("GET", endpoint, params=params)
+        
+        if self.cache is not None:
+            self.cache.set(key, result)
+        return result
+    
+    def invalidate_master_data(self):
+        """
+        Invalidar Items y BusinessPartners en caché tras una escritura
+        
+        Una Sales Order cambia stock comprometido y saldos del cliente.
+        """
+        if self.cache is not None:
+            self.cache.invalidate("/Items")
+            self.cache.invalidate("/BusinessPartners")
     
-    def get_sales_orders(self, filter_query: str = None, top: int = None) -> dict:
+    async def get_sales_orders(self, filter_query: str = None, top: int = None) -> dict:
         """
         Obtener Sales Orders de SAP
         
@@ -377,14 +704,219 @@ class SAPClient:
         if top:
             params['$top'] = top
             
-        return self.make_request("GET", endpoint, params=params)
+        return await self.make_request("GET", endpoint, params=params)
 
-    def __del__(self):
-     
-        if self.session_id:
-            self.logout()
+    async def get_order_detail(self, doc_entry: int) -> Optional[dict]:
+        """
+        Sales Order con los datos de su cliente y de cada artículo de sus líneas
+        
+        En lugar de un GET por línea, los datos maestros que no están en caché
+        se piden juntos: el Business Partner por clave y los Items en
+        consultas $filter=ItemCode eq ... or ... de LOOKUP_CHUNK_SIZE códigos,
+        todas en un solo $batch. El costo es de dos round trips (uno con todo
+        en caché), sin importar la cantidad de líneas.
+        
+        Args:
+            doc_entry: DocEntry de la orden
+            
+        Returns:
+            dict: La orden con BusinessPartner y, en cada línea, Item (None
+                si SAP no los encuentra); None si la orden no existe
+        """
+        try:
+            order = await self.make_request("GET", f"/Orders({int(doc_entry)})",
+                                            params={"$select": ",".join(ORDER_DETAIL_FIELDS)})
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code == 404:
+                return None
+            raise
+        
+        lines = order.get("DocumentLines") or []
+        card_code = order.get("CardCode")
+        item_codes = list(dict.fromkeys(line["ItemCode"] for line in lines if line.get("ItemCode")))
+        
+        partners, items = await self.lookup_master_data([card_code] if card_code else [], item_codes)
+        order["BusinessPartner"] = partners.get(card_code)
+        for line in lines:
+            line["Item"] = items.get(line.get("ItemCode"))
+        return order
+    
+    async def lookup_master_data(self, card_codes: List[str], item_codes: List[str],
+                                 partner_select: Optional[List[str]] = None,
+                                 item_select: Optional[List[str]] = None) -> Tuple[Dict[str, dict], Dict[str, dict]]:
+        """
+        Business Partners e Items por código: de la caché o, los que falten,
+        con consultas por lotes de códigos en un solo $batch
+        
+        Cada registro traído se guarda en caché con la misma clave que una
+        consulta "<campo> eq '<código>'" con ese $select.
+        
+        Returns:
+            tuple: (CardCode -> Business Partner, ItemCode -> Item); los
+                códigos que SAP no encuentra no aparecen
+        """
+        lookups = [("/BusinessPartners", "CardCode", card_codes, partner_select or DETAIL_PARTNER_FIELDS, {}),
+                   ("/Items", "ItemCode", item_codes, item_select or DETAIL_ITEM_FIELDS, {})]
+        
+        queries = []
+        for entity, field, codes, select, found in lookups:
+            missing = []
+            for code in dict.fromkeys(codes):
+                cached = self.cache.get(_lookup_key(entity, field, code, select)) if self.cache is not None else MISSING
+                if cached is MISSING:
+                    missing.append(code)
+                elif cached.get("value"):
+                    found[code] = cached["value"][0]
+            for i in range(0, len(missing), LOOKUP_CHUNK_SIZE):
+                chunk = missing[i:i + LOOKUP_CHUNK_SIZE]
+                params = {"$select": ",".join(select),
+                          "$filter": " or ".join(f"{field} eq '{_odata_literal(code)}'" for code in chunk)}
+                queries.append((entity, field, chunk, select, found, params))
+        
+        if len(queries) == 1:
+            entity, *_, params = queries[0]
+            bodies = [await self.make_request("GET", entity, params=params)]
+        elif queries:
+            endpoints = [f"{entity}?" + urlencode(params, safe="$',()", quote_via=quote)
+                         for entity, *_, params in queries]
+            responses = await self.execute_batch([[{"method": "GET", "endpoint": endpoint}]
+                                                  for endpoint in endpoints])
+            bodies = []
+            for endpoint, (response,) in zip(endpoints, responses):
+                _raise_for_batch_status(response, "GET", f"{self.base_url}{endpoint}",
+                                        "Error en consulta de datos maestros")
+                bodies.append(response["body"])
+        else:
+            bodies = []
+        
+        for (entity, field, chunk, select, found, _), body in zip(queries, bodies):
+            for row in (body or {}).get("value", []):
+                found[row.get(field)] = row
+            if self.cache is not None:
+                for code in chunk:
+                    self.cache.set(_lookup_key(entity, field, code, select),
+                                   {"value": [found[code]] if code in found else []})
+        
+        return lookups[0][4], lookups[1][4]
+    
+    async def iter_pages(self, endpoint: str, filter_query: str = None, select: Optional[List[str]] = None,
+                         orderby: str = None, top: int = None, page_size: int = None,
+                         apply: str = None) -> AsyncIterator[List[dict]]:
+        """
+        Recorrer una colección OData página por página siguiendo odata.nextLink
+        
+        Solo se mantiene en memoria la página actual. El tamaño de página se
+        negocia con el header Prefer: odata.maxpagesize.
+        
+        Args:
+            endpoint: Colección (ej: '/Items')
+            filter_query: Filtro OData
+            select: Campos a devolver ($select)
+            orderby: Orden OData ($orderby, ej: "ItemCode asc")
+            top: Número máximo de registros en total (None = todos)
+            page_size: Registros por página (default SAP_PAGE_SIZE o 100)
+            apply: Transformaciones OData ($apply, ej: agrupación y sumas en SAP)
+            
+        Yields:
+            list: Registros de cada página
+        """
+        page_size = page_size or env_int('SAP_PAGE_SIZE', 100)
+        if top:
+            page_size = min(page_size, top)
+        
+        params = odata_params(filter_query, select, orderby, top, apply)
+        left = top
+        next_endpoint: Optional[str] = endpoint
+        
+        while next_endpoint:
+            rows, next_endpoint = await self.get_page(next_endpoint, params, page_size)
+            
+            if left is not None:
+                rows = rows[:left]
+                left -= len(rows)
+            
+            if rows:
+                yield rows
+            
+            if left is not None and left <= 0:
+                break
+            
+            # El nextLink ya incluye los parámetros de la consulta
+            params = None
+    
+    async def get_page(self, endpoint: str, params: Optional[dict] = None,
+                       page_size: int = None) -> Tuple[List[dict], Optional[str]]:
+        """
+        Pedir una página de una colección OData
+        
+        Args:
+            endpoint: Colección o endpoint de la página siguiente
+            params: Parámetros de la consulta (ver odata_params); None en las páginas siguientes
+            page_size: Registros por página (default SAP_PAGE_SIZE o 100)
+            
+        Returns:
+            tuple: (registros, endpoint de la página siguiente o None)
+        """
+        page_size = page_size or env_int('SAP_PAGE_SIZE', 100)
+        data = await self.make_request("GET", endpoint, params=params or None,
+                                       extra_headers={'Prefer': f'odata.maxpagesize={page_size}'})
+        next_link = data.get('odata.nextLink') or data.get('@odata.nextLink')
+        return data.get('value', []), self._next_link_endpoint(next_link) if next_link else None
+    
+    async def iter_rows(self, endpoint: str, **kwargs) -> AsyncIterator[dict]:
+        """Recorrer una colección OData registro por registro (ver iter_pages)"""
+        async for page in self.iter_pages(endpoint, **kwargs):
+            for row in page:
+                yield row
+    
+    def iter_items(self, **kwargs) -> AsyncIterator[dict]:
+        """Recorrer todos los Items paginando (acepta los argumentos de iter_pages)"""
+        return self.iter_rows("/Items", **kwargs)
+    
+    def iter_business_partners(self, **kwargs) -> AsyncIterator[dict]:
+        """Recorrer todos los Business Partners paginando (acepta los argumentos de iter_pages)"""
+        return self.iter_rows("/BusinessPartners", **kwargs)
+    
+    def iter_sales_orders(self, **kwargs) -> AsyncIterator[dict]:
+        """Recorrer todas las Sales Orders paginando (acepta los argumentos de iter_pages)"""
+        return self.iter_rows("/Orders", **kwargs)
+    
+    def _next_link_endpoint(self, next_link: str) -> str:
+        """
+        Convertir un odata.nextLink en endpoint relativo a base_url
+        
+        SAP devuelve enlaces relativos a la raíz del servicio (ej: "Items?$skip=20"),
+        pero se aceptan también rutas absolutas o URLs completas.
+        """
+        base_path = urlsplit(self.base_url).path.rstrip('/')
+        if next_link.startswith(('http://', 'https://')):
+            parts = urlsplit(next_link)
+            next_link = parts.path + (f"?{parts.query}" if parts.query else "")
+        if base_path and next_link.startswith(base_path + '/'):
+            return next_link[len(base_path):]
+        return '/' + next_link.lstrip('/')
 
-    def create_sales_order(self, order_data: dict) -> dict:
+    async def aclose(self, logout: bool = True):
+        """
+        Cerrar la sesión SAP y el pool de conexiones HTTP
+
+        Reemplaza la limpieza en __del__: un logout asíncrono no puede
+        ejecutarse desde el destructor, así que el servidor lo invoca al apagar.
+
+        Args:
+            logout: False deja la sesión abierta en SAP (la sigue usando otro worker)
+        """
+        if logout and self.session_id:
+            await self.logout()
+        await self.session.aclose()
+
+    async def __aenter__(self) -> "SAPClient":
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.aclose()
+
+    async def create_sales_order(self, order_data: dict) -> dict:
         """
         Crear una Sales Order en SAP Business One
         
@@ -411,44 +943,378 @@ class SAPClient:
         Raises:
             Exception: Si hay error en la creación
         """
-        if not self.is_session_valid():
-            raise Exception("Sesión SAP no válida. Debe hacer login primero.")
+        if not await self.ensure_session():
+            raise ValueError("Sesión SAP no válida. Debe hacer login primero.")
         
         endpoint = "/Orders"
         
         try:
-            logger.info(f"Creando Sales Order para CardCode: {order_data.get('CardCode')}")
-            logger.info(f"Líneas de documento: {len(order_data.get('DocumentLines', []))}")
+            logger.info("Creando Sales Order para CardCode: %s (%s líneas)",
+                        order_data.get('CardCode'), len(order_data.get('DocumentLines', [])))
             
-            # Validar datos requeridos
-            required_fields = ['CardCode', 'DocumentLines']
-            for field in required_fields:
-                if field not in order_data:
-                    raise ValueError(f"Campo requerido faltante: {field}")
-            
-            if not order_data['DocumentLines']:
-                raise ValueError("DocumentLines no puede estar vacío")
-            
-            # Validar líneas de documento
-            for i, line in enumerate(order_data['DocumentLines']):
-                required_line_fields = ['ItemCode', 'Quantity']
-                for field in required_line_fields:
-                    if field not in line:
-                        raise ValueError(f"Campo requerido en línea {i+1}: {field}")
+            validate_sales_order(order_data)
             
             # Realizar POST request
-            response = self.make_request("POST", endpoint, json_data=order_data)
+            response = await self.make_request("POST", endpoint, json_data=order_data)
             
             if isinstance(response, dict):
-                logger.info(f"Sales Order creada exitosamente. DocEntry: {response.get('DocEntry', 'N/A')}")
+                logger.info("Sales Order creada exitosamente. DocEntry: %s", response.get('DocEntry', 'N/A'))
+                self.invalidate_master_data()
                 return response
             else:
                 raise Exception("Respuesta inesperada de SAP")
                 
         except Exception as e:
-            logger.error(f"Error creando Sales Order: {e}")
+            logger.error("Error creando Sales Order: %s", e)
             raise
 
+    async def create_sales_orders_bulk(self, orders: List[dict], batch_size: int = None,
+                                       atomic: bool = False,
+                                       on_progress: Optional[Callable[[int, int], Awaitable[None]]] = None
+                                       ) -> List[dict]:
+        """
+        Crear varias Sales Orders empaquetándolas en requests $batch
+        
+        Cada orden se valida igual que en create_sales_order; las inválidas
+        no se envían a SAP.
+        
+        Args:
+            orders: Lista de órdenes con la estructura de create_sales_order
+            batch_size: Órdenes por request $batch (default SAP_BATCH_SIZE o 50)
+            atomic: Si True, cada request $batch es un único change-set
+                (todo o nada); si False, cada orden se confirma por separado
+            on_progress: Corrutina opcional llamada tras cada lote con
+                (órdenes procesadas, órdenes válidas)
+            
+        Returns:
+            list: Un resultado por orden, en el mismo orden de entrada:
+                {"index", "status": "success", "DocEntry", "DocNum"},
+                {"index", "status": "error", "error"} si SAP no la creó, o
+                {"index", "status": "unknown", "error"} si el $batch se cortó
+                después de enviarse (SAP pudo haberla creado: verificar antes
+                de reintentar)
+        
+        Raises:
+            ServiceUnavailableError: Si SAP rechaza el primer lote antes de
+                enviarlo (circuito abierto o saturado); en lotes posteriores
+                las órdenes no enviadas se informan como error
+        """
+        batch_size = batch_size or env_int('SAP_BATCH_SIZE', 50)
+        if batch_size < 1:
+            raise ValueError("batch_size debe ser al menos 1")
+        
+        results: List[Optional[dict]] = [None] * len(orders)
+        valid: List[int] = []
+        
+        for index, order in enumerate(orders):
+            try:
+                validate_sales_order(order)
+                valid.append(index)
+            except ValueError as e:
+                results[index] = {"index": index, "status": "error", "error": str(e)}
+        
+        logger.info("Creando %d Sales Orders en lotes de %d (atómico: %s)", len(valid), batch_size, atomic)
+        
+        for start in range(0, len(valid), batch_size):
+            chunk = valid[start:start + batch_size]
+            operations = [{"method": "POST", "endpoint": "/Orders", "body": orders[i]} for i in chunk]
+            changesets = [operations] if atomic else [[op] for op in operations]
+            
+            try:
+                responses = [r for changeset in await self.execute_batch(changesets) for r in changeset]
+            except ServiceUnavailableError as e:
+                if start == 0:
+                    raise
+                # Los lotes anteriores ya se enviaron: no se pierde su resultado
+                logger.warning("$batch de Sales Orders rechazado antes de enviarse: %s", e)
+                for i in valid[start:]:
+                    results[i] = {"index": i, "status": "error",
+                                  "error": f"No se envió a SAP ({e}); se puede reintentar"}
+                break
+            except Exception as e:
+                if _reached_sap(e):
+                    # SAP pudo haber confirmado el change-set antes del corte
+                    logger.error("$batch de Sales Orders cortado después de enviarse: %s", e)
+                    for i in chunk:
+                        results[i] = {"index": i, "status": "unknown",
+                                      "error": f"Resultado desconocido ({e}); verificar en SAP si se creó "
+                                               f"antes de reintentar"}
+                else:
+                    logger.error("Error en $batch de Sales Orders: %s", e)
+                    for i in chunk:
+                        results[i] = {"index": i, "status": "error", "error": str(e)}
+            else:
+                for i, response in zip(chunk, responses):
+                    body = response["body"]
+                    if 200 <= response["status"] < 300 and isinstance(body, dict):
+                        results[i] = {
+                            "index": i,
+                            "status": "success",
+                            "DocEntry": body.get("DocEntry"),
+                            "DocNum": body.get("DocNum")
+                        }
+                    else:
+                        results[i] = {"index": i, "status": "error", "error": _sap_error_message(response)}
+            
+            if on_progress is not None:
+                await on_progress(min(start + batch_size, len(valid)), len(valid))
+        
+        created = sum(1 for r in results if r["status"] == "success")
+        logger.info("Sales Orders creadas: %d/%d", created, len(orders))
+        if created:
+            self.invalidate_master_data()
+        return results
+
+    async def execute_batch(self, changesets: List[List[dict]]) -> List[List[dict]]:
+        """
+        Ejecutar varias operaciones en una sola request OData $batch
+        
+        Args:
+            changesets: Grupos de operaciones {"method", "endpoint", "body"}.
+                Las escrituras de un grupo forman un change-set atómico; un
+                grupo con un único GET se envía fuera de change-set.
+            
+        Returns:
+            list: Por cada grupo, una respuesta {"status", "body"} por
+                operación. Si SAP rechaza un change-set completo, todas sus
+                operaciones reciben esa misma respuesta de error.
+        """
+        boundary = f"batch_{uuid.uuid4()}"
+        base_path = urlsplit(self.base_url).path.rstrip('/')
+        lines: List[str] = []
+        
+        for group in changesets:
+            if len(group) == 1 and group[0]["method"].upper() == "GET":
+                lines.append(f"--{boundary}")
+                lines.extend(_batch_operation(group[0], base_path))
+                continue
+            
+            changeset = f"changeset_{uuid.uuid4()}"
+            lines.append(f"--{boundary}")
+            lines.append(f"Content-Type: multipart/mixed;boundary={changeset}")
+            lines.append("")
+            for content_id, operation in enumerate(group, start=1):
+                lines.append(f"--{changeset}")
+                lines.extend(_batch_operation(operation, base_path, content_id))
+            lines.append(f"--{changeset}--")
+        lines.append(f"--{boundary}--")
+        lines.append("")
+        
+        response = await self.make_request(
+            "POST", "/$batch",
+            content="\r\n".join(lines).encode("utf-8"),
+            extra_headers={'Content-Type': f'multipart/mixed;boundary={boundary}'},
+            raw_response=True,
+            # Un $batch solo de lecturas se puede repetir como cualquier GET
+            idempotent=all(op["method"].upper() == "GET" for group in changesets for op in group)
+        )
+        
+        parts = _parse_multipart(response.headers.get('Content-Type', ''), response.text)
+        if len(parts) != len(changesets):
+            raise Exception(f"Respuesta $batch inesperada: {len(parts)} partes para {len(changesets)} grupos")
+        
+        results = []
+        for group, part in zip(changesets, parts):
+            # Un change-set rechazado vuelve como una sola respuesta
+            if isinstance(part, dict):
+                results.append([part] * len(group))
+            else:
+                results.append(part)
+        return results
+
+
+def validate_sales_order(order_data: dict):
+    """
+    Validar campos requeridos de una Sales Order antes de enviarla a SAP
+    
+    Quantity y UnitPrice llegan como texto desde el schema de la herramienta,
+    así que también se verifica que sean numéricos.
+    
+    Raises:
+        ValueError: Si falta un campo requerido o un valor no es válido
+    """
+    required_fields = ['CardCode', 'DocumentLines']
+    for field in required_fields:
+        if field not in order_data:
+            raise ValueError(f"Campo requerido faltante: {field}")
+    
+    if not order_data['DocumentLines']:
+        raise ValueError("DocumentLines no puede estar vacío")
+    
+    # Validar líneas de documento
+    for i, line in enumerate(order_data['DocumentLines']):
+        required_line_fields = ['ItemCode', 'Quantity']
+        for field in required_line_fields:
+            if field not in line:
+                raise ValueError(f"Campo requerido en línea {i+1}: {field}")
+        
+        quantity = _parse_number(line['Quantity'])
+        if quantity is None or quantity <= 0:
+            raise ValueError(f"Quantity en línea {i+1} debe ser un número mayor que cero: {line['Quantity']!r}")
+        
+        if line.get('UnitPrice') is not None:
+            price = _parse_number(line['UnitPrice'])
+            if price is None or price < 0:
+                raise ValueError(f"UnitPrice en línea {i+1} debe ser un número no negativo: {line['UnitPrice']!r}")
+
+
+def _parse_number(value: Any) -> Optional[float]:
+    """Convertir a float un número o texto numérico; None si no es válido"""
+    if isinstance(value, bool):
+        return None
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    return number if math.isfinite(number) else None
+
+
+def _odata_literal(value: str) -> str:
+    """Escapar un texto para un literal OData entre comillas simples"""
+    return str(value).replace("'", "''")
+
+
+def _lookup_key(entity: str, field: str, code: str, select: List[str]) -> Tuple:
+    return master_data_key(entity, f"{field} eq '{_odata_literal(code)}'", select)
+
+
+def _batch_operation(operation: dict, base_path: str, content_id: Optional[int] = None) -> List[str]:
+    """Líneas MIME de una operación dentro de un $batch"""
+    lines = ["Content-Type: application/http", "Content-Transfer-Encoding: binary"]
+    if content_id is not None:
+        lines.append(f"Content-ID: {content_id}")
+    lines.append("")
+    lines.append(f"{operation['method'].upper()} {base_path}{operation['endpoint']}")
+    
+    body = operation.get("body")
+    if body is not None:
+        lines.append("Content-Type: application/json")
+        lines.append("")
+        lines.append(json.dumps(body, ensure_ascii=False))
+    lines.append("")
+    return lines
+
+
+def _parse_multipart(content_type: str, text: str) -> List[Any]:
+    """
+    Interpretar una respuesta multipart/mixed de $batch
+    
+    Returns:
+        list: Por cada parte, una respuesta {"status", "body"} o, si la parte
+            es un change-set, la lista de sus respuestas
+    """
+    match = re.search(r'boundary="?([^";]+)"?', content_type)
+    if not match:
+        raise Exception(f"Respuesta $batch sin boundary: {content_type}")
+    
+    delimiter = f"--{match.group(1)}"
+    text = text.replace("\r\n", "\n")
+    parts = []
+    
+    for raw in text.split(delimiter)[1:]:
+        if raw.startswith("--"):
+            break
+        head, _, body = raw.lstrip("\n").partition("\n\n")
+        headers = _parse_headers(head)
+        part_type = headers.get("content-type", "")
+        
+        if part_type.startswith("multipart/mixed"):
+            parts.append(_parse_multipart(part_type, body))
+        else:
+            parts.append(_parse_http_response(body))
+    
+    return parts
+
+
+def _parse_headers(head: str) -> Dict[str, str]:
+    headers = {}
+    for line in head.split("\n"):
+        name, sep, value = line.partition(":")
+        if sep:
+            headers[name.strip().lower()] = value.strip()
+    return headers
+
+
+def _parse_http_response(text: str) -> dict:
+    """Interpretar una respuesta HTTP embebida (línea de estado, headers y cuerpo)"""
+    status_line, _, rest = text.lstrip("\n").partition("\n")
+    _, _, body = rest.partition("\n\n")
+    
+    try:
+        status = int(status_line.split()[1])
+    except (IndexError, ValueError):
+        raise Exception(f"Línea de estado inválida en $batch: {status_line!r}")
+    
+    body = body.strip()
+    try:
+        parsed = json.loads(body) if body else None
+    except ValueError:
+        parsed = body
+    return {"status": status, "body": parsed}
+
+
+def odata_params(filter_query: str = None, select: Optional[List[str]] = None, orderby: str = None,
+                 top: int = None, apply: str = None) -> dict:
+    """Parámetros de query string de una consulta OData ($filter, $select, $orderby, $top, $apply)"""
+    params = {}
+    if filter_query:
+        params['$filter'] = filter_query
+    if select:
+        params['$select'] = ",".join(select)
+    if orderby:
+        params['$orderby'] = orderby
+    if top:
+        params['$top'] = top
+    if apply:
+        params['$apply'] = apply
+    return params
+
+
+def _reached_sap(error: BaseException) -> bool:
+    """
+    Si una request no idempotente que falló pudo haber llegado a SAP
+
+    Un error de conexión, la falta de sesión o un plazo agotado antes de
+    enviar son seguros de reintentar; un timeout de lectura, una conexión
+    cortada o un 5xx después de enviar no (SAP pudo haberla confirmado).
+    Un 4xx es un rechazo explícito.
+    """
+    if isinstance(error, DeadlineExceeded):
+        # Sin causa, el plazo se agotó en check_deadline antes de enviar
+        return error.__cause__ is not None and _reached_sap(error.__cause__)
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500
+    # Solo ValueError exacto (sin sesión): un JSONDecodeError es una respuesta ya recibida
+    if type(error) is ValueError or isinstance(error, (ConnectionError,) + _NOT_SENT_ERRORS):
+        return False
+    return True
+
+
+def _sap_error_message(response: dict) -> str:
+    """Extraer el mensaje de error de una respuesta de SAP"""
+    body = response.get("body")
+    if isinstance(body, dict) and "error" in body:
+        message = body["error"].get("message", {})
+        if isinstance(message, dict):
+            message = message.get("value")
+        return f"{body['error'].get('code', response['status'])}: {message}"
+    return f"HTTP {response['status']}: {body}"
+
+
+def _raise_for_batch_status(response: dict, method: str, url: str, context: str):
+    """
+    Lanzar httpx.HTTPStatusError si una operación de un $batch falló, igual
+    que raise_for_status con una request individual
+    """
+    if response["status"] < 400:
+        return
+    request = httpx.Request(method, url)
+    body = response.get("body")
+    content = body if isinstance(body, str) else json.dumps(body, ensure_ascii=False)
+    raise httpx.HTTPStatusError(f"{context}: {_sap_error_message(response)}", request=request,
+                                response=httpx.Response(response["status"], request=request,
+                                                        content=(content or "").encode()))
+
 
 # Función auxiliar para crear cliente SAP desde variables de entorno
 def create_sap_client_from_env() -> SAPClient:
@@ -0,0 +1,236 @@
+"""
+Protección del Service Layer: límite de concurrencia adaptativo y circuit breaker
+
+Cuando SAP se degrada, seguir enviándole requests solo alarga la cola y la
+latencia. SAPGuard se ubica delante de cada request saliente:
+
+- Límite de concurrencia AIMD: crece en +1/limit por request rápida y
+  exitosa mientras el límite está en uso, y se multiplica por un factor
+  de retroceso ante un 5xx, un error de red o una latencia muy por encima
+  de la línea base. Las requests que superan el límite esperan un tiempo
+  acotado y luego fallan rápido.
+- Circuit breaker: si la fracción de fallos en la ventana reciente supera
+  el umbral, se abre y rechaza de inmediato durante un tiempo; luego deja
+  pasar una request de prueba (half-open) que lo cierra o lo vuelve a abrir.
+
+Los rechazos son ServiceUnavailableError, con el tiempo sugerido de
+reintento, para que /mcp responda un error JSON-RPC reintentable.
+"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Callable, Optional
+
+from config import env_int, env_float
+from deadlines import check_deadline, remaining as deadline_remaining
+from metrics import SAP_CIRCUIT_STATE, SAP_CONCURRENCY_LIMIT, SAP_REJECTED
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class ServiceUnavailableError(Exception):
+    """SAP no acepta requests por ahora (circuito abierto o saturado); reintentar luego"""
+
+    def __init__(self, message: str, retry_after: float, reason: str):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class SAPGuard:
+    """
+    Límite de concurrencia AIMD + circuit breaker compartidos por las sesiones de un pool
+
+    Variables de entorno:
+        SAP_LIMIT_INITIAL: Requests concurrentes iniciales hacia SAP (default 8)
+        SAP_LIMIT_MIN: Límite mínimo (default 1)
+        SAP_LIMIT_MAX: Límite máximo (default 64)
+        SAP_LIMIT_BACKOFF: Factor de reducción ante sobrecarga (default 0.7)
+        SAP_LIMIT_LATENCY_TOLERANCE: Latencia relativa a la línea base que cuenta como sobrecarga (default 3.0)
+        SAP_LIMIT_QUEUE_TIMEOUT: Segundos máximos de espera por un lugar antes de fallar (default 5)
+        SAP_BREAKER_WINDOW: Resultados recientes considerados (default 20)
+        SAP_BREAKER_MIN_CALLS: Resultados mínimos en la ventana para abrir (default 10)
+        SAP_BREAKER_FAILURE_RATIO: Fracción de fallos que abre el circuito (default 0.5)
+        SAP_BREAKER_OPEN_SECONDS: Segundos abierto antes de probar (default 30)
+    """
+
+    def __init__(self, initial_limit: Optional[float] = None, min_limit: Optional[float] = None,
+                 max_limit: Optional[float] = None, backoff: Optional[float] = None,
+                 latency_tolerance: Optional[float] = None, queue_timeout: Optional[float] = None,
+                 window: Optional[int] = None, min_calls: Optional[int] = None,
+                 failure_ratio: Optional[float] = None, open_seconds: Optional[float] = None,
+                 clock: Callable[[], float] = time.monotonic):
+        self.min_limit = min_limit if min_limit is not None else env_float('SAP_LIMIT_MIN', 1.0)
+        self.max_limit = max_limit if max_limit is not None else env_float('SAP_LIMIT_MAX', 64.0)
+        self.limit = initial_limit if initial_limit is not None else env_float('SAP_LIMIT_INITIAL', 8.0)
+        self.limit = min(max(self.limit, self.min_limit), self.max_limit)
+        self.backoff = backoff if backoff is not None else env_float('SAP_LIMIT_BACKOFF', 0.7)
+        self.latency_tolerance = (latency_tolerance if latency_tolerance is not None
+                                  else env_float('SAP_LIMIT_LATENCY_TOLERANCE', 3.0))
+        self.queue_timeout = queue_timeout if queue_timeout is not None else env_float('SAP_LIMIT_QUEUE_TIMEOUT', 5.0)
+
+        self.min_calls = min_calls if min_calls is not None else env_int('SAP_BREAKER_MIN_CALLS', 10)
+        self.failure_ratio = failure_ratio if failure_ratio is not None else env_float('SAP_BREAKER_FAILURE_RATIO', 0.5)
+        self.open_seconds = open_seconds if open_seconds is not None else env_float('SAP_BREAKER_OPEN_SECONDS', 30.0)
+        self._outcomes: deque = deque(maxlen=window if window is not None else env_int('SAP_BREAKER_WINDOW', 20))
+        self._clock = clock
+
+        self.in_flight = 0
+        self.state = CLOSED
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        # Latencia típica sin carga (EWMA lenta de las requests exitosas)
+        self._baseline: Optional[float] = None
+        # Un solo retroceso por ventana de latencia, no uno por cada request en vuelo
+        self._last_backoff = 0.0
+        self._cond = asyncio.Condition()
+
+        self.rejected = 0
+        SAP_CONCURRENCY_LIMIT.set(round(self.limit, 2))
+        SAP_CIRCUIT_STATE.set(_STATE_VALUES[self.state])
+
+    # --- Circuit breaker -------------------------------------------------
+
+    def check(self):
+        """
+        Fallar rápido si el circuito está abierto
+
+        Raises:
+            ServiceUnavailableError: Con el tiempo restante hasta la prueba
+        """
+        if self.state == OPEN:
+            remaining = self._opened_at + self.open_seconds - self._clock()
+            if remaining > 0:
+                self._reject("circuit_open")
+                raise ServiceUnavailableError("SAP no disponible temporalmente (circuito abierto)",
+                                              retry_after=remaining, reason="circuit_open")
+            self._set_state(HALF_OPEN)
+
+        if self.state == HALF_OPEN and self._probe_in_flight:
+            self._reject("circuit_open")
+            raise ServiceUnavailableError("SAP no disponible temporalmente (verificando recuperación)",
+                                          retry_after=1.0, reason="circuit_open")
+
+    def _set_state(self, state: str):
+        if state != self.state:
+            logger.warning("Circuit breaker SAP: %s -> %s", self.state, state)
+            self.state = state
+            SAP_CIRCUIT_STATE.set(_STATE_VALUES[state])
+
+    def _open(self):
+        self._opened_at = self._clock()
+        self._outcomes.clear()
+        self._set_state(OPEN)
+
+    def _reject(self, reason: str):
+        self.rejected += 1
+        SAP_REJECTED.inc(reason)
+
+    # --- Límite de concurrencia --------------------------------------------
+
+    async def acquire(self) -> bool:
+        """
+        Reservar un lugar para una request a SAP
+
+        Returns:
+            bool: True si la request es la prueba half-open del circuito
+
+        Raises:
+            ServiceUnavailableError: Circuito abierto o sin lugar dentro de queue_timeout
+            DeadlineExceeded: Si el plazo de la llamada venció esperando lugar
+        """
+        self.check()
+        probe = self.state == HALF_OPEN
+        if probe:
+            self._probe_in_flight = True
+            self.in_flight += 1
+            return True
+
+        if self.in_flight >= int(self.limit):
+            # Nunca se espera más que el plazo restante de la llamada
+            budget = deadline_remaining()
+            wait = self.queue_timeout if budget is None else max(0.0, min(self.queue_timeout, budget))
+            try:
+                async with self._cond:
+                    await asyncio.wait_for(
+                        self._cond.wait_for(lambda: self.in_flight < int(self.limit) or self.state != CLOSED),
+                        wait
+                    )
+            except asyncio.TimeoutError:
+                check_deadline()
+                self._reject("overloaded")
+                raise ServiceUnavailableError("SAP saturado: límite de concurrencia alcanzado",
+                                              retry_after=self.queue_timeout, reason="overloaded")
+            # El circuito pudo abrirse mientras se esperaba
+            self.check()
+
+        self.in_flight += 1
+        return False
+
+    async def release(self, latency: Optional[float], failed: bool, probe: bool = False):
+        """
+        Liberar el lugar y registrar el resultado
+
+        latency None indica una request cancelada: no cuenta como éxito ni
+        como fallo.
+        """
+        self.in_flight -= 1
+        if probe:
+            self._probe_in_flight = False
+        if latency is not None:
+            self.record(latency, failed, probe)
+        async with self._cond:
+            self._cond.notify_all()
+
+    def record(self, latency: float, failed: bool, probe: bool = False):
+        """Registrar el resultado de una request (también logins, que no ocupan lugar)"""
+        if probe:
+            if failed:
+                self._open()
+            else:
+                self._outcomes.clear()
+                self._set_state(CLOSED)
+            return
+
+        if self.state == HALF_OPEN and failed:
+            self._open()
+            return
+
+        self._outcomes.append(failed)
+        failures = sum(self._outcomes)
+        if (self.state == CLOSED and len(self._outcomes) >= self.min_calls
+                and failures / len(self._outcomes) >= self.failure_ratio):
+            self._open()
+
+        now = self._clock()
+        slow = self._baseline is not None and latency > self._baseline * self.latency_tolerance
+        if failed or slow:
+            # Retroceso multiplicativo, como mucho una vez por latencia típica
+            if now - self._last_backoff >= (self._baseline or 0.0):
+                self.limit = max(self.min_limit, self.limit * self.backoff)
+                self._last_backoff = now
+        else:
+            self._baseline = latency if self._baseline is None else self._baseline * 0.95 + latency * 0.05
+            # Aumento aditivo solo si el límite está realmente en uso
+            if self.in_flight + 1 >= int(self.limit):
+                self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+        SAP_CONCURRENCY_LIMIT.set(round(self.limit, 2))
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "limit": round(self.limit, 2),
+            "in_flight": self.in_flight,
+            "baseline_latency": round(self._baseline, 4) if self._baseline is not None else None,
+            "recent_failures": sum(self._outcomes),
+            "recent_calls": len(self._outcomes),
+            "rejected": self.rejected
+        }
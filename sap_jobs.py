@@ -0,0 +1,445 @@
+"""
+Cola durable de trabajos de escritura en SAP
+
+Una importación grande de Sales Orders puede tardar más que el timeout HTTP
+del agente. En modo trabajo la herramienta solo encola los documentos en un
+archivo SQLite local y devuelve un job_id; un conjunto de workers (tareas
+asyncio) los envía a SAP con concurrencia acotada y registra el resultado
+de cada documento, que se consulta con sap_job_status.
+
+Estados de un documento:
+- pending: en cola, todavía no se envió a SAP.
+- sending: un worker lo está enviando.
+- success / error: resultado final (DocEntry/DocNum o el mensaje de error).
+- unknown: el proceso que lo enviaba terminó a mitad del envío. SAP pudo
+  haberlo creado o no; no se reenvía solo para no duplicarlo.
+
+Los trabajos sobreviven a un reinicio si el archivo está en un volumen
+persistente: al arrancar, los workers retoman los documentos pendientes.
+Varios procesos pueden compartir el archivo (BEGIN IMMEDIATE serializa los
+claims); cada proceso registra un latido para detectar envíos huérfanos.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Iterator, List, Optional, Tuple
+
+from config import env_int, env_float
+from deadlines import deadline_scope
+from metrics import SAP_JOB_DOCUMENTS
+from sap_guard import ServiceUnavailableError
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    company_db TEXT NOT NULL,
+    username TEXT NOT NULL,
+    options TEXT NOT NULL,
+    idempotency_key TEXT,
+    created_at REAL NOT NULL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_key ON jobs (idempotency_key, created_at);
+CREATE TABLE IF NOT EXISTS job_documents (
+    job_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL,
+    owner TEXT,
+    result TEXT,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (job_id, position)
+);
+CREATE INDEX IF NOT EXISTS job_documents_status ON job_documents (status, job_id, position);
+CREATE TABLE IF NOT EXISTS job_workers (
+    owner TEXT PRIMARY KEY,
+    heartbeat REAL NOT NULL
+);
+"""
+
+# Estados finales de un documento
+FINISHED_STATES = ("success", "error", "unknown")
+
+# Un proceso sin latido por este tiempo se da por terminado
+HEARTBEAT_INTERVAL = 10.0
+STALE_AFTER = 60.0
+
+# Crea los documentos de un lote: recibe el trabajo y las órdenes, devuelve
+# un resultado por orden ({"status": "success", "DocEntry", "DocNum"},
+# {"status": "error", "error"} o {"status": "unknown", "error"} si el envío se
+# cortó después de llegar a SAP). Lanza ServiceUnavailableError o
+# ConnectionError si no envió nada: el lote vuelve a la cola.
+Executor = Callable[[dict, List[dict]], Awaitable[List[dict]]]
+
+
+def _final_status(result: dict) -> str:
+    """Estado final de un documento según el resultado del Executor"""
+    status = result.get("status")
+    return status if status in FINISHED_STATES else "error"
+
+
+def _isoformat(timestamp: Optional[float]) -> Optional[str]:
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat() if timestamp else None
+
+
+class JobQueue:
+    """
+    Trabajos de creación de documentos en SAP persistidos en SQLite
+
+    Variables de entorno:
+        SAP_JOB_QUEUE_PATH: Archivo SQLite de la cola; sin valor el modo trabajo está deshabilitado
+        SAP_JOB_WORKERS: Lotes enviados a SAP a la vez por proceso (default 2)
+        SAP_JOB_TIMEOUT: Plazo en segundos de cada lote enviado a SAP (default 300)
+        SAP_JOB_RETENTION_HOURS: Horas que se conserva un trabajo terminado (default 24)
+    """
+
+    def __init__(self, path: str, workers: Optional[int] = None, timeout: Optional[float] = None,
+                 retention_hours: Optional[float] = None, dedupe_ttl: float = 0.0,
+                 poll_interval: float = 1.0):
+        self.path = path
+        self.workers = max(1, workers if workers is not None else env_int('SAP_JOB_WORKERS', 2))
+        self.timeout = timeout if timeout is not None else env_float('SAP_JOB_TIMEOUT', 300.0)
+        self.retention = 3600 * (retention_hours if retention_hours is not None
+                                 else env_float('SAP_JOB_RETENTION_HOURS', 24.0))
+        # Un trabajo con la misma clave de idempotencia dentro de este plazo no se repite
+        self.dedupe_ttl = dedupe_ttl
+        self.poll_interval = poll_interval
+        # Identifica a este proceso como dueño de los envíos en curso (un PID
+        # puede repetirse en un contenedor nuevo)
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:12]}"
+        self._wakeup = asyncio.Event()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=10)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+        self._lock = threading.Lock()
+
+        with self._transaction() as conn:
+            conn.execute("INSERT OR REPLACE INTO job_workers (owner, heartbeat) VALUES (?, ?)",
+                         (self.owner, time.time()))
+        logger.info("Cola de trabajos SAP en %s (%s workers)", path, self.workers)
+
+    @classmethod
+    def from_env(cls, dedupe_ttl: float = 0.0) -> Optional["JobQueue"]:
+        """Crear la cola si SAP_JOB_QUEUE_PATH está configurada"""
+        path = os.getenv('SAP_JOB_QUEUE_PATH')
+        return cls(path, dedupe_ttl=dedupe_ttl) if path else None
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    # --- Operaciones (en un hilo: el lock de SQLite puede esperar a otro proceso) ---
+
+    async def submit(self, kind: str, company_db: str, username: str, documents: List[dict],
+                     options: Optional[dict] = None, idempotency_key: Optional[str] = None) -> Tuple[str, bool]:
+        """
+        Encolar un trabajo
+
+        Returns:
+            tuple: (job_id, repetido) donde repetido indica que ya existía un
+                trabajo con la misma clave de idempotencia y se devuelve ese
+        """
+        job_id, replayed = await asyncio.to_thread(self._submit, kind, company_db, username, documents,
+                                                   options or {}, idempotency_key)
+        if not replayed:
+            self._wakeup.set()
+        return job_id, replayed
+
+    def _submit(self, kind: str, company_db: str, username: str, documents: List[dict], options: dict,
+                idempotency_key: Optional[str]) -> Tuple[str, bool]:
+        now = time.time()
+        with self._transaction() as conn:
+            if idempotency_key:
+                row = conn.execute(
+                    "SELECT job_id FROM jobs WHERE idempotency_key = ? AND created_at > ? "
+                    "ORDER BY created_at DESC LIMIT 1",
+                    (idempotency_key, now - self.dedupe_ttl)
+                ).fetchone()
+                if row is not None:
+                    return row["job_id"], True
+
+            job_id = uuid.uuid4().hex
+            conn.execute(
+                "INSERT INTO jobs (job_id, kind, company_db, username, options, idempotency_key, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (job_id, kind, company_db, username, json.dumps(options), idempotency_key, now)
+            )
+            conn.executemany(
+                "INSERT INTO job_documents (job_id, position, payload, status, updated_at) "
+                "VALUES (?, ?, ?, 'pending', ?)",
+                [(job_id, position, json.dumps(document, ensure_ascii=False), now)
+                 for position, document in enumerate(documents)]
+            )
+        logger.info("Trabajo %s encolado: %s, %s documentos", job_id, kind, len(documents))
+        return job_id, False
+
+    def _reap(self, conn: sqlite3.Connection) -> int:
+        """
+        Marcar como unknown los envíos de procesos sin latido y borrar trabajos viejos
+
+        Returns:
+            int: Documentos que quedaron en estado unknown (la métrica se
+                actualiza en el event loop, no en este hilo)
+        """
+        now = time.time()
+        conn.execute("DELETE FROM job_workers WHERE heartbeat < ? AND owner != ?", (now - STALE_AFTER, self.owner))
+        orphaned = conn.execute(
+            "UPDATE job_documents SET status = 'unknown', owner = NULL, updated_at = ?, result = ? "
+            "WHERE status = 'sending' AND owner NOT IN (SELECT owner FROM job_workers)",
+            (now, json.dumps({"error": "El proceso que enviaba el documento terminó durante el envío; "
+                                       "verificar en SAP si se creó antes de reintentar"}))
+        ).rowcount
+        if orphaned:
+            logger.warning("%s documentos de trabajos quedaron en estado desconocido", orphaned)
+            self._finish_jobs(conn)
+        conn.execute("DELETE FROM job_documents WHERE job_id IN "
+                     "(SELECT job_id FROM jobs WHERE finished_at IS NOT NULL AND finished_at < ?)",
+                     (now - self.retention,))
+        conn.execute("DELETE FROM jobs WHERE finished_at IS NOT NULL AND finished_at < ?", (now - self.retention,))
+        return orphaned
+
+    def _finish_jobs(self, conn: sqlite3.Connection, job_id: Optional[str] = None):
+        """Fijar finished_at de los trabajos sin documentos por procesar"""
+        conn.execute(
+            "UPDATE jobs SET finished_at = ? WHERE finished_at IS NULL "
+            + ("AND job_id = ? " if job_id else "")
+            + "AND NOT EXISTS (SELECT 1 FROM job_documents d WHERE d.job_id = jobs.job_id "
+              "AND d.status IN ('pending', 'sending'))",
+            (time.time(), job_id) if job_id else (time.time(),)
+        )
+
+    async def claim(self) -> Optional[Tuple[dict, List[int], List[dict]]]:
+        """
+        Tomar el próximo lote de documentos pendientes (del trabajo más antiguo)
+
+        Returns:
+            tuple: (trabajo, posiciones, documentos), o None si no hay pendientes
+        """
+        orphaned, claimed = await asyncio.to_thread(self._claim)
+        if orphaned:
+            SAP_JOB_DOCUMENTS.inc("unknown", amount=orphaned)
+        return claimed
+
+    def _claim(self) -> Tuple[int, Optional[Tuple[dict, List[int], List[dict]]]]:
+        with self._transaction() as conn:
+            orphaned = self._reap(conn)
+            row = conn.execute(
+                "SELECT j.* FROM jobs j WHERE EXISTS (SELECT 1 FROM job_documents d "
+                "WHERE d.job_id = j.job_id AND d.status = 'pending') ORDER BY j.created_at LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return orphaned, None
+
+            job = self._job(row)
+            rows = conn.execute(
+                "SELECT position, payload FROM job_documents WHERE job_id = ? AND status = 'pending' "
+                "ORDER BY position LIMIT ?",
+                (job["job_id"], max(1, int(job["options"].get("batch_size") or 1)))
+            ).fetchall()
+            positions = [r["position"] for r in rows]
+            conn.executemany(
+                "UPDATE job_documents SET status = 'sending', owner = ?, updated_at = ? "
+                "WHERE job_id = ? AND position = ?",
+                [(self.owner, time.time(), job["job_id"], position) for position in positions]
+            )
+            return orphaned, (job, positions, [json.loads(r["payload"]) for r in rows])
+
+    async def complete(self, job_id: str, positions: List[int], results: List[dict]):
+        """Registrar el resultado de cada documento de un lote"""
+        await asyncio.to_thread(self._complete, job_id, positions, results)
+        for result in results:
+            SAP_JOB_DOCUMENTS.inc(_final_status(result))
+
+    def _complete(self, job_id: str, positions: List[int], results: List[dict]):
+        now = time.time()
+        with self._transaction() as conn:
+            conn.executemany(
+                "UPDATE job_documents SET status = ?, owner = NULL, result = ?, updated_at = ? "
+                "WHERE job_id = ? AND position = ?",
+                [(_final_status(result),
+                  json.dumps({k: v for k, v in result.items() if k not in ("index", "status")}, ensure_ascii=False),
+                  now, job_id, position)
+                 for position, result in zip(positions, results)]
+            )
+            self._finish_jobs(conn, job_id)
+
+    async def requeue(self, job_id: str, positions: List[int]):
+        """Devolver a la cola documentos que no llegaron a enviarse"""
+        await asyncio.to_thread(self._requeue, job_id, positions)
+
+    def _requeue(self, job_id: str, positions: List[int]):
+        with self._transaction() as conn:
+            conn.executemany(
+                "UPDATE job_documents SET status = 'pending', owner = NULL, updated_at = ? "
+                "WHERE job_id = ? AND position = ?",
+                [(time.time(), job_id, position) for position in positions]
+            )
+
+    async def heartbeat(self):
+        await asyncio.to_thread(self._heartbeat)
+
+    def _heartbeat(self):
+        with self._transaction() as conn:
+            conn.execute("INSERT OR REPLACE INTO job_workers (owner, heartbeat) VALUES (?, ?)",
+                         (self.owner, time.time()))
+
+    async def status(self, job_id: str) -> Optional[dict]:
+        """
+        Estado de un trabajo con el resultado de cada documento
+
+        Returns:
+            dict: Estado, contadores y resultados, o None si el trabajo no existe
+        """
+        return await asyncio.to_thread(self._status, job_id)
+
+    def _status(self, job_id: str) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+            if row is None:
+                return None
+            documents = self._conn.execute(
+                "SELECT position, status, result FROM job_documents WHERE job_id = ? ORDER BY position",
+                (job_id,)
+            ).fetchall()
+
+        job = self._job(row)
+        counts = {state: 0 for state in ("pending", "sending") + FINISHED_STATES}
+        results = []
+        for document in documents:
+            counts[document["status"]] += 1
+            if document["status"] in FINISHED_STATES:
+                results.append({"index": document["position"], "status": document["status"],
+                                **json.loads(document["result"] or "{}")})
+
+        total = len(documents)
+        done = total - counts["pending"] - counts["sending"]
+        if done < total:
+            status = "queued" if counts["pending"] == total else "running"
+        elif counts["success"] == total:
+            status = "success"
+        else:
+            status = "partial" if counts["success"] else "error"
+
+        return {
+            "job_id": job_id,
+            "kind": job["kind"],
+            "status": status,
+            "company_db": job["company_db"],
+            "total": total,
+            "done": done,
+            "created": counts["success"],
+            "failed": counts["error"],
+            "unknown": counts["unknown"],
+            "pending": counts["pending"] + counts["sending"],
+            "created_at": _isoformat(job["created_at"]),
+            "finished_at": _isoformat(job["finished_at"]),
+            "results": results
+        }
+
+    @staticmethod
+    def _job(row: sqlite3.Row) -> dict:
+        return {**dict(row), "options": json.loads(row["options"])}
+
+    # --- Workers ---------------------------------------------------------
+
+    async def run(self, execute: Executor):
+        """Tarea en segundo plano: workers que envían los lotes pendientes"""
+        tasks = [asyncio.create_task(self._worker(execute)) for _ in range(self.workers)]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def heartbeat_loop(self):
+        """
+        Tarea en segundo plano: latido del proceso
+
+        Se inicia al arrancar, sin esperar a SAP: si este proceso dejara de
+        latir, otro daría por huérfanos sus envíos en curso.
+        """
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            try:
+                await self.heartbeat()
+            except Exception as e:
+                logger.error("Error registrando el latido de la cola de trabajos: %s", e)
+
+    async def _worker(self, execute: Executor):
+        while True:
+            try:
+                claimed = await self.claim()
+            except Exception as e:
+                logger.error("Error leyendo la cola de trabajos: %s", e)
+                claimed = None
+
+            if claimed is None:
+                # Sin pendientes: esperar un encolado de este proceso o, por
+                # los de otros procesos, el siguiente sondeo
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            job, positions, documents = claimed
+            try:
+                with deadline_scope(self.timeout):
+                    results = await execute(job, documents)
+            except asyncio.CancelledError:
+                # Apagado ordenado antes de terminar el envío: el resultado es incierto
+                raise
+            except (ServiceUnavailableError, ConnectionError) as e:
+                # Nada llegó a SAP (circuito abierto, sin sesión): volver a la cola
+                retry_after = getattr(e, "retry_after", None) or 5.0
+                logger.warning("Trabajo %s: SAP no disponible (%s), reintento en %.0fs", job['job_id'], e, retry_after)
+                await self.requeue(job["job_id"], positions)
+                await asyncio.sleep(retry_after)
+                continue
+            except Exception as e:
+                logger.error("Error procesando el trabajo %s: %s", job['job_id'], e)
+                results = [{"status": "error", "error": str(e)} for _ in documents]
+
+            await self.complete(job["job_id"], positions, results)
+
+    def stats(self) -> dict:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT status, COUNT(*) FROM job_documents WHERE status IN ('pending', 'sending') GROUP BY status"
+            ).fetchall()
+            jobs = self._conn.execute("SELECT COUNT(*) FROM jobs WHERE finished_at IS NULL").fetchone()[0]
+        counts = {status: count for status, count in rows}
+        return {"path": self.path, "active_jobs": jobs, "pending": counts.get("pending", 0),
+                "sending": counts.get("sending", 0), "workers": self.workers}
+
+    def close(self):
+        """Dar de baja este proceso; sus envíos cortados quedan como unknown para el próximo claim"""
+        with self._lock:
+            self._conn.execute("DELETE FROM job_workers WHERE owner = ?", (self.owner,))
+            self._conn.close()
@@ -0,0 +1,525 @@
+"""
+Pool de sesiones del SAP Business One Service Layer
+
+Cada SAPClient representa una sesión B1SESSION, que SAP procesa de forma
+serializada y que queda fijada a un nodo del Service Layer mediante la
+cookie ROUTEID. El pool mantiene varias sesiones, entrega una sesión libre
+a cada llamada de herramienta y reparte la carga entre los nodos vistos.
+
+Con SAP_SESSION_STORE_PATH los pools de varios workers comparten sus
+sesiones a través de un almacén local (session_store.py).
+"""
+
+import asyncio
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+from config import env_int, env_float
+from deadlines import check_deadline, remaining as deadline_remaining
+from sap_cache import MasterDataCache
+from sap_client import SAPClient, odata_params
+from sap_guard import SAPGuard, ServiceUnavailableError
+from session_store import SessionStore
+
+logger = logging.getLogger(__name__)
+
+# Ruta usada para sesiones sin cookie ROUTEID (Service Layer sin cluster)
+DEFAULT_ROUTE = "default"
+
+# Segundos que debe avanzar la expiración de una sesión antes de escribirla
+# en el almacén compartido: a lo sumo una escritura por minuto por sesión
+STORE_TOUCH_INTERVAL = 60.0
+
+
+class PooledSession:
+    """Sesión SAP administrada por el pool"""
+
+    __slots__ = ("client", "in_use", "last_used", "stored_id", "stored_expires")
+
+    def __init__(self, client: SAPClient, stored_id: Optional[str] = None, stored_expires: float = 0.0):
+        self.client = client
+        self.in_use = False
+        self.last_used = time.monotonic()
+        # session_id y expiración (epoch) con que la sesión figura en el almacén compartido
+        self.stored_id = stored_id
+        self.stored_expires = stored_expires
+
+    @property
+    def route(self) -> str:
+        return self.client.route_id or DEFAULT_ROUTE
+
+
+class SAPSessionPool:
+    """
+    Pool de sesiones SAP con crecimiento bajo demanda y reparto por ROUTEID
+
+    Variables de entorno:
+        SAP_POOL_MIN_SIZE: Sesiones que se conservan aunque estén ociosas (default 1)
+        SAP_POOL_MAX_SIZE: Máximo de sesiones abiertas, limitado por licencias (default 4)
+        SAP_POOL_IDLE_TIMEOUT: Segundos de inactividad antes de cerrar una sesión sobrante (default 300)
+        SAP_SESSION_REFRESH_MARGIN: Segundos antes de la expiración en que se renueva una sesión ociosa (default 120)
+        SAP_POOL_ACQUIRE_TIMEOUT: Segundos máximos de espera por una sesión libre (default 30)
+    """
+
+    def __init__(self, base_url: Optional[str] = None,
+                 min_size: Optional[int] = None,
+                 max_size: Optional[int] = None,
+                 idle_timeout: Optional[float] = None,
+                 refresh_margin: Optional[float] = None,
+                 client_factory: Optional[Callable[[], SAPClient]] = None,
+                 cache: Optional[MasterDataCache] = None,
+                 guard: Optional[SAPGuard] = None,
+                 store: Optional[SessionStore] = None,
+                 credentials: Optional[Tuple[str, str, str]] = None):
+        self.base_url = base_url
+        # (CompanyDB, usuario, contraseña); None usa SAP_COMPANY_DB/SAP_USERNAME/SAP_PASSWORD
+        self.credentials = credentials
+        self.min_size = min_size if min_size is not None else env_int('SAP_POOL_MIN_SIZE', 1)
+        self.max_size = max_size if max_size is not None else env_int('SAP_POOL_MAX_SIZE', 4)
+        self.idle_timeout = idle_timeout if idle_timeout is not None else env_float('SAP_POOL_IDLE_TIMEOUT', 300.0)
+        self.refresh_margin = refresh_margin if refresh_margin is not None else env_float('SAP_SESSION_REFRESH_MARGIN', 120.0)
+        self.acquire_timeout = env_float('SAP_POOL_ACQUIRE_TIMEOUT', 30.0)
+
+        if self.max_size < 1:
+            raise ValueError("SAP_POOL_MAX_SIZE debe ser al menos 1")
+        self.min_size = max(0, min(self.min_size, self.max_size))
+
+        # Caché de datos maestros compartida por todas las sesiones del pool
+        self.cache = cache if cache is not None else MasterDataCache()
+        # Límite de concurrencia y circuit breaker comunes: protegen al mismo Service Layer
+        self.guard = guard if guard is not None else SAPGuard()
+        # Almacén de sesiones compartido con otros workers (opcional); si lo
+        # recibe de afuera (registro de compañías), su ciclo de vida no es del pool
+        self._owns_store = store is None
+        self.store = store if store is not None else SessionStore.from_env()
+        self._client_factory = client_factory or (lambda: SAPClient(self.base_url, cache=self.cache,
+                                                                    guard=self.guard))
+        self._sessions: List[PooledSession] = []
+        # Logins en curso que ya reservaron un lugar en el pool
+        self._pending = 0
+        # Llamadas dentro de _checkout: esperando una sesión o el lock del pool
+        self._waiting = 0
+        self._cond = asyncio.Condition()
+        self._maintenance_task: Optional[asyncio.Task] = None
+        self._closed = False
+
+        logger.info("Pool de sesiones SAP: min=%s, max=%s", self.min_size, self.max_size)
+
+    @property
+    def size(self) -> int:
+        return len(self._sessions)
+
+    @property
+    def sessions(self) -> List[SAPClient]:
+        return [s.client for s in self._sessions]
+
+    @property
+    def in_use(self) -> int:
+        return sum(1 for s in self._sessions if s.in_use)
+
+    @property
+    def busy(self) -> bool:
+        """Hay sesiones en uso, logins en curso o llamadas esperando una sesión"""
+        return self.in_use > 0 or self._pending > 0 or self._waiting > 0
+
+    @asynccontextmanager
+    async def acquire(self) -> AsyncIterator[SAPClient]:
+        """
+        Obtener una sesión SAP libre para uso exclusivo
+
+        Usa una sesión ociosa si existe, abre una nueva si el pool no llegó
+        a max_size, o espera a que se libere una.
+
+        Raises:
+            ConnectionError: Si no se pudo iniciar sesión en SAP
+            ServiceUnavailableError: Si el circuito hacia SAP está abierto o no
+                se liberó una sesión dentro de SAP_POOL_ACQUIRE_TIMEOUT
+            DeadlineExceeded: Si se agotó el plazo de la llamada esperando una sesión
+        """
+        # Con el circuito abierto no tiene sentido esperar una sesión
+        self.guard.check()
+        session = await self._checkout()
+        try:
+            # Re-login coalescido si la sesión expiró; normalmente la tarea
+            # de mantenimiento ya la renovó antes
+            if not await session.client.ensure_session():
+                await self._discard(session)
+                session = None
+                raise ConnectionError("No se pudo conectar a SAP")
+            yield session.client
+        finally:
+            if session is not None:
+                await self._checkin(session)
+
+    async def iter_pages(self, endpoint: str, filter_query: str = None, select: Optional[List[str]] = None,
+                         orderby: str = None, page_size: int = None) -> AsyncIterator[List[dict]]:
+        """
+        Recorrer una colección OData tomando una sesión del pool por página
+
+        Entre página y página la sesión vuelve al pool: un recorrido largo en
+        segundo plano (carga de datos maestros) no le quita una sesión a las
+        herramientas durante todo el recorrido.
+
+        Yields:
+            list: Registros de cada página
+        """
+        params = odata_params(filter_query, select, orderby)
+        next_endpoint: Optional[str] = endpoint
+        while next_endpoint:
+            async with self.acquire() as client:
+                rows, next_endpoint = await client.get_page(next_endpoint, params, page_size)
+            # El nextLink ya incluye los parámetros de la consulta
+            params = None
+            if rows:
+                yield rows
+
+    async def iter_rows(self, endpoint: str, **kwargs) -> AsyncIterator[dict]:
+        """Recorrer una colección OData registro por registro (ver iter_pages)"""
+        async for page in self.iter_pages(endpoint, **kwargs):
+            for row in page:
+                yield row
+
+    async def warm_up(self) -> int:
+        """
+        Abrir las sesiones de min_size (al menos una) antes de recibir tráfico
+
+        Así la primera llamada de herramienta no paga el login.
+
+        Returns:
+            int: Sesiones abiertas
+
+        Raises:
+            ConnectionError: Si no se pudo iniciar sesión en SAP
+        """
+        async def open_one():
+            async with self.acquire():
+                pass
+
+        missing = max(1, self.min_size) - len(self._sessions)
+        await asyncio.gather(*(open_one() for _ in range(missing)))
+        return max(0, missing)
+
+    @property
+    def last_ok_at(self) -> Optional[float]:
+        """Última respuesta exitosa de SAP en cualquier sesión del pool (time.monotonic)"""
+        return max((s.client.last_ok_at for s in self._sessions if s.client.last_ok_at), default=None)
+
+    async def check_ready(self, max_age: float):
+        """
+        Confirmar que SAP acepta requests con las sesiones del pool
+
+        Una respuesta exitosa de hace menos de max_age segundos alcanza (con
+        tráfico no se agrega carga); si no, se hace una request mínima.
+
+        Raises:
+            ServiceUnavailableError: Si el circuito está abierto o no hay sesión libre
+            ConnectionError: Si no se pudo iniciar sesión en SAP
+            httpx.HTTPError: Si SAP rechazó la request de verificación
+        """
+        self.guard.check()
+        last_ok = self.last_ok_at
+        if last_ok is not None and time.monotonic() - last_ok < max_age:
+            return
+        async with self.acquire() as client:
+            await client.ping()
+
+    async def _checkout(self) -> PooledSession:
+        self._waiting += 1
+        try:
+            return await self._wait_for_session()
+        finally:
+            self._waiting -= 1
+
+    async def _wait_for_session(self) -> PooledSession:
+        self._ensure_maintenance()
+        # Sin sesión libre a tiempo se falla rápido en lugar de encolar sin
+        # límite; nunca se espera más que el plazo restante de la llamada
+        budget = deadline_remaining()
+        wait = self.acquire_timeout if budget is None else min(self.acquire_timeout, budget)
+        deadline = time.monotonic() + wait
+
+        async with self._cond:
+            while True:
+                if self._closed:
+                    raise ConnectionError("El pool de sesiones SAP está cerrado")
+
+                free = [s for s in self._sessions if not s.in_use]
+                if free:
+                    session = self._pick(free)
+                    session.in_use = True
+                    return session
+
+                if len(self._sessions) + self._pending < self.max_size:
+                    self._pending += 1
+                    break
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    check_deadline()
+                    raise ServiceUnavailableError("No hay sesiones SAP libres", retry_after=1.0,
+                                                  reason="pool_exhausted")
+                try:
+                    await asyncio.wait_for(self._cond.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+
+        # Abrir la nueva sesión fuera del lock: el login tarda segundos en SAP
+        try:
+            session = await self._open_session()
+        except BaseException:
+            async with self._cond:
+                self._pending -= 1
+                self._cond.notify()
+            raise
+
+        session.in_use = True
+        async with self._cond:
+            self._pending -= 1
+            self._sessions.append(session)
+        return session
+
+    async def _open_session(self) -> PooledSession:
+        client = self._client_factory()
+
+        # Otro worker pudo haber dejado una sesión vigente: adoptarla evita un login
+        if self.store is not None:
+            company_db, username = (self.credentials[:2] if self.credentials
+                                    else (os.getenv('SAP_COMPANY_DB'), os.getenv('SAP_USERNAME')))
+            state = await self.store.claim(company_db, username, min_ttl=self.refresh_margin)
+            if state is not None:
+                session = PooledSession(client, stored_id=state["session_id"], stored_expires=state["expires_at"])
+                client.adopt_session(state, password=self.credentials[2] if self.credentials else None)
+                logger.info("Sesión SAP adoptada del almacén compartido (nodo %s), total %s",
+                            session.route, len(self._sessions) + 1)
+                return session
+
+        logged_in = await (client.login(*self.credentials) if self.credentials else client.login_from_env())
+        if not logged_in:
+            await client.aclose()
+            raise ConnectionError("No se pudo conectar a SAP")
+
+        session = PooledSession(client)
+        await self._sync_store(session)
+        logger.info("Nueva sesión SAP en el pool (nodo %s), total %s", session.route, len(self._sessions) + 1)
+        return session
+
+    async def _sync_store(self, session: PooledSession):
+        """
+        Publicar la sesión en el almacén si cambió (login, re-login o renovación)
+
+        Si es la misma sesión, extender su expiración registrada: SAP la
+        extiende con cada request y, si no, otro worker la daría por vencida.
+        """
+        if self.store is None:
+            return
+        client = session.client
+        try:
+            if client.session_id == session.stored_id:
+                if client.session_id and client.session_timeout is not None:
+                    expires_at = client.session_timeout.timestamp()
+                    if expires_at - session.stored_expires >= STORE_TOUCH_INTERVAL:
+                        await self.store.touch(session.stored_id, expires_at)
+                        session.stored_expires = expires_at
+                return
+            state = client.session_state()
+            if state is None:
+                await self.store.remove(session.stored_id)
+            else:
+                await self.store.publish(state, replaces=session.stored_id)
+                session.stored_expires = state["expires_at"]
+            session.stored_id = client.session_id
+        except Exception as e:
+            logger.error("Error actualizando el almacén de sesiones SAP: %s", e)
+
+    async def _retire(self, session: PooledSession):
+        """
+        Sacar una sesión del pool: devolverla al almacén para otros workers
+        o, si no corresponde, cerrarla con logout
+        """
+        state = session.client.session_state() if session.client.is_session_valid() else None
+        if self.store is not None:
+            try:
+                if state is not None and await self.store.release(state, replaces=session.stored_id):
+                    await session.client.aclose(logout=False)
+                    return
+                await self.store.remove(session.stored_id)
+            except Exception as e:
+                logger.error("Error devolviendo la sesión SAP al almacén: %s", e)
+        await session.client.aclose()
+
+    def _route_load(self) -> Dict[str, int]:
+        """Sesiones en uso por nodo ROUTEID"""
+        load: Dict[str, int] = {}
+        for s in self._sessions:
+            load.setdefault(s.route, 0)
+            if s.in_use:
+                load[s.route] += 1
+        return load
+
+    def _pick(self, free: List[PooledSession]) -> PooledSession:
+        """
+        Elegir la sesión libre del nodo menos cargado
+
+        Entre nodos igual de cargados se prefiere la sesión usada más
+        recientemente, así las demás quedan ociosas y el pool puede encogerse.
+        """
+        load = self._route_load()
+        return min(free, key=lambda s: (load[s.route], -s.last_used))
+
+    async def _checkin(self, session: PooledSession, touch: bool = True):
+        # Un re-login durante el uso cambió la sesión: los demás workers no deben adoptar la vieja
+        await self._sync_store(session)
+        async with self._cond:
+            session.in_use = False
+            if touch:
+                session.last_used = time.monotonic()
+            self._cond.notify()
+
+    async def _discard(self, session: PooledSession):
+        async with self._cond:
+            if session in self._sessions:
+                self._sessions.remove(session)
+            self._cond.notify()
+        if self.store is not None:
+            await self.store.remove(session.stored_id)
+        await session.client.aclose()
+
+    async def shrink(self) -> int:
+        """
+        Cerrar sesiones ociosas por más de idle_timeout sin bajar de min_size
+
+        Las sesiones se retiran primero de los nodos con más sesiones, para
+        mantener el reparto entre nodos.
+
+        Returns:
+            int: Número de sesiones cerradas
+        """
+        now = time.monotonic()
+        to_close: List[PooledSession] = []
+
+        async with self._cond:
+            while len(self._sessions) > self.min_size:
+                idle = [s for s in self._sessions
+                        if not s.in_use and now - s.last_used >= self.idle_timeout]
+                if not idle:
+                    break
+
+                per_route: Dict[str, int] = {}
+                for s in self._sessions:
+                    per_route[s.route] = per_route.get(s.route, 0) + 1
+
+                victim = max(idle, key=lambda s: (per_route[s.route], now - s.last_used))
+                self._sessions.remove(victim)
+                to_close.append(victim)
+
+        for session in to_close:
+            logger.info("Cerrando sesión SAP ociosa (nodo %s)", session.route)
+            await self._retire(session)
+
+        return len(to_close)
+
+    async def refresh_expiring(self) -> int:
+        """
+        Renovar en segundo plano las sesiones ociosas próximas a expirar
+
+        Las sesiones se reservan mientras se renuevan, así ninguna llamada
+        de herramienta recibe una sesión a mitad de login.
+
+        Returns:
+            int: Número de sesiones renovadas
+        """
+        async with self._cond:
+            due = [s for s in self._sessions
+                   if not s.in_use and s.client.expires_within(self.refresh_margin)]
+            for s in due:
+                s.in_use = True
+
+        async def refresh(session: PooledSession) -> bool:
+            try:
+                if await session.client.refresh_session():
+                    await self._checkin(session, touch=False)
+                    return True
+                logger.warning("No se pudo renovar la sesión SAP (nodo %s), se descarta", session.route)
+            except Exception as e:
+                logger.error("Error renovando sesión SAP: %s", e)
+            await self._discard(session)
+            return False
+
+        results = await asyncio.gather(*(refresh(s) for s in due))
+        return sum(1 for ok in results if ok)
+
+    def _ensure_maintenance(self):
+        if self._maintenance_task is None or self._maintenance_task.done():
+            self._maintenance_task = asyncio.create_task(self._maintenance_loop())
+
+    async def _maintenance_loop(self):
+        interval = max(1.0, min(self.idle_timeout / 2, self.refresh_margin / 2, 60.0))
+        while not self._closed:
+            await asyncio.sleep(interval)
+            try:
+                await self.shrink()
+                await self.refresh_expiring()
+            except Exception as e:
+                logger.error("Error en mantenimiento del pool SAP: %s", e)
+
+    def stats(self) -> dict:
+        """Estado del pool para herramientas de estado y health checks"""
+        routes: Dict[str, int] = {}
+        for s in self._sessions:
+            routes[s.route] = routes.get(s.route, 0) + 1
+        return {
+            "size": len(self._sessions),
+            "in_use": self.in_use,
+            "min_size": self.min_size,
+            "max_size": self.max_size,
+            "routes": routes,
+            "cache": self.cache.stats(),
+            "guard": self.guard.stats(),
+            "store": self.store.stats() if self.store is not None else None
+        }
+
+    async def close(self):
+        """
+        Cerrar todas las sesiones (logout) y detener el mantenimiento
+
+        Con almacén compartido las sesiones vuelven al almacén para los
+        workers que siguen activos; el último en salir hace el logout.
+        """
+        self._closed = True
+        if self._maintenance_task is not None:
+            self._maintenance_task.cancel()
+            try:
+                await self._maintenance_task
+            except asyncio.CancelledError:
+                pass
+            self._maintenance_task = None
+
+        async with self._cond:
+            sessions, self._sessions = self._sessions, []
+            self._cond.notify_all()
+
+        await asyncio.gather(*(self._retire(s) for s in sessions), return_exceptions=True)
+
+        if self.store is not None and self._owns_store:
+            await close_session_store(self.store, self._client_factory)
+
+        logger.info("Pool de sesiones SAP cerrado (%s sesiones)", len(sessions))
+
+
+async def close_session_store(store: SessionStore, client_factory: Callable[[], SAPClient]):
+    """
+    Dar de baja este worker del almacén compartido y cerrarlo
+
+    El último worker en salir hace logout de las sesiones que quedaron libres.
+    """
+    leftovers = await store.leave()
+    for state in leftovers:
+        client = client_factory()
+        client.adopt_session(state)
+        await client.aclose()
+    if leftovers:
+        logger.info("Logout de %s sesiones SAP libres del almacén compartido", len(leftovers))
+    store.close()
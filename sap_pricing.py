@@ -0,0 +1,427 @@
+"""
+Cotización local de Sales Orders con listas de precios en memoria
+
+Calcula precio, descuento, impuesto y DocTotal de cada línea sin crear
+documentos en SAP, a partir de PriceLists, SpecialPrices, precios de los
+Items y tasas de impuesto refrescados periódicamente (Items y clientes
+vienen de la carga compartida con sap_validation). Una muestra de las
+cotizaciones se contrasta en segundo plano con CompanyService_GetItemPrice:
+si SAP da otro precio se registra la diferencia y se adelanta el refresco.
+
+Reglas (las de SAP sin grupos de descuento ni conversión de moneda):
+    - Precio especial del cliente para el artículo, o el de su lista
+      (CardCode '*<lista>'), con el período y el escalón de cantidad
+      vigentes; si no hay, el precio del artículo en la lista del cliente.
+    - UnitPrice / DiscountPercent de la línea reemplazan a los calculados.
+    - TaxCode de la línea, o el grupo de IVA del artículo o del cliente.
+    - El DiscountPercent del documento se aplica antes del impuesto.
+"""
+
+import asyncio
+import contextvars
+import logging
+import os
+import random
+import time
+from datetime import date, datetime, timezone
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import httpx
+
+from config import env_float
+from deadlines import deadline_scope
+from metrics import SAP_QUOTE_CHECKS
+from sap_client import _parse_number
+from sap_replica import MasterDataSource
+from sap_validation import _is_yes
+
+logger = logging.getLogger(__name__)
+
+# Diferencia de precio tolerada al contrastar con SAP (redondeo)
+PRICE_TOLERANCE = 0.01
+
+# Plazo de un contraste con SAP (corre fuera de la llamada que lo originó)
+RECONCILE_TIMEOUT = 30.0
+
+
+def _parse_date(value: Any) -> Optional[date]:
+    """Fecha de SAP ('2025-01-31', '2025-01-31T00:00:00Z') o del usuario ('20250131')"""
+    if not value:
+        return None
+    text = str(value)[:10].replace("-", "")
+    try:
+        return datetime.strptime(text, "%Y%m%d").date()
+    except ValueError:
+        return None
+
+
+def _money(value: float) -> float:
+    return round(value, 2)
+
+
+class QuoteError(ValueError):
+    """Orden que no se puede cotizar; errors lista cada problema"""
+
+    def __init__(self, errors: List[str]):
+        super().__init__("; ".join(errors))
+        self.errors = errors
+
+
+class PricingEngine:
+    """
+    Motor de precios con listas, precios especiales e impuestos en memoria
+
+    Variables de entorno:
+        SAP_PRICING_REFRESH_INTERVAL: Segundos entre refrescos de precios (default 600)
+        SAP_QUOTE_RECONCILE_RATE: Fracción de cotizaciones contrastadas con SAP (default 0.05; 0 = nunca)
+        SAP_TAX_CODES_ENDPOINT: Entidad de códigos de impuesto (ver sap_validation)
+    """
+
+    def __init__(self, master_data: Optional[MasterDataSource] = None,
+                 refresh_interval: Optional[float] = None,
+                 reconcile_rate: Optional[float] = None,
+                 tax_codes_endpoint: Optional[str] = None):
+        self.master_data = master_data or MasterDataSource()
+        self.refresh_interval = (refresh_interval if refresh_interval is not None
+                                 else env_float('SAP_PRICING_REFRESH_INTERVAL', 600.0))
+        self.reconcile_rate = (reconcile_rate if reconcile_rate is not None
+                               else env_float('SAP_QUOTE_RECONCILE_RATE', 0.05))
+        self.tax_codes_endpoint = tax_codes_endpoint or os.getenv('SAP_TAX_CODES_ENDPOINT', '/SalesTaxCodes')
+
+        # ItemCode -> {lista: (precio, moneda)} y grupo de IVA de venta
+        self.item_prices: Dict[str, Dict[int, Tuple[float, Optional[str]]]] = {}
+        self.item_tax: Dict[str, Optional[str]] = {}
+        # CardCode -> lista de precios, moneda y grupo de IVA
+        self.partners: Dict[str, dict] = {}
+        # Lista -> precios con impuesto incluido
+        self.gross_lists: Set[int] = set()
+        # (CardCode o '*<lista>', ItemCode) -> SpecialPrice
+        self.special_prices: Dict[Tuple[str, str], dict] = {}
+        # Código -> tasa (%) de los códigos activos; los inactivos solo se conocen
+        self.tax_rates: Dict[str, float] = {}
+        self.inactive_taxes: Set[str] = set()
+
+        self.last_refresh: Optional[float] = None
+        self.checks = {"match": 0, "mismatch": 0, "error": 0}
+        self._load_lock = asyncio.Lock()
+        self._refresh_now = asyncio.Event()
+        self._pending_checks: Set[asyncio.Task] = set()
+        self._closed = False
+
+    def is_loaded(self) -> bool:
+        return self.last_refresh is not None
+
+    # --- Carga de precios ------------------------------------------------
+
+    async def refresh(self, pool, max_age: float = 0.0):
+        """
+        Recargar precios, listas e impuestos desde la réplica (si está cargada) o desde SAP
+
+        Args:
+            pool: Pool de sesiones; se toma una sesión por página
+            max_age: Segundos de antigüedad aceptables de un recorrido de SAP
+                hecho para otro consumidor (ver MasterDataSource)
+        """
+        start = time.monotonic()
+        items, partners = await self.master_data.load(pool, max_age)
+        partners = [p for p in partners if p.get("CardType", "cCustomer") == "cCustomer"]
+
+        item_prices = {}
+        for item in items:
+            item_prices[item["ItemCode"]] = {
+                p["PriceList"]: (float(p.get("Price") or 0.0), p.get("Currency") or None)
+                for p in item.get("ItemPrices") or [] if p.get("PriceList") is not None
+            }
+        item_tax = {i["ItemCode"]: i.get("SalesVATGroup") for i in items}
+        partner_terms = {p["CardCode"]: {"PriceListNum": p.get("PriceListNum") or 1,
+                                         "Currency": p.get("Currency"), "VatGroup": p.get("VatGroup")}
+                         for p in partners}
+
+        price_lists = await self._optional_rows(pool, "/PriceLists", ["PriceListNo", "IsGrossPrice", "Active"])
+        special_prices = await self._optional_rows(pool, "/SpecialPrices")
+        if self.tax_codes_endpoint.rstrip("/").endswith("VatGroups"):
+            taxes = await self._optional_rows(pool, self.tax_codes_endpoint,
+                                              ["Code", "Inactive", "VatGroups_Lines"])
+        else:
+            taxes = await self._optional_rows(pool, self.tax_codes_endpoint, ["Code", "Inactive", "Rate"])
+
+        # Se reemplaza todo junto: una cotización nunca mezcla dos refrescos
+        self.item_prices, self.item_tax, self.partners = item_prices, item_tax, partner_terms
+        if price_lists is not None:
+            self.gross_lists = {p["PriceListNo"] for p in price_lists if _is_yes(p.get("IsGrossPrice"))}
+        if special_prices is not None:
+            self.special_prices = {(s["CardCode"], s["ItemCode"]): s for s in special_prices
+                                   if _is_yes(s.get("Valid", "tYES"))}
+        if taxes is not None:
+            self.tax_rates = {t["Code"]: _tax_rate(t) for t in taxes if not _is_yes(t.get("Inactive", "tNO"))}
+            self.inactive_taxes = {t["Code"] for t in taxes if _is_yes(t.get("Inactive", "tNO"))}
+
+        self.last_refresh = time.time()
+        logger.info("Precios cargados en %.1fs: %s items, %s clientes, %s precios especiales, %s impuestos",
+                    time.monotonic() - start, len(self.item_prices), len(self.partners),
+                    len(self.special_prices), len(self.tax_rates))
+
+    async def _optional_rows(self, pool, endpoint: str, select: Optional[List[str]] = None) -> Optional[List[dict]]:
+        """Filas de una entidad que puede no estar expuesta (o sin permiso); None si SAP la rechaza"""
+        try:
+            return [r async for r in pool.iter_rows(endpoint, select=select)]
+        except httpx.HTTPStatusError as e:
+            logger.warning("No se pudo cargar %s para cotizar: %s", endpoint, e)
+            return None
+
+    async def ensure_loaded(self, pool):
+        """Cargar los precios en la primera cotización si el refresco de fondo aún no terminó"""
+        if self.is_loaded():
+            return
+        async with self._load_lock:
+            if not self.is_loaded():
+                await self.refresh(pool, max_age=self.refresh_interval / 2)
+
+    async def run(self, pool):
+        """Tarea en segundo plano: refrescar precios periódicamente o al detectar diferencias con SAP"""
+        # Una diferencia con SAP pide un recorrido nuevo, no el de otro consumidor
+        max_age = self.refresh_interval / 2
+        while True:
+            try:
+                await self.refresh(pool, max_age=max_age)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Error refrescando precios: %s", e)
+            self._refresh_now.clear()
+            try:
+                await asyncio.wait_for(self._refresh_now.wait(), self.refresh_interval)
+                max_age = 0.0
+            except asyncio.TimeoutError:
+                max_age = self.refresh_interval / 2
+
+    # --- Cotización --------------------------------------------------------
+
+    def quote(self, order: dict) -> dict:
+        """
+        Cotizar una Sales Order con los precios en memoria
+
+        Returns:
+            dict: Líneas con precio, descuento e impuesto, y totales del documento
+
+        Raises:
+            QuoteError: Si el cliente, un artículo o un código de impuesto no son válidos
+        """
+        errors: List[str] = []
+        warnings: List[str] = []
+        card_code = order.get("CardCode")
+        partner = self.partners.get(card_code)
+        if partner is None:
+            raise QuoteError([f"CardCode '{card_code}' no existe o no es cliente"])
+
+        on_date = _parse_date(order.get("DocDate")) or date.today()
+        list_no = partner["PriceListNum"]
+        currency = order.get("DocCurrency") or (partner["Currency"] if partner["Currency"] != "##" else None)
+        doc_discount = _parse_number(order.get("DiscountPercent")) or 0.0
+        if not 0 <= doc_discount <= 100:
+            errors.append(f"DiscountPercent del documento fuera de rango: {order.get('DiscountPercent')!r}")
+
+        lines = []
+        for i, line in enumerate(order.get("DocumentLines") or [], start=1):
+            item_code = line.get("ItemCode")
+            if item_code not in self.item_prices:
+                errors.append(f"Línea {i}: ItemCode '{item_code}' no existe")
+                continue
+            quantity = _parse_number(line.get("Quantity")) or 0.0
+
+            unit_price, discount, price, line_currency, source = self._line_price(
+                card_code, list_no, item_code, quantity, on_date)
+            if line.get("UnitPrice") is not None:
+                unit_price, discount, line_currency, source = _parse_number(line["UnitPrice"]), 0.0, None, "request"
+            elif source is None:
+                warnings.append(f"Línea {i}: '{item_code}' no tiene precio en la lista {list_no}; se cotiza en 0")
+            if line.get("DiscountPercent") is not None:
+                discount = _parse_number(line["DiscountPercent"])
+                if discount is None or not 0 <= discount <= 100:
+                    errors.append(f"Línea {i}: DiscountPercent fuera de rango: {line['DiscountPercent']!r}")
+                    continue
+                source = "request" if source in ("request", None) else f"{source}+request"
+            if line.get("UnitPrice") is not None or line.get("DiscountPercent") is not None:
+                price = unit_price * (1 - discount / 100)
+
+            if currency is None:
+                currency = line_currency
+            elif line_currency is not None and line_currency != currency:
+                errors.append(f"Línea {i}: el precio de '{item_code}' está en {line_currency}, no en {currency} "
+                              "(la conversión de moneda no se cotiza localmente)")
+                continue
+
+            tax_code = line.get("TaxCode") or self.item_tax.get(item_code) or partner["VatGroup"]
+            if tax_code in self.inactive_taxes:
+                errors.append(f"Línea {i}: TaxCode '{tax_code}' está inactivo")
+                continue
+            if tax_code and tax_code not in self.tax_rates:
+                if line.get("TaxCode") and self.tax_rates:
+                    errors.append(f"Línea {i}: TaxCode '{tax_code}' no existe")
+                    continue
+                warnings.append(f"Línea {i}: tasa de '{tax_code}' desconocida; se cotiza sin impuesto")
+            rate = self.tax_rates.get(tax_code, 0.0)
+
+            # En listas con impuesto incluido el total de línea es neto de impuesto
+            gross = source != "request" and list_no in self.gross_lists
+            line_total = _money(quantity * price / (1 + rate / 100) if gross else quantity * price)
+            lines.append({
+                "LineNum": i - 1, "ItemCode": item_code, "Quantity": quantity,
+                "UnitPrice": _money(unit_price), "DiscountPercent": round(discount, 4), "Price": _money(price),
+                "LineTotal": line_total, "TaxCode": tax_code, "TaxRate": rate, "PriceSource": source or "missing"
+            })
+
+        if errors:
+            raise QuoteError(errors)
+
+        subtotal = _money(sum(line["LineTotal"] for line in lines))
+        total_discount = _money(subtotal * doc_discount / 100)
+        for line in lines:
+            line["TaxAmount"] = _money(line["LineTotal"] * (1 - doc_discount / 100) * line["TaxRate"] / 100)
+        vat_sum = _money(sum(line["TaxAmount"] for line in lines))
+
+        quote = {
+            "CardCode": card_code,
+            "DocDate": on_date.isoformat(),
+            "DocCurrency": currency,
+            "PriceList": list_no,
+            "DocumentLines": lines,
+            "Subtotal": subtotal,
+            "DiscountPercent": doc_discount,
+            "TotalDiscount": total_discount,
+            "VatSum": vat_sum,
+            "DocTotal": _money(subtotal - total_discount + vat_sum),
+            "prices_as_of": datetime.fromtimestamp(self.last_refresh, timezone.utc).isoformat()
+            if self.last_refresh else None
+        }
+        if warnings:
+            quote["warnings"] = warnings
+        return quote
+
+    def _line_price(self, card_code: str, list_no: int, item_code: str, quantity: float,
+                    on_date: date) -> Tuple[float, float, float, Optional[str], Optional[str]]:
+        """(precio de lista, descuento %, precio neto, moneda, origen) de un artículo para el cliente"""
+        base_price, currency = self.item_prices[item_code].get(list_no, (None, None))
+        special = (self.special_prices.get((card_code, item_code))
+                   or self.special_prices.get((f"*{list_no}", item_code)))
+
+        if special is not None and _in_period(special.get("ValidFrom"), special.get("ValidTo"), on_date):
+            price = float(special.get("Price") or 0.0)
+            discount = float(special.get("DiscountPercent") or 0.0)
+            currency = special.get("Currency") or currency
+            for area in special.get("SpecialPriceDataAreas") or []:
+                if not _in_period(area.get("DateFrom"), area.get("Dateto"), on_date):
+                    continue
+                price, discount = float(area.get("SpecialPrice") or 0.0), float(area.get("Discount") or 0.0)
+                currency = area.get("PriceCurrency") or currency
+                tiers = [q for q in area.get("SpecialPriceQuantityAreas") or []
+                         if (q.get("Quantity") or 0) <= quantity]
+                if tiers:
+                    tier = max(tiers, key=lambda q: q.get("Quantity") or 0)
+                    price, discount = float(tier.get("SpecialPrice") or 0.0), float(tier.get("Discountin") or 0.0)
+                    currency = tier.get("PriceCurrency") or currency
+                break
+            # El precio especial ya tiene el descuento aplicado sobre el de lista
+            unit_price = base_price if base_price is not None else (
+                price / (1 - discount / 100) if discount < 100 else 0.0)
+            return unit_price, discount, price, currency, "special_price"
+
+        if base_price is None:
+            return 0.0, 0.0, 0.0, None, None
+        return base_price, 0.0, base_price, currency, "price_list"
+
+    # --- Contraste con SAP ---------------------------------------------------
+
+    def sample_reconcile(self, pool, quote: dict):
+        """Contrastar en segundo plano una fracción de las cotizaciones con el precio que calcula SAP"""
+        if self._closed or self.reconcile_rate <= 0 or random.random() >= self.reconcile_rate:
+            return
+        # Contexto vacío: no hereda el plazo de la herramienta, que ya respondió
+        task = contextvars.Context().run(asyncio.create_task, self.reconcile(pool, quote))
+        self._pending_checks.add(task)
+        task.add_done_callback(self._pending_checks.discard)
+
+    async def reconcile(self, pool, quote: dict) -> List[dict]:
+        """
+        Pedir a SAP el precio de cada línea cotizada con precios en memoria
+
+        Una diferencia indica precios desactualizados (o reglas que el motor
+        local no cubre): se registra y se adelanta el refresco.
+
+        Returns:
+            list: Diferencias encontradas (ItemCode, precio local y de SAP)
+        """
+        try:
+            with deadline_scope(RECONCILE_TIMEOUT):
+                mismatches = await self._compare_with_sap(pool, quote)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.checks["error"] += 1
+            SAP_QUOTE_CHECKS.inc("error")
+            logger.warning("No se pudo contrastar la cotización de %s con SAP: %s", quote['CardCode'], e)
+            return []
+
+        result = "mismatch" if mismatches else "match"
+        self.checks[result] += 1
+        SAP_QUOTE_CHECKS.inc(result)
+        if mismatches:
+            logger.warning("Cotización de %s distinta de SAP, se adelanta el refresco de precios: %s",
+                           quote['CardCode'], mismatches)
+            self._refresh_now.set()
+        return mismatches
+
+    async def _compare_with_sap(self, pool, quote: dict) -> List[dict]:
+        mismatches = []
+        async with pool.acquire() as client:
+            for line in quote["DocumentLines"]:
+                if line["PriceSource"].endswith("request"):
+                    continue
+                params = {"CardCode": quote["CardCode"], "ItemCode": line["ItemCode"],
+                          "Date": quote["DocDate"], "Quantity": line["Quantity"]}
+                if quote.get("DocCurrency"):
+                    params["Currency"] = quote["DocCurrency"]
+                result = await client.make_request("POST", "/CompanyService_GetItemPrice",
+                                                   json_data={"ItemPriceParams": params}, idempotent=True)
+                sap_price = float(result.get("Price") or 0.0)
+                if abs(sap_price - line["Price"]) > PRICE_TOLERANCE:
+                    mismatches.append({"ItemCode": line["ItemCode"], "local": line["Price"],
+                                       "sap": sap_price, "sap_discount": result.get("Discount")})
+        return mismatches
+
+    async def close(self):
+        """Cancelar los contrastes en curso (antes de cerrar los pools de sesiones)"""
+        self._closed = True
+        checks = list(self._pending_checks)
+        for task in checks:
+            task.cancel()
+        await asyncio.gather(*checks, return_exceptions=True)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "items": len(self.item_prices),
+            "customers": len(self.partners),
+            "special_prices": len(self.special_prices),
+            "tax_codes": len(self.tax_rates),
+            "last_refresh": datetime.fromtimestamp(self.last_refresh, timezone.utc).isoformat()
+            if self.last_refresh else None,
+            "checks": dict(self.checks)
+        }
+
+
+def _in_period(start: Any, end: Any, on_date: date) -> bool:
+    start, end = _parse_date(start), _parse_date(end)
+    return (start is None or start <= on_date) and (end is None or on_date <= end)
+
+
+def _tax_rate(tax: dict) -> float:
+    """Tasa (%) de un SalesTaxCode, o la vigente de un VatGroup (VatGroups_Lines)"""
+    if tax.get("Rate") is not None:
+        return float(tax["Rate"])
+    today = date.today()
+    lines = [line for line in tax.get("VatGroups_Lines") or []
+             if (_parse_date(line.get("Effectivefrom")) or date.min) <= today]
+    if not lines:
+        return 0.0
+    latest = max(lines, key=lambda line: _parse_date(line.get("Effectivefrom")) or date.min)
+    return float(latest.get("Rate") or 0.0)
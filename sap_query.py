@@ -0,0 +1,394 @@
+"""
+Consultas de lectura con proyección y salida columnar compacta
+
+Las herramientas sap_query_* piden a SAP solo los campos necesarios
+($select, con un default por entidad) y limitan las filas. El resultado
+se devuelve en forma columnar: un encabezado con las columnas y luego una
+fila por línea como arreglo JSON, sin repetir nombres de campo ni
+indentación. Eso reduce la transferencia desde SAP, el costo de
+serialización y los tokens que lee el agente.
+"""
+
+import logging
+import re
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+import httpx
+
+from config import env_int
+from payload import dumps_text
+
+logger = logging.getLogger(__name__)
+
+# Nombres de propiedad OData aceptados en select (evita inyectar opciones extra)
+_FIELD_NAME = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+
+class QueryEntity:
+    """Colección consultable: endpoint, nombre y proyección por defecto"""
+
+    __slots__ = ("endpoint", "name", "default_select", "default_orderby")
+
+    def __init__(self, endpoint: str, name: str, default_select: List[str], default_orderby: str):
+        self.endpoint = endpoint
+        self.name = name
+        self.default_select = default_select
+        self.default_orderby = default_orderby
+
+
+QUERY_ENTITIES: Dict[str, QueryEntity] = {
+    "sap_query_items": QueryEntity(
+        "/Items", "Items",
+        ["ItemCode", "ItemName", "ItemsGroupCode", "QuantityOnStock", "SalesUnit", "Valid", "Frozen"],
+        "ItemCode asc"
+    ),
+    "sap_query_business_partners": QueryEntity(
+        "/BusinessPartners", "BusinessPartners",
+        ["CardCode", "CardName", "CardType", "Phone1", "EmailAddress", "Currency", "CurrentAccountBalance"],
+        "CardCode asc"
+    ),
+    "sap_query_orders": QueryEntity(
+        "/Orders", "Orders",
+        ["DocEntry", "DocNum", "CardCode", "CardName", "DocDate", "DocDueDate",
+         "DocTotal", "DocCurrency", "DocumentStatus"],
+        "DocEntry desc"
+    ),
+}
+
+
+def query_input_schema(entity: QueryEntity) -> dict:
+    """inputSchema común de las herramientas de consulta"""
+    return {
+        "type": "object",
+        "properties": {
+            "select": {
+                "type": "array",
+                "items": {"type": "string"},
+                "description": f"Campos a devolver ($select). Default: {', '.join(entity.default_select)}"
+            },
+            "filter": {
+                "type": "string",
+                "description": "Filtro OData ($filter), ej: \"CardCode eq 'C20000'\""
+            },
+            "orderby": {
+                "type": "string",
+                "description": f"Orden OData ($orderby). Default: {entity.default_orderby}"
+            },
+            "top": {
+                "type": "integer",
+                "description": "Filas máximas a devolver (default SAP_QUERY_DEFAULT_TOP, tope SAP_QUERY_MAX_ROWS)"
+            }
+        },
+        "required": []
+    }
+
+
+def resolve_select(entity: QueryEntity, select: Optional[List[str]]) -> List[str]:
+    """
+    Proyección efectiva: la pedida (sin duplicados, en orden) o la de la entidad
+
+    Raises:
+        ValueError: Si algún nombre de campo no es una propiedad OData válida
+    """
+    if not select:
+        return list(entity.default_select)
+    return _field_list(select, "select")
+
+
+def _field_list(fields, argument: str) -> List[str]:
+    if isinstance(fields, str):
+        fields = fields.split(",")
+
+    columns: List[str] = []
+    for field in fields:
+        field = str(field).strip()
+        if not _FIELD_NAME.match(field):
+            raise ValueError(f"Campo inválido en {argument}: '{field}'")
+        if field not in columns:
+            columns.append(field)
+    return columns
+
+
+def query_limit(top: Optional[int]) -> int:
+    """
+    Filas a devolver: top pedido o SAP_QUERY_DEFAULT_TOP, acotado a SAP_QUERY_MAX_ROWS
+
+    Variables de entorno:
+        SAP_QUERY_DEFAULT_TOP: Filas devueltas si no se indica top (default 50)
+        SAP_QUERY_MAX_ROWS: Máximo de filas por consulta (default 1000)
+    """
+    max_rows = env_int('SAP_QUERY_MAX_ROWS', 1000)
+    limit = int(top) if top else env_int('SAP_QUERY_DEFAULT_TOP', 50)
+    if limit < 1:
+        raise ValueError("top debe ser al menos 1")
+    return min(limit, max_rows)
+
+
+async def iter_columnar(client, entity: QueryEntity, columns: List[str], limit: int,
+                        filter_query: Optional[str] = None,
+                        orderby: Optional[str] = None) -> AsyncIterator[List[list]]:
+    """
+    Recorrer la consulta página por página como filas (listas en el orden de columns)
+
+    Se pide una fila más que limit: si llega, el resultado está truncado.
+    El llamador descarta esa fila extra; así no hace falta un $count en SAP.
+    """
+    async for page in client.iter_pages(entity.endpoint, filter_query=filter_query, select=columns,
+                                        orderby=orderby or entity.default_orderby, top=limit + 1):
+        yield [[row.get(column) for column in columns] for row in page]
+
+
+# --- Agregación ------------------------------------------------------------
+
+# Función pedida -> función de agregación OData ($apply)
+AGGREGATE_FUNCTIONS = {"sum": "sum", "avg": "average", "min": "min", "max": "max"}
+
+DEFAULT_AGGREGATES = ["count", "sum:DocTotal"]
+
+# Service Layers (URL y compañía) que rechazaron $apply: se agrega leyendo páginas
+_apply_unsupported: Set[Tuple[str, str]] = set()
+
+
+class Aggregate:
+    """Medida de una agregación: función, campo (None para count) y nombre de columna"""
+
+    __slots__ = ("function", "field", "alias")
+
+    def __init__(self, function: str, field: Optional[str]):
+        self.function = function
+        self.field = field
+        self.alias = "count" if field is None else f"{field}_{function}"
+
+    def apply_clause(self) -> str:
+        if self.field is None:
+            return f"$count as {self.alias}"
+        return f"{self.field} with {AGGREGATE_FUNCTIONS[self.function]} as {self.alias}"
+
+
+def aggregate_input_schema() -> dict:
+    """inputSchema de sap_aggregate_orders"""
+    return {
+        "type": "object",
+        "properties": {
+            "group_by": {
+                "type": "array",
+                "items": {"type": "string"},
+                "description": "Campos del encabezado por los que agrupar (ej: [\"CardCode\"]); vacío = un solo total"
+            },
+            "aggregates": {
+                "type": "array",
+                "items": {"type": "string"},
+                "description": ("Medidas: 'count' o '<función>:<campo>' con función sum, avg, min o max "
+                                f"(default: {', '.join(DEFAULT_AGGREGATES)})")
+            },
+            "filter": {
+                "type": "string",
+                "description": "Filtro OData ($filter), ej: \"DocDate ge '2025-06-01' and DocDate le '2025-06-30'\""
+            },
+            "orderby": {
+                "type": "string",
+                "description": ("Columna del resultado y dirección, ej: \"DocTotal_sum desc\" "
+                                "(default: la primera medida sobre un campo, desc)")
+            },
+            "top": {
+                "type": "integer",
+                "description": "Grupos máximos a devolver (default SAP_QUERY_DEFAULT_TOP, tope SAP_QUERY_MAX_ROWS)"
+            }
+        },
+        "required": []
+    }
+
+
+def resolve_group_by(group_by) -> List[str]:
+    """Campos de agrupación validados (vacío = total general)"""
+    return _field_list(group_by, "group_by") if group_by else []
+
+
+def resolve_aggregates(specs) -> List[Aggregate]:
+    """
+    Medidas pedidas ('count', 'sum:DocTotal', ...) sin duplicados
+
+    Raises:
+        ValueError: Si una función o un campo no son válidos
+    """
+    if not specs:
+        specs = DEFAULT_AGGREGATES
+    if isinstance(specs, str):
+        specs = specs.split(",")
+
+    aggregates: List[Aggregate] = []
+    for spec in specs:
+        function, _, field = str(spec).strip().partition(":")
+        function, field = function.strip().lower(), field.strip()
+        if function == "count" and not field:
+            aggregate = Aggregate("count", None)
+        elif function in AGGREGATE_FUNCTIONS and _FIELD_NAME.match(field):
+            aggregate = Aggregate(function, field)
+        else:
+            raise ValueError(f"Medida inválida: '{spec}' (usar count o sum/avg/min/max:<campo>)")
+        if aggregate.alias not in [a.alias for a in aggregates]:
+            aggregates.append(aggregate)
+    return aggregates
+
+
+def apply_expression(group_by: List[str], aggregates: List[Aggregate], filter_query: Optional[str] = None) -> str:
+    """$apply con filtro, agrupación y medidas, ej: filter(...)/groupby((CardCode),aggregate(...))"""
+    steps = [f"filter({filter_query})"] if filter_query else []
+    aggregate = "aggregate(" + ",".join(a.apply_clause() for a in aggregates) + ")"
+    steps.append(f"groupby(({','.join(group_by)}),{aggregate})" if group_by else aggregate)
+    return "/".join(steps)
+
+
+async def aggregate_rows(client, entity: QueryEntity, group_by: List[str], aggregates: List[Aggregate],
+                         filter_query: Optional[str] = None,
+                         on_page: Optional[Callable[[int], Awaitable[None]]] = None) -> Tuple[List[list], dict]:
+    """
+    Agrupar y sumar una colección: en SAP con $apply si el Service Layer lo
+    acepta, si no leyendo páginas proyectadas y acumulando por grupo
+
+    Variables de entorno:
+        SAP_AGGREGATE_APPLY: 0 para no intentar $apply (default 1)
+        SAP_AGGREGATE_MAX_GROUPS: Grupos máximos en memoria al agregar leyendo páginas (default 10000)
+
+    Returns:
+        tuple: (filas [grupo..., medidas...], detalle: source y rows_scanned)
+    """
+    instance = (client.base_url, getattr(client, "company_db", None))
+    if env_int('SAP_AGGREGATE_APPLY', 1) and instance not in _apply_unsupported:
+        try:
+            rows = await _aggregate_with_apply(client, entity, group_by, aggregates, filter_query)
+            return rows, {"source": "$apply"}
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code not in (400, 404, 501):
+                raise
+            apply_error = e
+        rows, scanned = await _aggregate_by_scan(client, entity, group_by, aggregates, filter_query, on_page)
+        # El mismo filtro funcionó leyendo páginas: el rechazo era de $apply
+        logger.warning("El Service Layer no acepta $apply (%s); se agrega leyendo páginas", apply_error)
+        _apply_unsupported.add(instance)
+        return rows, {"source": "scan", "rows_scanned": scanned}
+
+    rows, scanned = await _aggregate_by_scan(client, entity, group_by, aggregates, filter_query, on_page)
+    return rows, {"source": "scan", "rows_scanned": scanned}
+
+
+async def _aggregate_with_apply(client, entity: QueryEntity, group_by: List[str], aggregates: List[Aggregate],
+                                filter_query: Optional[str]) -> List[list]:
+    columns = group_by + [a.alias for a in aggregates]
+    rows = []
+    async for page in client.iter_pages(entity.endpoint, apply=apply_expression(group_by, aggregates, filter_query)):
+        rows.extend([row.get(column) for column in columns] for row in page)
+    return rows
+
+
+async def _aggregate_by_scan(client, entity: QueryEntity, group_by: List[str], aggregates: List[Aggregate],
+                             filter_query: Optional[str],
+                             on_page: Optional[Callable[[int], Awaitable[None]]] = None) -> Tuple[List[list], int]:
+    """
+    Recorrer la colección con $select de los campos necesarios y acumular por grupo
+
+    En memoria solo quedan la página actual y un acumulador por grupo: el
+    costo crece con la cantidad de grupos, no con la de filas.
+    """
+    max_groups = env_int('SAP_AGGREGATE_MAX_GROUPS', 10000)
+    measures = [a.field for a in aggregates if a.field is not None]
+    # Con solo count basta la clave de cada fila
+    select = group_by + [field for field in dict.fromkeys(measures) if field not in group_by] \
+        or entity.default_select[:1]
+    # Grupo -> [count, y por medida: acumulado, cantidad de valores]
+    groups: Dict[tuple, list] = {}
+    scanned = 0
+
+    # Un orden fijo mantiene estable la paginación por nextLink
+    async for page in client.iter_pages(entity.endpoint, filter_query=filter_query, select=select,
+                                        orderby=entity.default_orderby):
+        for row in page:
+            key = tuple(row.get(field) for field in group_by)
+            state = groups.get(key)
+            if state is None:
+                if len(groups) >= max_groups:
+                    raise ValueError(f"Más de {max_groups} grupos; agregar un filtro o agrupar por menos campos")
+                state = groups[key] = [0] + [None, 0] * len(aggregates)
+            state[0] += 1
+            for i, aggregate in enumerate(aggregates):
+                if aggregate.field is None:
+                    continue
+                value = row.get(aggregate.field)
+                if value is None:
+                    continue
+                current = state[1 + 2 * i]
+                if aggregate.function in ("sum", "avg"):
+                    state[1 + 2 * i] = (current or 0) + value
+                elif aggregate.function == "min":
+                    state[1 + 2 * i] = value if current is None or value < current else current
+                else:
+                    state[1 + 2 * i] = value if current is None or value > current else current
+                state[2 + 2 * i] += 1
+        scanned += len(page)
+        if on_page is not None:
+            await on_page(scanned)
+
+    rows = []
+    for key, state in groups.items():
+        values = []
+        for i, aggregate in enumerate(aggregates):
+            total, count = state[1 + 2 * i], state[2 + 2 * i]
+            if aggregate.field is None:
+                values.append(state[0])
+            elif aggregate.function == "avg":
+                values.append(round(total / count, 6) if count else None)
+            elif aggregate.function == "sum":
+                values.append(round(total, 6) if isinstance(total, float) else (total or 0))
+            else:
+                values.append(total)
+        rows.append(list(key) + values)
+    return rows, scanned
+
+
+def sort_groups(rows: List[list], columns: List[str], aggregates: List[Aggregate],
+                orderby: Optional[str] = None) -> List[list]:
+    """
+    Ordenar los grupos por una columna del resultado (default: la primera medida con campo, desc)
+
+    Raises:
+        ValueError: Si la columna no es parte del resultado
+    """
+    if orderby:
+        column, _, direction = orderby.strip().partition(" ")
+        descending = direction.strip().lower() == "desc"
+    else:
+        measures = [a for a in aggregates if a.field is not None] or aggregates
+        column, descending = measures[0].alias, True
+    if column not in columns:
+        raise ValueError(f"orderby debe ser una columna del resultado: {', '.join(columns)}")
+    index = columns.index(column)
+    # Los valores nulos van al final en ambas direcciones
+    present = sorted((row for row in rows if row[index] is not None), key=lambda row: row[index],
+                     reverse=descending)
+    return present + [row for row in rows if row[index] is None]
+
+
+def dumps_header(entity: QueryEntity, columns: List[str]) -> str:
+    return _dumps({"entity": entity.name, "columns": columns})
+
+
+def dumps_rows(rows: List[list]) -> str:
+    """Una fila por línea, como arreglo JSON compacto"""
+    return "\n".join(_dumps(row) for row in rows)
+
+
+def dumps_summary(count: int, truncated: bool) -> str:
+    return _dumps({"count": count, "truncated": truncated})
+
+
+def dumps_aggregate(entity: QueryEntity, group_by: List[str], columns: List[str], rows: List[list],
+                    detail: dict, groups: int) -> str:
+    """Resultado de una agregación: encabezado, un grupo por línea y resumen"""
+    header = _dumps({"entity": entity.name, "group_by": group_by, "columns": columns, "source": detail["source"]})
+    summary = _dumps({"groups": groups, "count": len(rows), "truncated": len(rows) < groups,
+                      **({"rows_scanned": detail["rows_scanned"]} if "rows_scanned" in detail else {})})
+    return "\n".join([header] + ([dumps_rows(rows)] if rows else []) + [summary])
+
+
+def _dumps(value) -> str:
+    return dumps_text(value)
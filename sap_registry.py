@@ -0,0 +1,257 @@
+"""
+Registro de pools de sesiones SAP por compañía y usuario
+
+Una sola réplica del servidor puede atender varias bases de datos de
+compañía. Cada par (CompanyDB, usuario) tiene su propio SAPSessionPool,
+que se crea la primera vez que una llamada lo pide. Para no mantener
+sesiones (licencias) abiertas en todas las compañías:
+
+- Hay como máximo SAP_REGISTRY_MAX_POOLS pools abiertos; al superar el
+  límite se cierra el usado hace más tiempo (LRU) que no tenga sesiones
+  en uso.
+- Un pool sin uso durante SAP_REGISTRY_IDLE_TIMEOUT segundos se cierra
+  (logout de sus sesiones) aunque no se haya llegado al límite.
+
+La compañía por defecto (SAP_COMPANY_DB/SAP_USERNAME/SAP_PASSWORD) nunca
+se cierra: la usan la réplica de datos maestros y el validador de órdenes.
+Las demás se configuran en SAP_COMPANIES, una lista JSON:
+
+    [{"company_db": "SBODEMO_MX", "username": "manager", "password_env": "SAP_PASSWORD_MX"}]
+
+("password" en lugar de "password_env" también se acepta). Las
+compañías se eligen por llamada con company_scope() (ver server.call_tool).
+"""
+
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from config import env_int, env_float
+from sap_client import SAPClient
+from sap_guard import SAPGuard
+from sap_pool import SAPSessionPool, close_session_store
+from session_store import SessionStore
+
+logger = logging.getLogger(__name__)
+
+# (CompanyDB, usuario) pedidos por la llamada en curso; None = compañía por defecto
+_current_company: ContextVar[Tuple[Optional[str], Optional[str]]] = ContextVar(
+    "sap_company", default=(None, None))
+
+Credentials = Tuple[str, str, str]
+CompanyKey = Tuple[str, str]
+
+
+class UnknownCompanyError(ValueError):
+    """La compañía o el usuario pedidos no están configurados"""
+
+
+@contextmanager
+def company_scope(company_db: Optional[str], username: Optional[str] = None) -> Iterator[None]:
+    """Elegir la compañía SAP de las llamadas a get() dentro del bloque"""
+    token = _current_company.set((company_db or None, username or None))
+    try:
+        yield
+    finally:
+        _current_company.reset(token)
+
+
+def current_company() -> Tuple[Optional[str], Optional[str]]:
+    return _current_company.get()
+
+
+def load_companies() -> Dict[CompanyKey, Credentials]:
+    """
+    Leer las compañías adicionales de SAP_COMPANIES
+
+    Raises:
+        ValueError: Si SAP_COMPANIES no es una lista JSON válida o falta la contraseña
+    """
+    spec = os.getenv('SAP_COMPANIES')
+    if not spec:
+        return {}
+
+    try:
+        entries = json.loads(spec)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"SAP_COMPANIES no es JSON válido: {e}")
+    if not isinstance(entries, list):
+        raise ValueError("SAP_COMPANIES debe ser una lista JSON")
+
+    companies: Dict[CompanyKey, Credentials] = {}
+    for entry in entries:
+        company_db, username = entry.get("company_db"), entry.get("username")
+        password = entry.get("password") or os.getenv(entry.get("password_env") or "")
+        if not company_db or not username or not password:
+            raise ValueError(f"SAP_COMPANIES: se requieren company_db, username y password/password_env "
+                             f"({company_db or '?'})")
+        companies[(company_db, username)] = (company_db, username, password)
+    return companies
+
+
+class SAPPoolRegistry:
+    """
+    Pools de sesiones SAP por compañía y usuario, creados bajo demanda y cerrados por LRU
+
+    Variables de entorno:
+        SAP_COMPANIES: Compañías adicionales (lista JSON, ver el docstring del módulo)
+        SAP_REGISTRY_MAX_POOLS: Compañías con sesiones abiertas a la vez (default 4)
+        SAP_REGISTRY_IDLE_TIMEOUT: Segundos sin uso antes de cerrar las sesiones de una compañía (default 900)
+    """
+
+    def __init__(self, companies: Optional[Dict[CompanyKey, Credentials]] = None,
+                 max_pools: Optional[int] = None,
+                 idle_timeout: Optional[float] = None,
+                 pool_factory: Optional[Callable[[Optional[Credentials]], SAPSessionPool]] = None,
+                 guard: Optional[SAPGuard] = None):
+        self.max_pools = max(1, max_pools if max_pools is not None else env_int('SAP_REGISTRY_MAX_POOLS', 4))
+        self.idle_timeout = idle_timeout if idle_timeout is not None else env_float('SAP_REGISTRY_IDLE_TIMEOUT', 900.0)
+
+        # La compañía del entorno es la de por defecto; sus credenciales las
+        # lee el pool (login_from_env), igual que sin registro
+        self.default: CompanyKey = (os.getenv('SAP_COMPANY_DB') or "", os.getenv('SAP_USERNAME') or "")
+        self.companies: Dict[CompanyKey, Optional[Credentials]] = {self.default: None}
+        self.companies.update(companies if companies is not None else load_companies())
+
+        # Todas las compañías viven en el mismo Service Layer: un solo guard y un solo almacén
+        self.guard = guard if guard is not None else SAPGuard()
+        self.store = SessionStore.from_env()
+        self._pool_factory = pool_factory or (
+            lambda credentials: SAPSessionPool(credentials=credentials, guard=self.guard, store=self.store))
+
+        # Orden de uso: el primero es el menos usado recientemente
+        self._pools: "OrderedDict[CompanyKey, SAPSessionPool]" = OrderedDict()
+        self._last_used: Dict[CompanyKey, float] = {}
+        self._closing: List[asyncio.Task] = []
+        self._maintenance_task: Optional[asyncio.Task] = None
+
+    def resolve(self, company_db: Optional[str] = None, username: Optional[str] = None) -> CompanyKey:
+        """
+        Clave (CompanyDB, usuario) configurada para lo pedido
+
+        Sin usuario se usa el de la compañía por defecto si coincide, o el
+        primero configurado para esa compañía.
+
+        Raises:
+            UnknownCompanyError: Si no hay credenciales para esa compañía/usuario
+        """
+        if not company_db or (company_db == self.default[0] and username in (None, self.default[1])):
+            return self.default
+
+        for key in self.companies:
+            if key[0] == company_db and (username is None or key[1] == username):
+                return key
+
+        who = f"{company_db} (usuario {username})" if username else company_db
+        raise UnknownCompanyError(f"Compañía SAP no configurada: {who}")
+
+    def get(self, company_db: Optional[str] = None, username: Optional[str] = None) -> SAPSessionPool:
+        """
+        Pool de la compañía pedida (o la de company_scope), creándolo si hace falta
+
+        Raises:
+            UnknownCompanyError: Si la compañía no está configurada
+        """
+        if company_db is None and username is None:
+            company_db, username = current_company()
+        key = self.resolve(company_db, username)
+
+        pool = self._pools.get(key)
+        if pool is None:
+            pool = self._pool_factory(self.companies[key])
+            self._pools[key] = pool
+            logger.info("Pool de sesiones SAP para la compañía %s (usuario %s)", key[0], key[1])
+            self._evict_over_limit(keep=key)
+        self._pools.move_to_end(key)
+        self._last_used[key] = time.monotonic()
+        self._ensure_maintenance()
+        return pool
+
+    @property
+    def default_pool(self) -> SAPSessionPool:
+        return self.get(*self.default)
+
+    @property
+    def pools(self) -> Dict[CompanyKey, SAPSessionPool]:
+        return dict(self._pools)
+
+    def _evictable(self, key: CompanyKey) -> bool:
+        # No solo sesiones en uso: un login en curso o una llamada esperando
+        # sesión fallarían con el pool cerrado
+        return key != self.default and not self._pools[key].busy
+
+    def _evict(self, key: CompanyKey, reason: str):
+        pool = self._pools.pop(key)
+        self._last_used.pop(key, None)
+        logger.info("Cerrando sesiones SAP de la compañía %s (usuario %s): %s", key[0], key[1], reason)
+        self._closing.append(asyncio.ensure_future(pool.close()))
+        self._closing = [task for task in self._closing if not task.done()]
+
+    def _evict_over_limit(self, keep: Optional[CompanyKey] = None):
+        while len(self._pools) > self.max_pools:
+            victim = next((key for key in self._pools if key != keep and self._evictable(key)), None)
+            if victim is None:
+                # Todas en uso: se cierran cuando se liberen (mantenimiento)
+                logger.warning("%s compañías con sesiones en uso, límite %s", len(self._pools), self.max_pools)
+                return
+            self._evict(victim, "límite de compañías abiertas")
+
+    def evict_idle(self) -> int:
+        """
+        Cerrar los pools sin uso por más de idle_timeout y los que exceden max_pools
+
+        Returns:
+            int: Pools cerrados
+        """
+        before = len(self._pools)
+        now = time.monotonic()
+        for key in list(self._pools):
+            if self._evictable(key) and now - self._last_used.get(key, now) >= self.idle_timeout:
+                self._evict(key, "sin uso")
+        self._evict_over_limit()
+        return before - len(self._pools)
+
+    def _ensure_maintenance(self):
+        if self._maintenance_task is None or self._maintenance_task.done():
+            self._maintenance_task = asyncio.ensure_future(self._maintenance_loop())
+
+    async def _maintenance_loop(self):
+        interval = max(1.0, min(self.idle_timeout / 2, 60.0))
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self.evict_idle()
+            except Exception as e:
+                logger.error("Error en mantenimiento del registro de compañías SAP: %s", e)
+
+    def stats(self) -> dict:
+        return {
+            "configured": len(self.companies),
+            "open": [f"{company}/{user}" for company, user in self._pools],
+            "max_pools": self.max_pools
+        }
+
+    async def close(self):
+        """Cerrar todos los pools y, si es el caso, el almacén compartido"""
+        if self._maintenance_task is not None:
+            self._maintenance_task.cancel()
+            try:
+                await self._maintenance_task
+            except asyncio.CancelledError:
+                pass
+            self._maintenance_task = None
+
+        pools, self._pools = list(self._pools.values()), OrderedDict()
+        self._last_used.clear()
+        await asyncio.gather(*(pool.close() for pool in pools), *self._closing, return_exceptions=True)
+        self._closing = []
+
+        if self.store is not None:
+            await close_session_store(self.store, lambda: SAPClient(guard=self.guard))
+            self.store = None
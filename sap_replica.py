@@ -0,0 +1,368 @@
+"""
+Réplica local de datos maestros de SAP (Items, BusinessPartners y precios)
+
+Guarda los datos maestros en un archivo SQLite indexado por ItemCode y
+CardCode. La primera carga completa se hace paginando el Service Layer;
+después una tarea en segundo plano trae solo los registros modificados
+desde la última marca de agua (UpdateDate/UpdateTime). Como el archivo
+sobrevive a los reinicios, un contenedor nuevo carga desde él los índices
+de validación y cotización (MasterDataSource) sin recorrer SAP completo.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from config import env_float
+
+logger = logging.getLogger(__name__)
+
+# Campos que se replican de cada entidad
+ITEM_FIELDS = [
+    "ItemCode", "ItemName", "Valid", "Frozen", "SalesItem", "InventoryItem",
+    "SalesUnit", "SalesVATGroup", "ItemPrices", "UpdateDate", "UpdateTime"
+]
+BUSINESS_PARTNER_FIELDS = [
+    "CardCode", "CardName", "CardType", "Valid", "Frozen", "Currency",
+    "PriceListNum", "VatGroup", "UpdateDate", "UpdateTime"
+]
+
+# tabla -> (endpoint, clave, campos)
+ENTITIES: Dict[str, Tuple[str, str, List[str]]] = {
+    "items": ("/Items", "ItemCode", ITEM_FIELDS),
+    "business_partners": ("/BusinessPartners", "CardCode", BUSINESS_PARTNER_FIELDS)
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (
+    code TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    load_id INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS business_partners (
+    code TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    load_id INTEGER NOT NULL
+);
+DROP TABLE IF EXISTS item_prices;
+CREATE TABLE IF NOT EXISTS sync_state (
+    entity TEXT PRIMARY KEY,
+    watermark_date TEXT,
+    watermark_time TEXT,
+    load_id INTEGER NOT NULL DEFAULT 0,
+    last_full_load REAL,
+    last_sync REAL
+);
+"""
+
+
+class MasterDataReplica:
+    """
+    Réplica SQLite de datos maestros con sincronización delta
+
+    Variables de entorno:
+        SAP_REPLICA_PATH: Archivo SQLite de la réplica; sin valor la réplica está desactivada
+        SAP_REPLICA_SYNC_INTERVAL: Segundos entre sincronizaciones delta (default 300)
+        SAP_REPLICA_FULL_RELOAD_HOURS: Horas entre cargas completas, que eliminan registros borrados en SAP (default 24)
+    """
+
+    def __init__(self, path: str, sync_interval: Optional[float] = None,
+                 full_reload_hours: Optional[float] = None):
+        self.path = path
+        self.sync_interval = sync_interval if sync_interval is not None else env_float('SAP_REPLICA_SYNC_INTERVAL', 300.0)
+        self.full_reload_hours = (full_reload_hours if full_reload_hours is not None
+                                  else env_float('SAP_REPLICA_FULL_RELOAD_HOURS', 24.0))
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        # Una sola conexión: las escrituras corren en un hilo (to_thread) y
+        # las búsquedas en el event loop, serializadas por el lock
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        self._lock = threading.Lock()
+
+        # Conteos y marcas de agua para estado y health checks: se calculan al
+        # terminar cada sincronización, así consultarlos no espera el lock
+        # mientras una carga escribe páginas
+        self._counts: Dict[str, int] = {}
+        self._watermarks: Dict[str, Optional[str]] = {}
+        with self._lock:
+            self._refresh_stats()
+
+        logger.info("Réplica de datos maestros en %s: %s items, %s business partners",
+                    path, self.count('items'), self.count('business_partners'))
+
+    @classmethod
+    def from_env(cls) -> Optional["MasterDataReplica"]:
+        """Crear la réplica si SAP_REPLICA_PATH está configurada"""
+        path = os.getenv('SAP_REPLICA_PATH')
+        return cls(path) if path else None
+
+    # --- Lectura ----------------------------------------------------------
+
+    def records(self, entity: str) -> List[dict]:
+        """Todos los registros replicados de una entidad"""
+        with self._lock:
+            rows = self._conn.execute(f"SELECT data FROM {entity}").fetchall()
+        return [json.loads(r[0]) for r in rows]
+
+    def count(self, entity: str) -> int:
+        """Registros de la tabla al terminar la última sincronización"""
+        return self._counts.get(entity, 0)
+
+    def is_loaded(self) -> bool:
+        """True si todas las entidades completaron al menos una carga completa"""
+        with self._lock:
+            loaded = self._conn.execute(
+                "SELECT COUNT(*) FROM sync_state WHERE last_full_load IS NOT NULL"
+            ).fetchone()[0]
+        return loaded == len(ENTITIES)
+
+    # --- Sincronización --------------------------------------------------
+
+    def _state(self, entity: str) -> dict:
+        with self._lock:
+            row = self._read_state(entity)
+        if not row:
+            return {"watermark_date": None, "watermark_time": None, "load_id": 0,
+                    "last_full_load": None, "last_sync": None}
+        return dict(zip(("watermark_date", "watermark_time", "load_id", "last_full_load", "last_sync"), row))
+
+    def _read_state(self, entity: str) -> Optional[tuple]:
+        return self._conn.execute(
+            "SELECT watermark_date, watermark_time, load_id, last_full_load, last_sync "
+            "FROM sync_state WHERE entity = ?", (entity,)
+        ).fetchone()
+
+    def _refresh_stats(self):
+        """Recalcular conteos y marcas de agua (con el lock tomado)"""
+        self._counts = {
+            table: self._conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            for table in ENTITIES
+        }
+        watermarks = {}
+        for entity in ENTITIES:
+            row = self._read_state(entity)
+            watermarks[entity] = f"{row[0]} {row[1]}" if row and row[0] else None
+        self._watermarks = watermarks
+
+    async def sync(self, pool) -> Dict[str, int]:
+        """
+        Sincronizar todas las entidades: carga completa si no hay marca de
+        agua o venció SAP_REPLICA_FULL_RELOAD_HOURS, delta en otro caso
+
+        Las páginas se leen con pool.iter_pages, que toma una sesión por
+        página: la sincronización no retiene una sesión del pool mientras
+        escribe en el archivo.
+
+        Returns:
+            dict: Registros recibidos por entidad
+        """
+        synced = {}
+        for entity in ENTITIES:
+            state = self._state(entity)
+            full_due = (state["last_full_load"] is None or
+                        time.time() - state["last_full_load"] >= self.full_reload_hours * 3600)
+            if full_due:
+                synced[entity] = await self.full_load(pool, entity)
+            else:
+                synced[entity] = await self.delta_sync(pool, entity)
+        return synced
+
+    async def full_load(self, pool, entity: str) -> int:
+        """
+        Carga completa paginada; al terminar se eliminan los registros que
+        ya no existen en SAP
+        """
+        endpoint, key, fields = ENTITIES[entity]
+        state = self._state(entity)
+        load_id = state["load_id"] + 1
+        watermark = (state["watermark_date"], state["watermark_time"])
+        total = 0
+
+        logger.info("Réplica: carga completa de %s", endpoint)
+        async for page in pool.iter_pages(endpoint, select=fields, orderby=f"{key} asc"):
+            watermark = await asyncio.to_thread(self._upsert_page, entity, page, load_id, watermark)
+            total += len(page)
+
+        await asyncio.to_thread(self._finish_full_load, entity, load_id, watermark)
+        logger.info("Réplica: %s registros de %s cargados", total, endpoint)
+        return total
+
+    async def delta_sync(self, pool, entity: str) -> int:
+        """Traer solo los registros modificados desde la última marca de agua"""
+        endpoint, key, fields = ENTITIES[entity]
+        state = self._state(entity)
+        watermark = (state["watermark_date"], state["watermark_time"])
+        if not watermark[0]:
+            return await self.full_load(pool, entity)
+
+        # Se incluye el mismo segundo de la marca: el upsert es idempotente
+        date, at = watermark
+        filter_query = f"UpdateDate gt '{date}' or (UpdateDate eq '{date}' and UpdateTime ge '{at}')"
+        total = 0
+
+        async for page in pool.iter_pages(endpoint, filter_query=filter_query, select=fields,
+                                          orderby=f"{key} asc"):
+            watermark = await asyncio.to_thread(self._upsert_page, entity, page, state["load_id"], watermark)
+            total += len(page)
+
+        await asyncio.to_thread(self._save_watermark, entity, watermark)
+        if total:
+            logger.info("Réplica: %s registros de %s actualizados", total, endpoint)
+        return total
+
+    def _upsert_page(self, entity: str, page: List[dict], load_id: int,
+                     watermark: Tuple[Optional[str], Optional[str]]) -> Tuple[Optional[str], Optional[str]]:
+        _, key, _ = ENTITIES[entity]
+        rows = []
+        for record in page:
+            code = record.get(key)
+            if not code:
+                continue
+            rows.append((code, json.dumps(record, ensure_ascii=False), load_id))
+            watermark = max(watermark, _record_watermark(record), key=_watermark_sort_key)
+
+        with self._lock, self._conn:
+            self._conn.executemany(
+                f"INSERT INTO {entity} (code, data, load_id) VALUES (?, ?, ?) "
+                f"ON CONFLICT(code) DO UPDATE SET data = excluded.data, load_id = excluded.load_id",
+                rows
+            )
+        return watermark
+
+    def _finish_full_load(self, entity: str, load_id: int, watermark: Tuple[Optional[str], Optional[str]]):
+        now = time.time()
+        with self._lock, self._conn:
+            deleted = self._conn.execute(f"DELETE FROM {entity} WHERE load_id < ?", (load_id,)).rowcount
+            self._conn.execute(
+                "INSERT INTO sync_state (entity, watermark_date, watermark_time, load_id, last_full_load, last_sync) "
+                "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(entity) DO UPDATE SET "
+                "watermark_date = excluded.watermark_date, watermark_time = excluded.watermark_time, "
+                "load_id = excluded.load_id, last_full_load = excluded.last_full_load, last_sync = excluded.last_sync",
+                (entity, watermark[0], watermark[1], load_id, now, now)
+            )
+            self._refresh_stats()
+        if deleted:
+            logger.info("Réplica: %s registros eliminados de %s", deleted, entity)
+
+    def _save_watermark(self, entity: str, watermark: Tuple[Optional[str], Optional[str]]):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE sync_state SET watermark_date = ?, watermark_time = ?, last_sync = ? WHERE entity = ?",
+                (watermark[0], watermark[1], time.time(), entity)
+            )
+            self._refresh_stats()
+
+    async def run(self, pool):
+        """Tarea en segundo plano: sincronizar cada sync_interval segundos"""
+        while True:
+            try:
+                await self.sync(pool)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Error sincronizando réplica de datos maestros: %s", e)
+            await asyncio.sleep(self.sync_interval)
+
+    def stats(self) -> dict:
+        """Estado al terminar la última sincronización (no consulta SQLite)"""
+        return {
+            "path": self.path,
+            "items": self.count("items"),
+            "business_partners": self.count("business_partners"),
+            "watermarks": dict(self._watermarks)
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class MasterDataSource:
+    """
+    Items y clientes para los índices en memoria (validación y cotización)
+
+    Con la réplica cargada se leen de ella, sin sesiones SAP. Si no, se
+    recorre el Service Layer una sola vez para todos los consumidores, con
+    una sesión del pool por página: una carga en curso se comparte y su
+    resultado se reutiliza mientras no supere el max_age que pide cada uno.
+    """
+
+    # Campos que necesitan OrderValidator y PricingEngine
+    ITEM_FIELDS = ["ItemCode", "Valid", "Frozen", "SalesItem", "SalesVATGroup", "ItemPrices"]
+    PARTNER_FIELDS = ["CardCode", "CardType", "Valid", "Frozen", "PriceListNum", "Currency", "VatGroup"]
+
+    def __init__(self, replica: Optional[MasterDataReplica] = None):
+        self.replica = replica
+        # (time.monotonic() de la carga, items, clientes) del último recorrido de SAP
+        self._snapshot: Optional[Tuple[float, List[dict], List[dict]]] = None
+        self._loading: Optional[asyncio.Task] = None
+        self.scans = 0
+
+    async def load(self, pool, max_age: float = 0.0) -> Tuple[List[dict], List[dict]]:
+        """
+        Items y Business Partners clientes
+
+        Args:
+            pool: Pool de sesiones de la compañía (solo si hay que recorrer SAP)
+            max_age: Segundos de antigüedad aceptables de un recorrido anterior
+
+        Returns:
+            tuple: (items, business partners)
+        """
+        if self.replica is not None and await asyncio.to_thread(self.replica.is_loaded):
+            self._snapshot = None
+            items = await asyncio.to_thread(self.replica.records, "items")
+            partners = await asyncio.to_thread(self.replica.records, "business_partners")
+            return items, partners
+
+        if self._snapshot is not None and time.monotonic() - self._snapshot[0] <= max_age:
+            return self._snapshot[1], self._snapshot[2]
+
+        if self._loading is None:
+            self._loading = asyncio.ensure_future(self._scan(pool))
+        # shield: si un consumidor se cancela, la carga sigue para los demás
+        return await asyncio.shield(self._loading)
+
+    async def _scan(self, pool) -> Tuple[List[dict], List[dict]]:
+        try:
+            start = time.monotonic()
+            items = [r async for r in pool.iter_rows("/Items", select=self.ITEM_FIELDS)]
+            partners = [r async for r in pool.iter_rows("/BusinessPartners", select=self.PARTNER_FIELDS,
+                                                        filter_query="CardType eq 'cCustomer'")]
+            self.scans += 1
+            self._snapshot = (time.monotonic(), items, partners)
+            logger.info("Datos maestros recorridos en %.1fs: %d items, %d clientes",
+                        time.monotonic() - start, len(items), len(partners))
+            return items, partners
+        finally:
+            self._loading = None
+
+    async def close(self):
+        """Cancelar un recorrido en curso (antes de cerrar los pools de sesiones)"""
+        loading = self._loading
+        if loading is not None:
+            loading.cancel()
+            await asyncio.gather(loading, return_exceptions=True)
+        self._snapshot = None
+
+
+def _record_watermark(record: dict) -> Tuple[Optional[str], Optional[str]]:
+    """Marca de agua (fecha, hora) de un registro; SAP v2 devuelve fechas ISO completas"""
+    date = record.get("UpdateDate")
+    at = record.get("UpdateTime")
+    return (date[:10] if date else None, at or "00:00:00")
+
+
+def _watermark_sort_key(watermark: Tuple[Optional[str], Optional[str]]) -> Tuple[str, str]:
+    return (watermark[0] or "", watermark[1] or "")
@@ -0,0 +1,200 @@
+"""
+Validación previa de Sales Orders contra códigos de SAP
+
+Mantiene en memoria conjuntos de CardCode, ItemCode y TaxCode válidos,
+refrescados periódicamente desde la réplica local (si existe) o desde el
+Service Layer. Items y clientes se leen con MasterDataSource, una sola
+carga compartida con la cotización. Así un código inexistente o inactivo
+se rechaza al instante, sin el POST a /Orders y el rechazo lento de SAP.
+"""
+
+import asyncio
+import logging
+import os
+import time
+from typing import Dict, List, Optional, Set
+
+import httpx
+
+from config import env_float
+from sap_replica import MasterDataSource
+
+logger = logging.getLogger(__name__)
+
+
+def _is_yes(value) -> bool:
+    return value in ("tYES", "Y", True)
+
+
+def is_active_item(item: dict) -> bool:
+    """Artículo válido, no congelado y de venta"""
+    return (_is_yes(item.get("Valid", "tYES")) and not _is_yes(item.get("Frozen", "tNO"))
+            and _is_yes(item.get("SalesItem", "tYES")))
+
+
+def is_active_customer(partner: dict) -> bool:
+    """Business Partner cliente, válido y no congelado"""
+    return (partner.get("CardType", "cCustomer") == "cCustomer"
+            and _is_yes(partner.get("Valid", "tYES")) and not _is_yes(partner.get("Frozen", "tNO")))
+
+
+class OrderValidationError(ValueError):
+    """Orden rechazada por la validación previa; errors lista cada problema"""
+
+    def __init__(self, errors: List[str]):
+        super().__init__("; ".join(errors))
+        self.errors = errors
+
+
+class CodeSet:
+    """Códigos conocidos y códigos activos de una entidad"""
+
+    __slots__ = ("known", "active")
+
+    def __init__(self, known: Set[str], active: Set[str]):
+        self.known = known
+        self.active = active
+
+
+class OrderValidator:
+    """
+    Validador de Sales Orders con conjuntos de códigos en memoria
+
+    Variables de entorno:
+        SAP_VALIDATION_REFRESH_INTERVAL: Segundos entre refrescos de los conjuntos (default 600)
+        SAP_TAX_CODES_ENDPOINT: Entidad de códigos de impuesto (default /SalesTaxCodes; /VatGroups en localizaciones con IVA)
+    """
+
+    def __init__(self, master_data: Optional[MasterDataSource] = None,
+                 refresh_interval: Optional[float] = None,
+                 tax_codes_endpoint: Optional[str] = None):
+        self.master_data = master_data or MasterDataSource()
+        self.refresh_interval = (refresh_interval if refresh_interval is not None
+                                 else env_float('SAP_VALIDATION_REFRESH_INTERVAL', 600.0))
+        self.tax_codes_endpoint = tax_codes_endpoint or os.getenv('SAP_TAX_CODES_ENDPOINT', '/SalesTaxCodes')
+
+        # None mientras no se cargaron: esa verificación se omite
+        self.customers: Optional[CodeSet] = None
+        self.items: Optional[CodeSet] = None
+        self.tax_codes: Optional[CodeSet] = None
+        self.last_refresh: Optional[float] = None
+
+    # --- Carga de conjuntos ---------------------------------------------
+
+    async def refresh(self, pool, max_age: float = 0.0):
+        """
+        Recargar los conjuntos desde la réplica (si está cargada) o desde SAP
+
+        Args:
+            pool: Pool de sesiones; se toma una sesión por página
+            max_age: Segundos de antigüedad aceptables de un recorrido de SAP
+                hecho para otro consumidor (ver MasterDataSource)
+        """
+        start = time.monotonic()
+        items, partners = await self.master_data.load(pool, max_age)
+
+        self.items = CodeSet({i["ItemCode"] for i in items},
+                             {i["ItemCode"] for i in items if is_active_item(i)})
+        self.customers = CodeSet({p["CardCode"] for p in partners},
+                                 {p["CardCode"] for p in partners if is_active_customer(p)})
+
+        try:
+            taxes = [t async for t in pool.iter_rows(self.tax_codes_endpoint, select=["Code", "Inactive"])]
+            self.tax_codes = CodeSet({t["Code"] for t in taxes},
+                                     {t["Code"] for t in taxes if not _is_yes(t.get("Inactive", "tNO"))})
+        except httpx.HTTPStatusError as e:
+            logger.warning("No se pudieron cargar códigos de impuesto de %s: %s", self.tax_codes_endpoint, e)
+
+        self.last_refresh = time.time()
+        logger.info("Conjuntos de validación cargados en %.1fs: %s clientes, %s items, %s impuestos",
+                    time.monotonic() - start, len(self.customers.known), len(self.items.known),
+                    len(self.tax_codes.known) if self.tax_codes else 0)
+
+    async def run(self, pool):
+        """Tarea en segundo plano: refrescar los conjuntos periódicamente"""
+        while True:
+            try:
+                await self.refresh(pool, max_age=self.refresh_interval / 2)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Error refrescando conjuntos de validación: %s", e)
+            await asyncio.sleep(self.refresh_interval)
+
+    # --- Validación ------------------------------------------------------
+
+    async def validate(self, order: dict, client=None) -> List[str]:
+        """
+        Verificar CardCode, ItemCode y TaxCode de una orden
+
+        Un código desconocido puede haberse creado después del último
+        refresco: si se pasa un cliente, se confirma con un GET puntual antes
+        de rechazarlo (mucho más barato que el POST fallido).
+
+        Returns:
+            list: Mensajes de error; vacía si la orden es válida
+        """
+        errors: List[str] = []
+        card_code = order.get("CardCode")
+        lines = order.get("DocumentLines") or []
+
+        if self.customers is not None and card_code:
+            error = await self._check(self.customers, card_code, "CardCode", "/BusinessPartners",
+                                      ["CardCode", "CardType", "Valid", "Frozen"], is_active_customer, client,
+                                      "no es un cliente activo")
+            if error:
+                errors.append(error)
+
+        for i, line in enumerate(lines, start=1):
+            item_code = line.get("ItemCode")
+            if self.items is not None and item_code:
+                error = await self._check(self.items, item_code, "ItemCode", "/Items",
+                                          ["ItemCode", "Valid", "Frozen", "SalesItem"], is_active_item, client,
+                                          "no está activo para venta")
+                if error:
+                    errors.append(f"Línea {i}: {error}")
+
+            tax_code = line.get("TaxCode")
+            if self.tax_codes is not None and tax_code:
+                if tax_code not in self.tax_codes.known:
+                    errors.append(f"Línea {i}: TaxCode '{tax_code}' no existe")
+                elif tax_code not in self.tax_codes.active:
+                    errors.append(f"Línea {i}: TaxCode '{tax_code}' está inactivo")
+
+        return errors
+
+    async def _check(self, codes: CodeSet, code: str, field: str, endpoint: str,
+                     select: List[str], is_active, client, inactive_message: str) -> Optional[str]:
+        if code in codes.active:
+            return None
+        if code in codes.known:
+            return f"{field} '{code}' {inactive_message}"
+
+        record = await self._lookup(client, endpoint, code, select) if client is not None else None
+        if record is None:
+            return f"{field} '{code}' no existe"
+
+        codes.known.add(code)
+        if is_active(record):
+            codes.active.add(code)
+            return None
+        return f"{field} '{code}' {inactive_message}"
+
+    async def _lookup(self, client, endpoint: str, code: str, select: List[str]) -> Optional[dict]:
+        """GET puntual de una entidad por clave; None si SAP responde 404"""
+        escaped = code.replace("'", "''")
+        try:
+            return await client.make_request("GET", f"{endpoint}('{escaped}')",
+                                             params={"$select": ",".join(select)})
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code == 404:
+                return None
+            raise
+
+    def stats(self) -> Dict[str, Optional[int]]:
+        return {
+            "customers": len(self.customers.known) if self.customers else None,
+            "items": len(self.items.known) if self.items else None,
+            "tax_codes": len(self.tax_codes.known) if self.tax_codes else None,
+            "last_refresh": self.last_refresh
+        }
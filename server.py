@@ -4,52 +4,200 @@ Servidor MCP HTTP para SAP Business One con gestión de sesión persistente
 """
 
 import os
-import json
+import asyncio
 import logging
-from typing import Any, Sequence
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, List, NamedTuple, Optional, Sequence, Union
 from dotenv import load_dotenv
-from fastapi import FastAPI, Response
+from fastapi import Body, FastAPI, Request, Response
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from mcp.server import Server
 from mcp.types import Resource, Tool, TextContent, ImageContent, EmbeddedResource
-from sap_client import SAPClient
+from sap_pool import SAPSessionPool
+from sap_registry import SAPPoolRegistry, UnknownCompanyError, company_scope, current_company
+from sap_guard import ServiceUnavailableError
+from sap_replica import MasterDataReplica, MasterDataSource
+from sap_jobs import JobQueue
+from sap_validation import OrderValidator, OrderValidationError
+from sap_pricing import PricingEngine, QuoteError
+from idempotency import (IdempotencyConflictError, IdempotencyStore, IDEMPOTENCY_KEY_FIELD, idempotency_key,
+                         payload_fingerprint)
+from sap_client import validate_sales_order
+from config import env_int, env_float
+from deadlines import deadline_scope
+from logging_setup import dropped_records, setup_logging
+from payload import compress_body, dumps, dumps_text
+from mcp_stream import (SSE_MEDIA_TYPE, collect_tool_call, emit_content, report_progress, stream_tool_call,
+                        wants_event_stream)
+from metrics import (CONTENT_TYPE as METRICS_CONTENT_TYPE, LOG_RECORDS_DROPPED, REGISTRY, SAP_COMPANY_POOLS,
+                     SAP_JOB_QUEUE, SAP_POOL_SESSIONS, SAP_SESSION_AGE, TOOL_DURATION, TOOL_ERRORS,
+                     TOOLS_IN_FLIGHT)
+from sap_query import (QUERY_ENTITIES, QueryEntity, aggregate_input_schema, aggregate_rows, dumps_aggregate,
+                       dumps_header, dumps_rows, dumps_summary, iter_columnar, query_input_schema, query_limit,
+                       resolve_aggregates, resolve_group_by, resolve_select, sort_groups)
 
 # Cargar variables de entorno
 load_dotenv()
 
-# Configurar logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+# Configurar logging (cola con escritura en segundo plano, ver logging_setup)
+setup_logging()
 logger = logging.getLogger(__name__)
 
-# Variable global para cliente SAP
-sap_client = None
+# Pools de sesiones SAP por compañía (la del entorno y las de SAP_COMPANIES)
+sap_registry: Optional[SAPPoolRegistry] = None
 
-def get_sap_client():
-    """Obtener cliente SAP con gestión de sesión persistente"""
-    global sap_client
+def get_sap_registry() -> SAPPoolRegistry:
+    """Obtener el registro de pools por compañía, creándolo en el primer uso"""
+    global sap_registry
     
-    try:
-        # Si no hay cliente, crear uno nuevo
-        if sap_client is None:
-            sap_client = SAPClient()
-            logger.info("Creando nuevo cliente SAP")
-        
-        # Verificar si la sesión es válida
-        if not sap_client.is_session_valid():
-            logger.info("Sesión SAP inválida, reconectando...")
-            success = sap_client.login_from_env()
-            if not success:
-                logger.error("Error al conectar a SAP")
-                return None
-            logger.info("Sesión SAP restaurada")
-        
-        return sap_client
-        
-    except Exception as e:
-        logger.error(f"Error en get_sap_client: {e}")
-        return None
+    if sap_registry is None:
+        sap_registry = SAPPoolRegistry()
+        logger.info("Creando registro de pools de sesiones SAP")
+    
+    return sap_registry
+
+def get_sap_pool() -> SAPSessionPool:
+    """Pool de sesiones SAP de la compañía de la llamada en curso (ver company_scope)"""
+    return get_sap_registry().get()
+
+def is_default_company() -> bool:
+    return sap_registry is None or sap_registry.resolve(*current_company()) == sap_registry.default
+
+# Réplica local opcional de datos maestros (SAP_REPLICA_PATH)
+sap_replica: Optional[MasterDataReplica] = None
+
+# Items y clientes de la compañía por defecto, cargados una vez para validación y cotización
+master_data: Optional[MasterDataSource] = None
+
+# Validador de códigos de Sales Orders
+order_validator: Optional[OrderValidator] = None
+
+# Las demás compañías no tienen conjuntos cargados: la validación la hace SAP
+unloaded_validator = OrderValidator()
+
+# Motor de cotización local con precios en memoria (solo compañía por defecto)
+pricing_engine: Optional[PricingEngine] = None
+
+# Resultados recientes y creaciones en curso por clave de idempotencia
+idempotency_store = IdempotencyStore()
+
+# Cola durable de trabajos en segundo plano (SAP_JOB_QUEUE_PATH); None = modo trabajo deshabilitado
+job_queue: Optional[JobQueue] = None
+
+def get_master_data() -> MasterDataSource:
+    """Obtener la fuente de datos maestros compartida, creándola en el primer uso"""
+    global master_data
+    
+    if master_data is None:
+        master_data = MasterDataSource(sap_replica)
+    
+    return master_data
+
+def get_order_validator() -> OrderValidator:
+    """Obtener el validador de Sales Orders, creándolo en el primer uso"""
+    global order_validator
+    
+    # Los conjuntos en memoria son de la compañía por defecto
+    if not is_default_company():
+        return unloaded_validator
+    
+    if order_validator is None:
+        order_validator = OrderValidator(get_master_data())
+    
+    return order_validator
+
+def get_pricing_engine() -> PricingEngine:
+    """Obtener el motor de cotización, creándolo en el primer uso"""
+    global pricing_engine
+    
+    if pricing_engine is None:
+        pricing_engine = PricingEngine(get_master_data())
+    
+    return pricing_engine
+
+# Login inicial en SAP (ver warm_up_sap); hasta que termina /ready responde 503
+sap_warm_up: Optional[asyncio.Task] = None
+
+async def warm_up_sap():
+    """Abrir las sesiones de la compañía por defecto, reintentando hasta que SAP responda"""
+    delay = 1.0
+    while True:
+        try:
+            opened = await get_sap_registry().default_pool.warm_up()
+            logger.info("Sesiones SAP listas antes del primer request (%s nuevas)", opened)
+            return
+        except Exception as e:
+            logger.warning("SAP no disponible al arrancar (%s), reintento en %.0fs", e, delay)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30.0)
+
+async def after_warm_up(warm_up: asyncio.Task, run: Callable[..., Awaitable], *args: Any):
+    """Empezar una tarea de fondo con la sesión inicial ya abierta, sin otro login en paralelo"""
+    await warm_up
+    await run(*args)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Ciclo de vida de la aplicación: login inicial, réplica de datos maestros y cierre de sesiones SAP"""
+    global sap_registry, sap_replica, master_data, order_validator, pricing_engine, sap_warm_up, job_queue
+    
+    # El catálogo de herramientas se serializa antes del primer tools/list
+    tool_catalog()
+    
+    sap_warm_up = asyncio.create_task(warm_up_sap())
+    background_tasks = [sap_warm_up]
+    sap_replica = MasterDataReplica.from_env()
+    if sap_replica is not None:
+        background_tasks.append(asyncio.create_task(
+            after_warm_up(sap_warm_up, sap_replica.run, get_sap_registry().default_pool)))
+    
+    # Validación y cotización comparten un solo recorrido de Items y clientes
+    master_data = MasterDataSource(sap_replica)
+    order_validator = OrderValidator(master_data)
+    background_tasks.append(asyncio.create_task(
+        after_warm_up(sap_warm_up, order_validator.run, get_sap_registry().default_pool)))
+    
+    pricing_engine = PricingEngine(master_data)
+    background_tasks.append(asyncio.create_task(
+        after_warm_up(sap_warm_up, pricing_engine.run, get_sap_registry().default_pool)))
+    
+    # Los trabajos pendientes de una ejecución anterior se retoman al arrancar
+    job_queue = JobQueue.from_env(dedupe_ttl=idempotency_store.ttl)
+    if job_queue is not None:
+        background_tasks.append(asyncio.create_task(job_queue.heartbeat_loop()))
+        background_tasks.append(asyncio.create_task(
+            after_warm_up(sap_warm_up, job_queue.run, execute_job_orders)))
+    
+    yield
+    
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    sap_warm_up = None
+    
+    if job_queue is not None:
+        job_queue.close()
+        job_queue = None
+    
+    # Los contrastes de cotizaciones usan sesiones del pool: terminan antes de cerrarlo
+    if pricing_engine is not None:
+        await pricing_engine.close()
+        pricing_engine = None
+    
+    if master_data is not None:
+        await master_data.close()
+        master_data = None
+    
+    if sap_replica is not None:
+        sap_replica.close()
+        sap_replica = None
+    
+    if sap_registry is not None:
+        logger.info("Cerrando pools de sesiones SAP...")
+        await sap_registry.close()
+        sap_registry = None
 
 # Crear servidor MCP
 mcp_server = Server("sap-mcp-server")
@@ -58,13 +206,100 @@ mcp_server = Server("sap-mcp-server")
 app = FastAPI(
     title="SAP Business One MCP Server",
     description="Servidor MCP para conectar con SAP Business One Service Layer API",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
-@mcp_server.list_tools()
-async def handle_list_tools() -> list[Tool]:
-    """Listar herramientas disponibles"""
-    return [
+# Código JSON-RPC (rango de errores del servidor) para "SAP no disponible, reintentar"
+SERVICE_UNAVAILABLE_CODE = -32001
+
+# Argumentos comunes a todas las herramientas para elegir la compañía SAP
+# (también se pueden enviar como headers X-SAP-Company / X-SAP-User)
+COMPANY_ARGUMENTS = {
+    "company_db": {
+        "type": "string",
+        "description": "Base de datos de compañía SAP (opcional, default la configurada en SAP_COMPANY_DB)"
+    },
+    "sap_username": {
+        "type": "string",
+        "description": "Usuario SAP de esa compañía (opcional)"
+    }
+}
+
+# Modo trabajo de las herramientas de creación (ver sap_jobs)
+BACKGROUND_ARGUMENT = {
+    "background": {
+        "type": "boolean",
+        "description": ("Si es true, encolar la creación y devolver un job_id de inmediato; "
+                        "el avance y los resultados se consultan con sap_job_status (opcional)")
+    }
+}
+
+# Schema de una Sales Order, compartido por las herramientas de creación
+SALES_ORDER_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "CardCode": {
+            "type": "string",
+            "description": "Código del cliente (Business Partner)"
+        },
+        "DocDueDate": {
+            "type": "string",
+            "description": "Fecha de vencimiento (formato YYYYMMDD)"
+        },
+        "DocCurrency": {
+            "type": "string",
+            "description": "Moneda del documento (ej: USD, EUR)"
+        },
+        "DocRate": {
+            "type": "number",
+            "description": "Tasa de cambio"
+        },
+        "DocDate": {
+            "type": "string",
+            "description": "Fecha del documento (formato YYYYMMDD, opcional; define los precios vigentes)"
+        },
+        "DiscountPercent": {
+            "type": "number",
+            "description": "Descuento del documento en % antes de impuestos (opcional)"
+        },
+        "DocumentLines": {
+            "type": "array",
+            "description": "Líneas de productos/servicios",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "ItemCode": {
+                        "type": "string",
+                        "description": "Código del artículo"
+                    },
+                    "Quantity": {
+                        "type": "string",
+                        "description": "Cantidad"
+                    },
+                    "TaxCode": {
+                        "type": "string",
+                        "description": "Código de impuesto (opcional)"
+                    },
+                    "UnitPrice": {
+                        "type": "string",
+                        "description": "Precio unitario"
+                    },
+                    "DiscountPercent": {
+                        "type": "string",
+                        "description": "Descuento de la línea en % (opcional)"
+                    }
+                },
+                "required": ["ItemCode", "Quantity"]
+            }
+        }
+    },
+    "required": ["CardCode", "DocumentLines"]
+}
+
+def build_tools() -> List[Tool]:
+    """Armar las definiciones de las herramientas (una sola vez, ver tool_catalog)"""
+    tools = [
         Tool(
             name="sap_connect",
             description="Conectar a SAP Business One",
@@ -87,74 +322,322 @@ async def handle_list_tools() -> list[Tool]:
             name="sap_create_sales_order",
             description="Crear una nueva Sales Order en SAP Business One",
             inputSchema={
-                "type": "object",
+                **SALES_ORDER_SCHEMA,
                 "properties": {
-                    "CardCode": {
+                    **SALES_ORDER_SCHEMA["properties"],
+                    IDEMPOTENCY_KEY_FIELD: {
                         "type": "string",
-                        "description": "Código del cliente (Business Partner)"
+                        "description": ("Clave de idempotencia (opcional). Un reintento con la misma clave "
+                                        "devuelve la orden original; sin clave se usa un hash del contenido")
                     },
-                    "DocDueDate": {
-                        "type": "string",
-                        "description": "Fecha de vencimiento (formato YYYYMMDD)"
+                    **BACKGROUND_ARGUMENT
+                }
+            }
+        ),
+        Tool(
+            name="sap_create_sales_orders_bulk",
+            description="Crear varias Sales Orders en SAP Business One en lotes $batch",
+            inputSchema={
+                "type": "object",
+                "properties": {
+                    "orders": {
+                        "type": "array",
+                        "description": "Sales Orders a crear (misma estructura que sap_create_sales_order)",
+                        "items": SALES_ORDER_SCHEMA
                     },
-                    "DocCurrency": {
-                        "type": "string",
-                        "description": "Moneda del documento (ej: USD, EUR)"
+                    "batch_size": {
+                        "type": "integer",
+                        "description": "Órdenes por request $batch (opcional, default 50)"
                     },
-                    "DocRate": {
-                        "type": "number",
-                        "description": "Tasa de cambio"
+                    "atomic": {
+                        "type": "boolean",
+                        "description": "Si es true, cada lote se confirma completo o no se confirma (opcional)"
                     },
-                    "DocumentLines": {
-                        "type": "array",
-                        "description": "Líneas de productos/servicios",
-                        "items": {
-                            "type": "object",
-                            "properties": {
-                                "ItemCode": {
-                                    "type": "string",
-                                    "description": "Código del artículo"
-                                },
-                                "Quantity": {
-                                    "type": "string",
-                                    "description": "Cantidad"
-                                },
-                                "TaxCode": {
-                                    "type": "string",
-                                    "description": "Código de impuesto (opcional)"
-                                },
-                                "UnitPrice": {
-                                    "type": "string",
-                                    "description": "Precio unitario"
-                                }
-                            },
-                            "required": ["ItemCode", "Quantity"]
-                        }
+                    IDEMPOTENCY_KEY_FIELD: {
+                        "type": "string",
+                        "description": ("Clave de idempotencia del trabajo con background (opcional). Un "
+                                        "reintento con la misma clave devuelve el mismo job_id; sin clave se "
+                                        "usa un hash del contenido")
+                    },
+                    **BACKGROUND_ARGUMENT
+                },
+                "required": ["orders"]
+            }
+        ),
+        Tool(
+            name="sap_quote_order",
+            description=("Cotizar una Sales Order sin crearla: precio, descuento e impuesto por línea y "
+                         "DocTotal, calculados con las listas de precios en memoria (no crea documentos)"),
+            inputSchema=SALES_ORDER_SCHEMA
+        ),
+        Tool(
+            name="sap_job_status",
+            description=("Consultar el avance de un trabajo en segundo plano (creaciones con background) "
+                         "y el resultado de cada documento"),
+            inputSchema={
+                "type": "object",
+                "properties": {
+                    "job_id": {
+                        "type": "string",
+                        "description": "Identificador devuelto al encolar el trabajo"
+                    }
+                },
+                "required": ["job_id"]
+            }
+        ),
+        Tool(
+            name="sap_query_items",
+            description=("Consultar Items de SAP. Devuelve un encabezado con las columnas y una fila "
+                         "por línea como arreglo JSON; pedir solo los campos necesarios en select"),
+            inputSchema=query_input_schema(QUERY_ENTITIES["sap_query_items"])
+        ),
+        Tool(
+            name="sap_query_business_partners",
+            description=("Consultar Business Partners de SAP. Devuelve un encabezado con las columnas y "
+                         "una fila por línea como arreglo JSON; pedir solo los campos necesarios en select"),
+            inputSchema=query_input_schema(QUERY_ENTITIES["sap_query_business_partners"])
+        ),
+        Tool(
+            name="sap_query_orders",
+            description=("Consultar Sales Orders de SAP. Devuelve un encabezado con las columnas y una "
+                         "fila por línea como arreglo JSON; pedir solo los campos necesarios en select"),
+            inputSchema=query_input_schema(QUERY_ENTITIES["sap_query_orders"])
+        ),
+        Tool(
+            name="sap_get_order_detail",
+            description=("Obtener una Sales Order con los datos de su cliente y de cada artículo de sus líneas "
+                         "(en dos requests a SAP como máximo, sin importar la cantidad de líneas)"),
+            inputSchema={
+                "type": "object",
+                "properties": {
+                    "doc_entry": {
+                        "type": "integer",
+                        "description": "DocEntry de la Sales Order"
                     }
                 },
-                "required": ["CardCode", "DocumentLines"]
+                "required": ["doc_entry"]
             }
+        ),
+        Tool(
+            name="sap_aggregate_orders",
+            description=("Agrupar Sales Orders y calcular count/sum/avg/min/max (ej: ventas por cliente del mes) "
+                         "en SAP, sin traer las órdenes; devuelve un grupo por línea como arreglo JSON"),
+            inputSchema=aggregate_input_schema()
         )
     ]
+    for tool in tools:
+        tool.inputSchema = {**tool.inputSchema,
+                            "properties": {**tool.inputSchema.get("properties", {}), **COMPANY_ARGUMENTS}}
+    return tools
+
+class ToolCatalog(NamedTuple):
+    """Herramientas disponibles y el resultado de tools/list ya serializado"""
+    tools: List[Tool]
+    names: frozenset
+    result: dict
+    payload: bytes
+
+_tool_catalog: Optional[ToolCatalog] = None
+
+def tool_catalog() -> ToolCatalog:
+    """
+    Catálogo de herramientas, armado y serializado en el primer uso
+    
+    Las definiciones no cambian en la vida del proceso: tools/list responde
+    siempre los mismos bytes en lugar de reconstruir y serializar los modelos.
+    """
+    global _tool_catalog
+    
+    if _tool_catalog is None:
+        tools = build_tools()
+        result = {"tools": [tool.model_dump() for tool in tools]}
+        _tool_catalog = ToolCatalog(
+            tools=tools,
+            names=frozenset(tool.name for tool in tools),
+            result=result,
+            payload=dumps(result)
+        )
+    
+    return _tool_catalog
+
+@mcp_server.list_tools()
+async def handle_list_tools() -> list[Tool]:
+    """Listar herramientas disponibles"""
+    return tool_catalog().tools
+
+async def handle_query_tool(entity: QueryEntity, arguments: dict) -> list[TextContent]:
+    """
+    Ejecutar una herramienta sap_query_*
+    
+    El encabezado y cada página de filas se emiten como bloques de contenido
+    apenas llegan de SAP (en streaming no se acumula el resultado); el
+    bloque devuelto al final resume cuántas filas hubo y si se truncó.
+    """
+    try:
+        columns = resolve_select(entity, arguments.get("select"))
+        limit = query_limit(arguments.get("top"))
+    except (TypeError, ValueError) as e:
+        return [TextContent(
+            type="text",
+            text=f"Consulta inválida: {str(e)}"
+        )]
+    
+    count = 0
+    truncated = False
+    try:
+        async with get_sap_pool().acquire() as client:
+            await emit_content(TextContent(type="text", text=dumps_header(entity, columns)))
+            
+            async for rows in iter_columnar(client, entity, columns, limit,
+                                            arguments.get("filter"), arguments.get("orderby")):
+                # La fila extra pedida a SAP solo indica que hay más resultados
+                if count + len(rows) > limit:
+                    rows = rows[:limit - count]
+                    truncated = True
+                if rows:
+                    count += len(rows)
+                    await emit_content(TextContent(type="text", text=dumps_rows(rows)))
+                    await report_progress(count, limit)
+    except ConnectionError:
+        return [TextContent(
+            type="text",
+            text="No se pudo conectar a SAP"
+        )]
+    except ServiceUnavailableError:
+        raise
+    except Exception as e:
+        return [TextContent(
+            type="text",
+            text=f"Error consultando {entity.name}: {str(e)}"
+        )]
+    
+    return [TextContent(
+        type="text",
+        text=dumps_summary(count, truncated)
+    )]
+
+async def handle_aggregate_tool(arguments: dict) -> list[TextContent]:
+    """
+    Ejecutar sap_aggregate_orders
+    
+    La agrupación se hace en SAP con $apply cuando el Service Layer lo
+    acepta; si no, se leen páginas con $select de los campos necesarios
+    acumulando por grupo (ver sap_query.aggregate_rows).
+    """
+    entity = QUERY_ENTITIES["sap_query_orders"]
+    try:
+        group_by = resolve_group_by(arguments.get("group_by"))
+        aggregates = resolve_aggregates(arguments.get("aggregates"))
+        limit = query_limit(arguments.get("top"))
+        columns = group_by + [a.alias for a in aggregates]
+        sort_groups([], columns, aggregates, arguments.get("orderby"))
+    except (TypeError, ValueError) as e:
+        return [TextContent(
+            type="text",
+            text=f"Consulta inválida: {str(e)}"
+        )]
+    
+    async def progress(scanned: int):
+        await report_progress(scanned, None, f"{scanned} Sales Orders leídas")
+    
+    try:
+        async with get_sap_pool().acquire() as client:
+            rows, detail = await aggregate_rows(client, entity, group_by, aggregates,
+                                                arguments.get("filter"), on_page=progress)
+    except ConnectionError:
+        return [TextContent(
+            type="text",
+            text="No se pudo conectar a SAP"
+        )]
+    except ServiceUnavailableError:
+        raise
+    except Exception as e:
+        return [TextContent(
+            type="text",
+            text=f"Error agregando {entity.name}: {str(e)}"
+        )]
+    
+    ordered = sort_groups(rows, columns, aggregates, arguments.get("orderby"))
+    return [TextContent(
+        type="text",
+        text=dumps_aggregate(entity, group_by, columns, ordered[:limit], detail, len(rows))
+    )]
+
+async def create_validated_orders(client, orders: List[dict], batch_size: Optional[int] = None,
+                                  atomic: bool = False,
+                                  on_progress: Optional[Callable[[int, int], Awaitable[None]]] = None) -> List[dict]:
+    """
+    Crear Sales Orders en lotes $batch; las que tienen códigos inválidos no se envían a SAP
+    
+    Returns:
+        list: Un resultado por orden (ver SAPClient.create_sales_orders_bulk)
+    """
+    results: List[Optional[dict]] = [None] * len(orders)
+    pending = []
+    for index, order in enumerate(orders):
+        errors = await get_order_validator().validate(order, client)
+        if errors:
+            results[index] = {"index": index, "status": "error", "error": "; ".join(errors)}
+        else:
+            pending.append(index)
+    
+    bulk = await client.create_sales_orders_bulk(
+        [orders[i] for i in pending],
+        batch_size=batch_size,
+        atomic=atomic,
+        on_progress=on_progress
+    )
+    for index, result in zip(pending, bulk):
+        results[index] = {**result, "index": index}
+    return results
+
+async def execute_job_orders(job: dict, orders: List[dict]) -> List[dict]:
+    """Crear un lote de Sales Orders de un trabajo en segundo plano (ver sap_jobs.JobQueue)"""
+    with company_scope(job["company_db"], job["username"]):
+        async with get_sap_pool().acquire() as client:
+            return await create_validated_orders(client, orders, batch_size=len(orders),
+                                                 atomic=bool(job["options"].get("atomic")))
+
+async def submit_job(kind: str, orders: List[dict], options: dict, arguments: dict) -> list[TextContent]:
+    """Encolar una creación en segundo plano y responder con el job_id"""
+    if job_queue is None:
+        return [TextContent(
+            type="text",
+            text="El modo en segundo plano no está habilitado (configurar SAP_JOB_QUEUE_PATH)"
+        )]
+    
+    # Un reintento del mismo trabajo (misma clave o mismo contenido) devuelve el job_id original
+    company_db, username = get_sap_registry().resolve(*current_company())
+    job_id, replayed = await job_queue.submit(kind, company_db, username, orders, options,
+                                              idempotency_key(f"{kind}@{company_db}/{username}", arguments))
+    status = await job_queue.status(job_id)
+    summary = {"job_id": job_id, "status": status["status"], "total": status["total"]}
+    if replayed:
+        summary["idempotent_replay"] = True
+    
+    return [TextContent(
+        type="text",
+        text=f"Trabajo encolado (consultar con sap_job_status):\n{dumps_text(summary)}"
+    )]
 
 @mcp_server.call_tool()
 async def handle_call_tool(name: str, arguments: dict[str, Any] | None) -> list[TextContent]:
     """Ejecutar herramientas"""
-    global sap_client
     
     if name == "sap_connect":
         try:
-            client = get_sap_client()
-            if client:
+            async with get_sap_pool().acquire() as client:
                 return [TextContent(
                     type="text",
                     text=f"Conectado a SAP\nEmpresa: {client.company_db}\nSesión: {client.session_id[:20]}..."
                 )]
-            else:
-                return [TextContent(
-                    type="text",
-                    text="Error al conectar a SAP"
-                )]
+        except ConnectionError:
+            return [TextContent(
+                type="text",
+                text="Error al conectar a SAP"
+            )]
+        except ServiceUnavailableError:
+            raise
         except Exception as e:
             return [TextContent(
                 type="text",
@@ -162,10 +645,25 @@ async def handle_call_tool(name: str, arguments: dict[str, Any] | None) -> list[
             )]
     
     elif name == "sap_status":
-        if sap_client and sap_client.session_id:
+        pool = get_sap_pool() if sap_registry is not None else None
+        connected = [c for c in pool.sessions if c.session_id] if pool else []
+        if connected:
+            stats = pool.stats()
+            routes = ", ".join(f"{route}: {count}" for route, count in stats["routes"].items())
+            cache = stats["cache"]
             return [TextContent(
                 type="text",
-                text=f"Conectado\nEmpresa: {sap_client.company_db}\nSesión: {sap_client.session_id[:20]}..."
+                text=(f"Conectado\nEmpresa: {connected[0].company_db}\n"
+                      f"Sesiones: {stats['size']}/{stats['max_size']} (en uso: {stats['in_use']})\n"
+                      f"Nodos: {routes}\n"
+                      f"Caché: {cache['size']} entradas, {cache['hits']} aciertos, "
+                      f"{cache['misses']} fallos (ratio {cache['hit_ratio']})"
+                      + (f"\nRéplica: {sap_replica.count('items')} items, "
+                         f"{sap_replica.count('business_partners')} business partners"
+                         if sap_replica else "")
+                      + (f"\nAlmacén compartido: {stats['store']['sessions']} sesiones "
+                         f"({stats['store']['free']} libres), {stats['store']['workers']} workers"
+                         if stats["store"] else ""))
             )]
         else:
             return [TextContent(
@@ -175,13 +673,7 @@ async def handle_call_tool(name: str, arguments: dict[str, Any] | None) -> list[
     
     elif name == "sap_create_sales_order":
         try:
-            client = get_sap_client()
-            if not client:
-                return [TextContent(
-                    type="text",
-                    text="No se pudo conectar a SAP"
-                )]
-            
+            background = bool((arguments or {}).pop("background", False))
             if not arguments:
                 return [TextContent(
                     type="text",
@@ -201,8 +693,53 @@ async def handle_call_tool(name: str, arguments: dict[str, Any] | None) -> list[
                     text="DocumentLines es requerido y no puede estar vacío"
                 )]
             
-            # Crear la Sales Order
-            result = client.create_sales_order(arguments)
+            # Validación local de campos y valores numéricos
+            try:
+                validate_sales_order(arguments)
+            except ValueError as e:
+                return [TextContent(
+                    type="text",
+                    text=f"Sales Order inválida: {str(e)}"
+                )]
+            
+            order = {k: v for k, v in arguments.items() if k != IDEMPOTENCY_KEY_FIELD}
+            
+            if background:
+                return await submit_job("sales_order", [order], {"batch_size": 1}, arguments)
+            
+            async def create_order():
+                # Crear la Sales Order con una sesión libre del pool
+                async with get_sap_pool().acquire() as client:
+                    # Validar códigos contra los conjuntos en memoria antes del POST
+                    errors = await get_order_validator().validate(order, client)
+                    if errors:
+                        raise OrderValidationError(errors)
+                    return await client.create_sales_order(order)
+            
+            # Un reintento con la misma clave (explícita o derivada del payload)
+            # espera la creación en curso o recibe el resultado original
+            try:
+                # La misma orden en otra compañía es otra operación
+                company_db, username = get_sap_registry().resolve(*current_company())
+                result, replayed = await idempotency_store.run(
+                    idempotency_key(f"sap_create_sales_order@{company_db}/{username}", arguments), create_order,
+                    fingerprint=payload_fingerprint(arguments)
+                )
+            except IdempotencyConflictError as e:
+                return [TextContent(
+                    type="text",
+                    text=f"Sales Order rechazada: {e}"
+                )]
+            except OrderValidationError as e:
+                return [TextContent(
+                    type="text",
+                    text="Sales Order inválida:\n- " + "\n- ".join(e.errors)
+                )]
+            except ConnectionError:
+                return [TextContent(
+                    type="text",
+                    text="No se pudo conectar a SAP"
+                )]
             
             # Extraer información esencial para respuesta limpia
             if isinstance(result, dict) and "DocEntry" in result:
@@ -220,47 +757,327 @@ async def handle_call_tool(name: str, arguments: dict[str, Any] | None) -> list[
                     "DocRate": result.get("DocRate"),
                     "DocumentStatus": result.get("DocumentStatus")
                 }
+                if replayed:
+                    summary["idempotent_replay"] = True
                 
                 return [TextContent(
                     type="text",
-                    text=f"Sales Order creada exitosamente:\n{json.dumps(summary, indent=2, ensure_ascii=False)}"
+                    text=f"Sales Order creada exitosamente:\n{dumps_text(summary)}"
                 )]
             else:
                 return [TextContent(
                     type="text",
-                    text=f"Sales Order creada exitosamente:\n{json.dumps(result, indent=2, ensure_ascii=False)}"
+                    text=f"Sales Order creada exitosamente:\n{dumps_text(result)}"
                 )]
             
+        except ServiceUnavailableError:
+            
+            raise
+            
         except Exception as e:
             return [TextContent(
                 type="text",
                 text=f"Error creando Sales Order: {str(e)}"
             )]
-    
+
+    elif name == "sap_create_sales_orders_bulk":
+        try:
+            background = bool((arguments or {}).pop("background", False))
+            orders = (arguments or {}).get("orders")
+            if not orders:
+                return [TextContent(
+                    type="text",
+                    text="orders es requerido y no puede estar vacío"
+                )]
+            
+            if background:
+                return await submit_job("sales_orders_bulk", orders, {
+                    "batch_size": arguments.get("batch_size") or env_int('SAP_BATCH_SIZE', 50),
+                    "atomic": bool(arguments.get("atomic", False))
+                }, arguments)
+
+            try:
+                async with get_sap_pool().acquire() as client:
+                    async def progress(done: int, total: int):
+                        await report_progress(done, total, f"{done}/{total} Sales Orders enviadas")
+                    
+                    results = await create_validated_orders(
+                        client, orders,
+                        batch_size=arguments.get("batch_size"),
+                        atomic=bool(arguments.get("atomic", False)),
+                        on_progress=progress
+                    )
+            except ConnectionError:
+                return [TextContent(
+                    type="text",
+                    text="No se pudo conectar a SAP"
+                )]
+
+            created = sum(1 for r in results if r["status"] == "success")
+            unknown = sum(1 for r in results if r["status"] == "unknown")
+            summary = {
+                "status": "success" if created == len(results) else "partial" if created else "error",
+                "created": created,
+                "failed": len(results) - created - unknown,
+                "unknown": unknown,
+                "results": results
+            }
+
+            return [TextContent(
+                type="text",
+                text=f"Sales Orders procesadas:\n{dumps_text(summary)}"
+            )]
+
+        except ServiceUnavailableError:
+
+            raise
+
+        except Exception as e:
+            return [TextContent(
+                type="text",
+                text=f"Error creando Sales Orders: {str(e)}"
+            )]
+
+    elif name == "sap_quote_order":
+        # Las listas de precios en memoria son de la compañía por defecto
+        if not is_default_company():
+            return [TextContent(
+                type="text",
+                text="La cotización local solo está disponible para la compañía por defecto"
+            )]
+        
+        try:
+            validate_sales_order(arguments or {})
+        except ValueError as e:
+            return [TextContent(
+                type="text",
+                text=f"Sales Order inválida: {str(e)}"
+            )]
+        
+        engine = get_pricing_engine()
+        try:
+            await engine.ensure_loaded(get_sap_pool())
+        except ConnectionError:
+            return [TextContent(
+                type="text",
+                text="No se pudo conectar a SAP"
+            )]
+        except ServiceUnavailableError:
+            
+            raise
+            
+        except Exception as e:
+            # Plazo agotado o error de SAP durante la primera carga de precios
+            return [TextContent(
+                type="text",
+                text=f"Error cargando precios para cotizar: {str(e)}"
+            )]
+        
+        try:
+            quote = engine.quote(arguments)
+        except QuoteError as e:
+            return [TextContent(
+                type="text",
+                text="Cotización inválida:\n- " + "\n- ".join(e.errors)
+            )]
+        
+        engine.sample_reconcile(get_sap_pool(), quote)
+        return [TextContent(
+            type="text",
+            text=f"Cotización (sin crear documento en SAP):\n{dumps_text(quote)}"
+        )]
+
+    elif name == "sap_job_status":
+        if job_queue is None:
+            return [TextContent(
+                type="text",
+                text="El modo en segundo plano no está habilitado (configurar SAP_JOB_QUEUE_PATH)"
+            )]
+        
+        job_id = (arguments or {}).get("job_id")
+        if not job_id:
+            return [TextContent(
+                type="text",
+                text="job_id es requerido"
+            )]
+        
+        status = await job_queue.status(job_id)
+        if status is None:
+            return [TextContent(
+                type="text",
+                text=f"Trabajo no encontrado: {job_id}"
+            )]
+        
+        return [TextContent(
+            type="text",
+            text=f"Trabajo {job_id}:\n{dumps_text(status)}"
+        )]
+
+    elif name == "sap_get_order_detail":
+        doc_entry = (arguments or {}).get("doc_entry")
+        try:
+            doc_entry = int(doc_entry)
+        except (TypeError, ValueError):
+            return [TextContent(
+                type="text",
+                text="doc_entry es requerido y debe ser un número entero"
+            )]
+        
+        try:
+            async with get_sap_pool().acquire() as client:
+                order = await client.get_order_detail(doc_entry)
+        except ConnectionError:
+            return [TextContent(
+                type="text",
+                text="No se pudo conectar a SAP"
+            )]
+        except ServiceUnavailableError:
+            raise
+        except Exception as e:
+            return [TextContent(
+                type="text",
+                text=f"Error obteniendo Sales Order: {str(e)}"
+            )]
+        
+        if order is None:
+            return [TextContent(
+                type="text",
+                text=f"Sales Order no encontrada: {doc_entry}"
+            )]
+        
+        return [TextContent(
+            type="text",
+            text=f"Sales Order {doc_entry}:\n{dumps_text(order)}"
+        )]
+
+    elif name == "sap_aggregate_orders":
+        return await handle_aggregate_tool(arguments or {})
+
+    elif name in QUERY_ENTITIES:
+        return await handle_query_tool(QUERY_ENTITIES[name], arguments or {})
+
     else:
         return [TextContent(
             type="text",
             text=f"Herramienta desconocida: {name}"
         )]
 
-@app.post("/mcp")
-async def handle_mcp_request(request: dict, response: Response):
-    """Endpoint principal para manejar solicitudes MCP"""
+def tool_timeout(name: str) -> float:
+    """
+    Plazo en segundos para una llamada a herramienta
     
-    # Agregar header requerido para Microsoft Copilot Studio
-    response.headers["x-ms-agentic-protocol"] = "mcp-streamable-1.0"
+    Variables de entorno:
+        MCP_TOOL_TIMEOUT: Plazo por defecto (default 60)
+        MCP_BULK_TOOL_TIMEOUT: Plazo de sap_create_sales_orders_bulk (default 300)
+        MCP_AGGREGATE_TOOL_TIMEOUT: Plazo de sap_aggregate_orders, que sin $apply recorre
+            todas las órdenes filtradas (default 300)
+    """
+    if name == "sap_create_sales_orders_bulk":
+        return env_float('MCP_BULK_TOOL_TIMEOUT', 300.0)
+    if name == "sap_aggregate_orders":
+        return env_float('MCP_AGGREGATE_TOOL_TIMEOUT', 300.0)
+    return env_float('MCP_TOOL_TIMEOUT', 60.0)
+
+async def call_tool(name: str, arguments: dict[str, Any] | None) -> list:
+    """
+    Ejecutar una herramienta registrando latencia, errores y concurrencia
+    
+    Todas las requests a SAP de la herramienta comparten su plazo
+    (deadlines.deadline_scope): cada una se acota al tiempo restante.
+    Los argumentos company_db/sap_username eligen la compañía SAP.
+    """
+    # Solo nombres conocidos, para no crear series por nombres arbitrarios
+    label = name if name in tool_catalog().names else "unknown"
     
+    # La compañía se elige por argumentos; no forman parte de los datos de la herramienta
+    arguments = dict(arguments or {})
+    company_db = arguments.pop("company_db", None)
+    sap_username = arguments.pop("sap_username", None)
+    
+    TOOLS_IN_FLIGHT.inc()
+    start = time.perf_counter()
     try:
-        logger.info(f"Recibida solicitud MCP: {request}")
+        with deadline_scope(tool_timeout(name)), company_scope(company_db, sap_username):
+            try:
+                return await handle_call_tool(name, arguments)
+            except UnknownCompanyError as e:
+                return [TextContent(type="text", text=f"Error: {str(e)}")]
+    except Exception:
+        TOOL_ERRORS.inc(label)
+        raise
+    finally:
+        TOOLS_IN_FLIGHT.dec()
+        TOOL_DURATION.observe(time.perf_counter() - start, label)
+
+def dump_content(content: Any) -> Any:
+    """Serializar un bloque de contenido MCP (modelo pydantic o dict)"""
+    return content.model_dump() if hasattr(content, "model_dump") else content
+
+def stream_mcp_tool_call(request: dict) -> StreamingResponse:
+    """
+    Responder un tools/call como stream SSE (Streamable HTTP)
+    
+    El progressToken de params._meta habilita las notificaciones de avance
+    (y el contenido se envía al terminar); sin él, el contenido que la
+    herramienta emite se envía apenas está disponible.
+    """
+    logger.info("Solicitud MCP (streaming): %s id=%s", request.get("method"), request.get("id"))
+    logger.debug("Cuerpo de la solicitud MCP: %s", request)
+    params = request.get("params") or {}
+    name = params.get("name")
+    arguments = params.get("arguments")
+    progress_token = (params.get("_meta") or {}).get("progressToken")
+    
+    return StreamingResponse(
+        stream_tool_call(request.get("id"), progress_token,
+                         lambda: call_tool(name, arguments), dump_content, error_reply),
+        media_type=SSE_MEDIA_TYPE,
+        headers={
+            "x-ms-agentic-protocol": "mcp-streamable-1.0",
+            "Cache-Control": "no-cache",
+            # Evitar que nginx acumule el stream antes de reenviarlo
+            "X-Accel-Buffering": "no"
+        }
+    )
+
+def service_unavailable_reply(request_id: Any, error: ServiceUnavailableError) -> dict:
+    """Error JSON-RPC reintentable cuando SAP no acepta requests"""
+    return {
+        "jsonrpc": "2.0",
+        "id": request_id,
+        "error": {
+            "code": SERVICE_UNAVAILABLE_CODE,
+            "message": str(error),
+            "data": {"retriable": True, "retryAfter": round(error.retry_after, 1), "reason": error.reason}
+        }
+    }
+
+def error_reply(request_id: Any, error: Exception) -> dict:
+    """Error JSON-RPC de una solicitud que falló (el mismo con y sin streaming)"""
+    if isinstance(error, ServiceUnavailableError):
+        # SAP protegido por el circuit breaker o saturado: error reintentable
+        logger.warning("Solicitud MCP rechazada: %s", error)
+        return service_unavailable_reply(request_id, error)
+    logger.error("Error procesando solicitud MCP: %s", error)
+    return {
+        "jsonrpc": "2.0",
+        "id": request_id,
+        "error": {"code": -32603, "message": f"Error interno: {str(error)}"}
+    }
+
+async def process_mcp_message(request: dict) -> dict:
+    """Procesar un mensaje JSON-RPC individual y devolver su respuesta"""
+    try:
+        logger.info("Solicitud MCP: %s id=%s", request.get("method"), request.get("id"))
+        logger.debug("Cuerpo de la solicitud MCP: %s", request)
         
         method = request.get("method")
         
         if method == "tools/list":
-            tools = await handle_list_tools()
             return {
                 "jsonrpc": "2.0",
                 "id": request.get("id"),
-                "result": {"tools": [tool.model_dump() for tool in tools]}
+                "result": tool_catalog().result
             }
             
         elif method == "tools/call":
@@ -268,12 +1085,12 @@ async def handle_mcp_request(request: dict, response: Response):
             name = params.get("name")
             arguments = params.get("arguments")
             
-            result = await handle_call_tool(name, arguments)
+            result = await collect_tool_call(lambda: call_tool(name, arguments))
             
             return {
                 "jsonrpc": "2.0", 
                 "id": request.get("id"),
-                "result": {"content": [content.model_dump() for content in result]}
+                "result": {"content": [dump_content(content) for content in result]}
             }
             
         else:
@@ -284,12 +1101,115 @@ async def handle_mcp_request(request: dict, response: Response):
             }
             
     except Exception as e:
-        logger.error(f"Error procesando solicitud MCP: {e}")
-        return {
-            "jsonrpc": "2.0",
-            "id": request.get("id", None),
-            "error": {"code": -32603, "message": f"Error interno: {str(e)}"}
-        }
+        return error_reply(request.get("id", None), e)
+
+async def process_mcp_batch(batch: list) -> list:
+    """
+    Procesar un batch JSON-RPC 2.0
+    
+    Las entradas se ejecutan concurrentemente, hasta MCP_BATCH_CONCURRENCY a
+    la vez, y cada una recibe su propio resultado o error. Las notificaciones
+    (sin "id") no generan respuesta.
+    """
+    semaphore = asyncio.Semaphore(env_int('MCP_BATCH_CONCURRENCY', 8))
+    
+    async def run(entry: Any) -> Optional[dict]:
+        if not isinstance(entry, dict):
+            return {
+                "jsonrpc": "2.0",
+                "id": None,
+                "error": {"code": -32600, "message": "Solicitud inválida: se esperaba un objeto JSON-RPC"}
+            }
+        async with semaphore:
+            reply = await process_mcp_message(entry)
+        return reply if "id" in entry else None
+    
+    replies = await asyncio.gather(*(run(entry) for entry in batch))
+    return [reply for reply in replies if reply is not None]
+
+def mcp_json_response(http_request: Request, payload: Any) -> Response:
+    """
+    Serializar una respuesta JSON-RPC con dumps y comprimirla si el cliente
+    lo acepta y supera MCP_COMPRESS_MIN_SIZE
+    """
+    return encoded_response(http_request, dumps(payload))
+
+def encoded_response(http_request: Request, body: bytes) -> Response:
+    """Response JSON de /mcp con el Content-Encoding negociado"""
+    headers = {"x-ms-agentic-protocol": "mcp-streamable-1.0", "Vary": "Accept-Encoding"}
+    body, encoding = compress_body(body, http_request.headers.get("accept-encoding"))
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return Response(body, media_type="application/json", headers=headers)
+
+def tools_list_response(http_request: Request, request_id: Any) -> Response:
+    """Responder tools/list con el catálogo ya serializado, sin pasar por el encoder de FastAPI"""
+    body = b'{"jsonrpc":"2.0","id":' + dumps(request_id) + b',"result":' + tool_catalog().payload + b'}'
+    return encoded_response(http_request, body)
+
+def apply_company_headers(request: Union[dict, list], headers) -> None:
+    """
+    Pasar los headers X-SAP-Company / X-SAP-User a los tools/call como
+    company_db / sap_username (los argumentos explícitos tienen prioridad)
+    """
+    company_db = headers.get("x-sap-company")
+    sap_username = headers.get("x-sap-user")
+    if not company_db and not sap_username:
+        return
+    
+    for message in request if isinstance(request, list) else [request]:
+        if not isinstance(message, dict) or message.get("method") != "tools/call":
+            continue
+        params = message.get("params")
+        if not isinstance(params, dict):
+            continue
+        arguments = params.get("arguments")
+        arguments = params["arguments"] = dict(arguments) if isinstance(arguments, dict) else {}
+        if company_db:
+            arguments.setdefault("company_db", company_db)
+        if sap_username:
+            arguments.setdefault("sap_username", sap_username)
+
+@app.post("/mcp")
+async def handle_mcp_request(http_request: Request, response: Response,
+                             request: Union[dict, list] = Body(...)):
+    """Endpoint principal para manejar solicitudes MCP (objeto JSON-RPC o batch)"""
+    
+    # Agregar header requerido para Microsoft Copilot Studio
+    response.headers["x-ms-agentic-protocol"] = "mcp-streamable-1.0"
+    
+    apply_company_headers(request, http_request.headers)
+    
+    if isinstance(request, list):
+        if not request:
+            return mcp_json_response(http_request, {
+                "jsonrpc": "2.0",
+                "id": None,
+                "error": {"code": -32600, "message": "Solicitud inválida: batch vacío"}
+            })
+        
+        replies = await process_mcp_batch(request)
+        if not replies:
+            # Batch solo de notificaciones: no hay nada que responder
+            return Response(status_code=202, headers={"x-ms-agentic-protocol": "mcp-streamable-1.0"})
+        return mcp_json_response(http_request, replies)
+    
+    if request.get("method") == "tools/list":
+        logger.info("Solicitud MCP: tools/list id=%s", request.get("id"))
+        return tools_list_response(http_request, request.get("id"))
+    
+    # Un tools/call de un cliente que acepta SSE se responde en streaming
+    if request.get("method") == "tools/call" and "id" in request \
+            and wants_event_stream(http_request.headers.get("accept")):
+        # Con el circuito abierto se responde el error antes de abrir el stream
+        if sap_registry is not None:
+            try:
+                sap_registry.guard.check()
+            except ServiceUnavailableError as e:
+                return mcp_json_response(http_request, service_unavailable_reply(request.get("id"), e))
+        return stream_mcp_tool_call(request)
+    
+    return mcp_json_response(http_request, await process_mcp_message(request))
 
 @app.get("/")
 async def root():
@@ -300,31 +1220,106 @@ async def root():
         "description": "Servidor MCP para conectar con SAP Business One Service Layer API",
         "endpoints": {
             "mcp": "/mcp",
-            "health": "/health"
+            "health": "/health",
+            "ready": "/ready",
+            "metrics": "/metrics"
         }
     }
 
 @app.get("/health")
 async def health():
     """Endpoint de salud del servidor"""
-    global sap_client
     
+    pool = sap_registry.default_pool if sap_registry is not None else None
     sap_status = "disconnected"
-    if sap_client and sap_client.session_id:
+    if pool and any(c.session_id for c in pool.sessions):
         sap_status = "connected"
     
     return {
         "status": "healthy",
         "sap_connection": sap_status,
-        "timestamp": "2025-08-20T00:00:00Z"
+        "sap_cache": pool.cache.stats() if pool else None,
+        "sap_companies": sap_registry.stats() if sap_registry else None,
+        "sap_replica": sap_replica.stats() if sap_replica else None,
+        "sap_jobs": await asyncio.to_thread(job_queue.stats) if job_queue else None,
+        "sap_pricing": pricing_engine.stats() if pricing_engine else None,
+        "timestamp": datetime.now(timezone.utc).isoformat()
     }
 
+@app.get("/ready")
+async def ready():
+    """
+    Sonda de readiness: 200 solo si SAP acepta requests con la sesión de la
+    compañía por defecto (/health solo indica que el proceso responde)
+    
+    Variables de entorno:
+        SAP_READY_TIMEOUT: Plazo de la verificación en segundos (default 5)
+        SAP_READY_MAX_AGE: Una respuesta exitosa de SAP más reciente que esto
+            basta, sin request de verificación (default 30)
+    """
+    if sap_warm_up is not None and not sap_warm_up.done():
+        return JSONResponse(status_code=503, content={"status": "starting",
+                                                      "reason": "Login inicial en SAP en curso"})
+    
+    try:
+        with deadline_scope(env_float('SAP_READY_TIMEOUT', 5.0)):
+            await get_sap_registry().default_pool.check_ready(env_float('SAP_READY_MAX_AGE', 30.0))
+    except Exception as e:
+        logger.warning("Readiness: SAP no disponible: %s", e)
+        return JSONResponse(status_code=503, content={"status": "not_ready", "reason": str(e) or type(e).__name__})
+    
+    return {"status": "ready", "timestamp": datetime.now(timezone.utc).isoformat()}
+
+@app.get("/metrics")
+async def metrics():
+    """Métricas en formato de exposición de Prometheus"""
+    
+    # Estado de los pools (todas las compañías): se toma al consultar, no en cada request
+    SAP_POOL_SESSIONS.clear()
+    SAP_SESSION_AGE.clear()
+    SAP_COMPANY_POOLS.set(len(sap_registry.pools) if sap_registry is not None else 0)
+    if sap_registry is not None:
+        pools = list(sap_registry.pools.values())
+        size = sum(pool.size for pool in pools)
+        in_use = sum(pool.in_use for pool in pools)
+        SAP_POOL_SESSIONS.set(in_use, "in_use")
+        SAP_POOL_SESSIONS.set(size - in_use, "idle")
+        
+        now = time.monotonic()
+        ages = [now - c.logged_in_at for pool in pools for c in pool.sessions if c.session_id and c.logged_in_at]
+        if ages:
+            SAP_SESSION_AGE.set(round(max(ages), 3), "max")
+            SAP_SESSION_AGE.set(round(min(ages), 3), "min")
+    
+    SAP_JOB_QUEUE.clear()
+    if job_queue is not None:
+        jobs = await asyncio.to_thread(job_queue.stats)
+        SAP_JOB_QUEUE.set(jobs["pending"], "pending")
+        SAP_JOB_QUEUE.set(jobs["sending"], "sending")
+    
+    LOG_RECORDS_DROPPED.set(dropped_records())
+    
+    return PlainTextResponse(REGISTRY.render(), media_type=METRICS_CONTENT_TYPE)
+
 if __name__ == "__main__":
     logger.info("Iniciando servidor MCP HTTP para SAP...")
     logger.info("Variables de entorno cargadas:")
-    logger.info(f"  SAP_BASE_URL: {os.getenv('SAP_BASE_URL', 'No configurada')}")
-    logger.info(f"  SAP_COMPANY_DB: {os.getenv('SAP_COMPANY_DB', 'No configurada')}")
-    logger.info(f"  SAP_USERNAME: {os.getenv('SAP_USERNAME', 'No configurado')}")
+    logger.info("  SAP_BASE_URL: %s", os.getenv('SAP_BASE_URL', 'No configurada'))
+    logger.info("  SAP_COMPANY_DB: %s", os.getenv('SAP_COMPANY_DB', 'No configurada'))
+    logger.info("  SAP_USERNAME: %s", os.getenv('SAP_USERNAME', 'No configurado'))
     
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    host = os.getenv('SERVER_HOST', '0.0.0.0')
+    port = env_int('SERVER_PORT', 8000)
+    workers = env_int('SERVER_WORKERS', 1)
+    
+    if workers > 1:
+        # Los workers heredan el entorno: todos usan el mismo almacén de
+        # sesiones en lugar de hacer cada uno sus propios logins
+        if not os.getenv('SAP_SESSION_STORE_PATH'):
+            import tempfile
+            os.environ['SAP_SESSION_STORE_PATH'] = os.path.join(tempfile.gettempdir(), 'sap-mcp-sessions.db')
+        logger.info("  Workers: %s (sesiones compartidas en %s)", workers, os.environ['SAP_SESSION_STORE_PATH'])
+        uvicorn.run("server:app", host=host, port=port, workers=workers)
+    else:
+        uvicorn.run(app, host=host, port=port)
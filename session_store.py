@@ -0,0 +1,332 @@
+"""
+Almacén de sesiones SAP compartido entre procesos worker
+
+Con varios workers de uvicorn cada proceso tiene su propio pool de
+sesiones. Sin coordinación, cada uno hace sus propios logins y consume
+licencias aparte. Este almacén guarda en un archivo SQLite local las
+cookies B1SESSION/ROUTEID y la expiración de cada sesión abierta, de modo
+que los workers se las pasen en lugar de volver a hacer login:
+
+- Cada sesión en uso pertenece a un solo worker (owner): SAP procesa
+  las requests de una sesión de forma serializada, así que compartirla a
+  la vez solo agregaría espera.
+- Un worker que necesita otra sesión primero adopta una libre del almacén
+  y solo hace login si no hay ninguna vigente.
+- Las sesiones que un worker deja de usar (pool que se encoge o worker que
+  termina) vuelven al almacén para los demás, hasta SAP_SESSION_STORE_MAX_IDLE;
+  las que sobran se cierran con logout.
+- Las renovaciones y re-logins actualizan el registro, así nadie adopta
+  una sesión vieja. El uso de una sesión extiende su expiración, igual que
+  el timeout por inactividad de SAP.
+- Cada worker registra un latido periódico; las sesiones de un worker sin
+  latido por STALE_AFTER segundos quedan libres. No se usa el PID: con
+  contenedores o PIDs reciclados un proceso muerto puede parecer vivo y
+  uno vivo de otro namespace, muerto.
+- Al terminar, el último worker hace logout de todas las sesiones libres.
+
+Las transacciones usan BEGIN IMMEDIATE: SQLite serializa las escrituras
+entre procesos con su propio lock de archivo.
+"""
+
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Iterator, List, Optional
+
+from config import env_int
+
+logger = logging.getLogger(__name__)
+
+# Versión del esquema (PRAGMA user_version); las tablas de versiones
+# anteriores se descartan: las sesiones que registraban expiran solas en SAP
+SCHEMA_VERSION = 2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id TEXT PRIMARY KEY,
+    b1session TEXT NOT NULL,
+    route_id TEXT,
+    company_db TEXT NOT NULL,
+    username TEXT NOT NULL,
+    timeout_minutes INTEGER NOT NULL,
+    expires_at REAL NOT NULL,
+    owner TEXT
+);
+CREATE INDEX IF NOT EXISTS sessions_company ON sessions (company_db, username, owner);
+CREATE TABLE IF NOT EXISTS workers (
+    owner TEXT PRIMARY KEY,
+    heartbeat REAL NOT NULL
+);
+"""
+
+# Un worker sin latido por este tiempo se da por terminado
+HEARTBEAT_INTERVAL = 10.0
+STALE_AFTER = 60.0
+
+# Campos del estado de sesión que exporta SAPClient.session_state()
+SESSION_FIELDS = ("session_id", "b1session", "route_id", "company_db", "username", "timeout_minutes", "expires_at")
+
+
+class SessionStore:
+    """
+    Sesiones SAP compartidas entre los workers de un mismo host
+
+    Variables de entorno:
+        SAP_SESSION_STORE_PATH: Archivo SQLite del almacén; sin valor cada worker usa solo sus sesiones
+        SAP_SESSION_STORE_MAX_IDLE: Sesiones libres que se conservan para otros workers (default 2)
+    """
+
+    def __init__(self, path: str, max_idle: Optional[int] = None):
+        self.path = path
+        self.max_idle = max_idle if max_idle is not None else env_int('SAP_SESSION_STORE_MAX_IDLE', 2)
+        # El PID solo no identifica al proceso: se reciclan y se repiten entre contenedores
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:12]}"
+        self._heartbeat_task: Optional[asyncio.Task] = None
+        # Conteos para sap_status y health checks, recalculados en cada
+        # transacción (también el latido): leerlos no espera el lock de
+        # SQLite, que otro proceso puede tener tomado
+        self._stats = {"sessions": 0, "free": 0, "workers": 0}
+        # El archivo se abre con la primera operación, ya en un hilo: el
+        # registro y los pools crean el almacén en el event loop, y abrirlo
+        # puede esperar el lock de SQLite de otro proceso
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        """Abrir el archivo, crear el esquema y registrar este worker (con _lock tomado)"""
+        if self._conn is not None:
+            return self._conn
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        # Transacciones explícitas (isolation_level=None) para poder usar
+        # BEGIN IMMEDIATE; timeout espera el lock de otros procesos
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=10)
+        conn.row_factory = sqlite3.Row
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if conn.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+                    conn.execute("DROP TABLE IF EXISTS sessions")
+                    conn.execute("DROP TABLE IF EXISTS workers")
+                    conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+                for statement in SCHEMA.split(";"):
+                    if statement.strip():
+                        conn.execute(statement)
+                conn.execute("INSERT OR REPLACE INTO workers (owner, heartbeat) VALUES (?, ?)",
+                             (self.owner, time.time()))
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.close()
+            raise
+
+        self._conn = conn
+        logger.info("Almacén compartido de sesiones SAP en %s (worker %s)", self.path, self.owner)
+        return conn
+
+    @classmethod
+    def from_env(cls) -> Optional["SessionStore"]:
+        """Crear el almacén si SAP_SESSION_STORE_PATH está configurada"""
+        path = os.getenv('SAP_SESSION_STORE_PATH')
+        return cls(path) if path else None
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+                self._refresh_stats()
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def _refresh_stats(self):
+        total, free = self._conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(owner IS NULL), 0) FROM sessions WHERE expires_at > ?",
+            (time.time(),)
+        ).fetchone()
+        workers = self._conn.execute("SELECT COUNT(*) FROM workers").fetchone()[0]
+        self._stats = {"sessions": total, "free": free, "workers": workers}
+
+    def _reap(self, conn: sqlite3.Connection):
+        """
+        Liberar las sesiones de workers sin latido y borrar las libres expiradas
+
+        Las sesiones en uso no se borran por expiración: su dueño extiende
+        la expiración al usarlas (touch) y las quita al cerrarlas.
+        """
+        now = time.time()
+        stale = [row[0] for row in conn.execute(
+            "SELECT owner FROM workers WHERE heartbeat < ? AND owner != ?", (now - STALE_AFTER, self.owner))]
+        for owner in stale:
+            logger.info("Worker %s sin latido: se da por terminado", owner)
+        conn.execute("DELETE FROM workers WHERE heartbeat < ? AND owner != ?", (now - STALE_AFTER, self.owner))
+        released = conn.execute(
+            "UPDATE sessions SET owner = NULL WHERE owner IS NOT NULL AND owner NOT IN (SELECT owner FROM workers)"
+        ).rowcount
+        if released:
+            logger.info("%s sesiones SAP de workers terminados quedan libres", released)
+        conn.execute("DELETE FROM sessions WHERE owner IS NULL AND expires_at <= ?", (now,))
+
+    def _write(self, conn: sqlite3.Connection, state: dict, owner: Optional[str]):
+        conn.execute(
+            "INSERT OR REPLACE INTO sessions (session_id, b1session, route_id, company_db, username, "
+            "timeout_minutes, expires_at, owner) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            tuple(state[field] for field in SESSION_FIELDS) + (owner,)
+        )
+
+    # --- Latido ---
+
+    def _ensure_heartbeat(self):
+        # Arranca con la primera operación: antes este worker no es dueño de ninguna sesión
+        if self._heartbeat_task is None or self._heartbeat_task.done():
+            self._heartbeat_task = asyncio.ensure_future(self._heartbeat_loop())
+
+    def _stop_heartbeat(self):
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+            self._heartbeat_task = None
+
+    async def heartbeat(self):
+        await asyncio.to_thread(self._heartbeat)
+
+    def _heartbeat(self):
+        with self._transaction() as conn:
+            conn.execute("INSERT OR REPLACE INTO workers (owner, heartbeat) VALUES (?, ?)",
+                         (self.owner, time.time()))
+
+    async def _heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            try:
+                await self.heartbeat()
+            except Exception as e:
+                logger.error("Error registrando el latido del almacén de sesiones SAP: %s", e)
+
+    # --- Operaciones (en un hilo: el lock de SQLite puede esperar a otro proceso) ---
+
+    async def claim(self, company_db: str, username: str, min_ttl: float = 0.0) -> Optional[dict]:
+        """
+        Adoptar una sesión libre y vigente de esa compañía y usuario
+
+        Args:
+            min_ttl: Segundos de vigencia mínimos (no adoptar una sesión a punto de expirar)
+
+        Returns:
+            dict: Estado de la sesión (ver SESSION_FIELDS), o None si no hay ninguna libre
+        """
+        self._ensure_heartbeat()
+        return await asyncio.to_thread(self._claim, company_db, username, min_ttl)
+
+    def _claim(self, company_db: str, username: str, min_ttl: float) -> Optional[dict]:
+        with self._transaction() as conn:
+            self._reap(conn)
+            row = conn.execute(
+                "SELECT * FROM sessions WHERE company_db = ? AND username = ? AND owner IS NULL "
+                "AND expires_at > ? ORDER BY expires_at DESC LIMIT 1",
+                (company_db, username, time.time() + min_ttl)
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE sessions SET owner = ? WHERE session_id = ?", (self.owner, row["session_id"]))
+            return {field: row[field] for field in SESSION_FIELDS}
+
+    async def publish(self, state: dict, replaces: Optional[str] = None):
+        """Registrar una sesión de este worker (reemplazando la anterior tras un re-login)"""
+        self._ensure_heartbeat()
+        await asyncio.to_thread(self._publish, state, replaces)
+
+    def _publish(self, state: dict, replaces: Optional[str]):
+        with self._transaction() as conn:
+            if replaces and replaces != state["session_id"]:
+                conn.execute("DELETE FROM sessions WHERE session_id = ?", (replaces,))
+            self._write(conn, state, self.owner)
+
+    async def touch(self, session_id: str, expires_at: float):
+        """Extender la expiración registrada de una sesión en uso (SAP la extiende con cada request)"""
+        await asyncio.to_thread(self._touch, session_id, expires_at)
+
+    def _touch(self, session_id: str, expires_at: float):
+        with self._transaction() as conn:
+            conn.execute("UPDATE sessions SET expires_at = MAX(expires_at, ?) WHERE session_id = ?",
+                         (expires_at, session_id))
+
+    async def release(self, state: dict, replaces: Optional[str] = None) -> bool:
+        """
+        Devolver una sesión al almacén para otros workers
+
+        Returns:
+            bool: False si ya hay max_idle sesiones libres; la sesión se quita
+                del almacén y el llamador debe hacer logout
+        """
+        return await asyncio.to_thread(self._release, state, replaces)
+
+    def _release(self, state: dict, replaces: Optional[str]) -> bool:
+        with self._transaction() as conn:
+            if replaces and replaces != state["session_id"]:
+                conn.execute("DELETE FROM sessions WHERE session_id = ?", (replaces,))
+            idle = conn.execute(
+                "SELECT COUNT(*) FROM sessions WHERE company_db = ? AND username = ? AND owner IS NULL "
+                "AND session_id != ?",
+                (state["company_db"], state["username"], state["session_id"])
+            ).fetchone()[0]
+            if idle >= self.max_idle:
+                conn.execute("DELETE FROM sessions WHERE session_id = ?", (state["session_id"],))
+                return False
+            self._write(conn, state, None)
+            return True
+
+    async def remove(self, session_id: Optional[str]):
+        """Quitar una sesión cerrada o inválida"""
+        if session_id:
+            await asyncio.to_thread(self._remove, session_id)
+
+    def _remove(self, session_id: str):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+
+    async def leave(self) -> List[dict]:
+        """
+        Dar de baja este worker
+
+        Returns:
+            list: Si era el último worker vivo, las sesiones libres restantes
+                (ya quitadas del almacén) para que haga logout; si no, vacía
+        """
+        self._stop_heartbeat()
+        return await asyncio.to_thread(self._leave)
+
+    def _leave(self) -> List[dict]:
+        with self._transaction() as conn:
+            self._reap(conn)
+            conn.execute("DELETE FROM workers WHERE owner = ?", (self.owner,))
+            if conn.execute("SELECT COUNT(*) FROM workers").fetchone()[0]:
+                return []
+            rows = conn.execute("SELECT * FROM sessions WHERE owner IS NULL").fetchall()
+            conn.execute("DELETE FROM sessions WHERE owner IS NULL")
+            return [{field: row[field] for field in SESSION_FIELDS} for row in rows]
+
+    def stats(self) -> dict:
+        """Estado a la última transacción de este worker (no consulta SQLite)"""
+        return {"path": self.path, **self._stats}
+
+    def close(self):
+        self._stop_heartbeat()
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
@@ -0,0 +1,72 @@
+"""
+Fixtures comunes de las pruebas
+
+Las pruebas corren en proceso contra el Service Layer simulado
+(benchmarks/fake_service_layer.py) usando los puntos de inyección del
+código: transport de SAPClient, client_factory de SAPSessionPool,
+pool_factory de SAPPoolRegistry y clock de SAPGuard.
+"""
+
+import os
+import sys
+
+import httpx
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault("SAP_BASE_URL", "http://fake-sap/b1s/v1")
+os.environ.setdefault("SAP_COMPANY_DB", "SBODEMO")
+os.environ.setdefault("SAP_USERNAME", "manager")
+os.environ.setdefault("SAP_PASSWORD", "manager")
+
+from benchmarks.fake_service_layer import FakeConfig, create_app  # noqa: E402
+
+SAP_URL = "http://fake-sap/b1s/v1"
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+def fake_sap():
+    """Service Layer simulado sin latencia; el estado queda en fake_sap.state.service_layer"""
+    return create_app(FakeConfig(latency=0.0, items=300, business_partners=50, orders=50))
+
+
+@pytest.fixture
+def sap_transport(fake_sap):
+    return httpx.ASGITransport(app=fake_sap)
+
+
+@pytest.fixture
+async def mcp(sap_transport, monkeypatch):
+    """Cliente HTTP del servidor MCP con el registro de compañías apuntando al Service Layer simulado"""
+    import server
+    from sap_client import SAPClient
+    from sap_guard import SAPGuard
+    from sap_pool import SAPSessionPool
+    from sap_registry import SAPPoolRegistry
+
+    guard = SAPGuard()
+    monkeypatch.setattr(server, "sap_registry", SAPPoolRegistry(
+        pool_factory=lambda credentials: SAPSessionPool(
+            max_size=2, guard=guard, credentials=credentials,
+            client_factory=lambda: SAPClient(SAP_URL, transport=sap_transport, guard=guard)
+        ),
+        guard=guard
+    ))
+    try:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app), base_url="http://mcp") as client:
+            yield client
+    finally:
+        await server.sap_registry.close()
+
+
+async def call_tool(mcp, name: str, arguments: dict) -> str:
+    """Texto de la respuesta de una herramienta por /mcp (sin streaming)"""
+    response = await mcp.post("/mcp", json={"jsonrpc": "2.0", "id": 1, "method": "tools/call",
+                                           "params": {"name": name, "arguments": arguments}})
+    return response.json()["result"]["content"][-1]["text"]
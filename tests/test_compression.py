@@ -0,0 +1,89 @@
+import gzip
+
+import pytest
+
+import payload
+from payload import compress_body
+
+pytestmark = pytest.mark.anyio
+
+BODY = b'{"jsonrpc":"2.0","id":1,"result":{"content":[' + b'{"type":"text","text":"fila"},' * 200 + b'{}]}}'
+
+
+class FakeBrotli:
+    @staticmethod
+    def compress(body: bytes, quality: int) -> bytes:
+        return b"br:" + gzip.compress(body)
+
+
+@pytest.mark.parametrize("accept_encoding", ["gzip", "deflate, gzip;q=0.5", "*", "GZIP"])
+def test_gzip_when_the_client_accepts_it(accept_encoding):
+    body, encoding = compress_body(BODY, accept_encoding)
+
+    assert encoding == "gzip"
+    assert gzip.decompress(body) == BODY
+
+
+@pytest.mark.parametrize("accept_encoding", [None, "", "identity", "gzip;q=0", "deflate", "gzip;q=abc"])
+def test_identity_when_gzip_is_not_accepted(accept_encoding):
+    assert compress_body(BODY, accept_encoding) == (BODY, None)
+
+
+def test_br_is_preferred_when_installed(monkeypatch):
+    monkeypatch.setattr(payload, "brotli", FakeBrotli)
+
+    assert compress_body(BODY, "gzip, br")[1] == "br"
+    assert compress_body(BODY, "gzip, br;q=0")[1] == "gzip"
+
+
+def test_br_is_not_used_without_the_library(monkeypatch):
+    monkeypatch.setattr(payload, "brotli", None)
+
+    assert compress_body(BODY, "br") == (BODY, None)
+    assert compress_body(BODY, "br, gzip")[1] == "gzip"
+
+
+def test_bodies_below_the_threshold_are_not_compressed(monkeypatch):
+    monkeypatch.setenv("MCP_COMPRESS_MIN_SIZE", str(len(BODY) + 1))
+    assert compress_body(BODY, "gzip") == (BODY, None)
+
+    monkeypatch.setenv("MCP_COMPRESS_MIN_SIZE", str(len(BODY)))
+    assert compress_body(BODY, "gzip")[1] == "gzip"
+
+
+def test_zero_threshold_disables_compression(monkeypatch):
+    monkeypatch.setenv("MCP_COMPRESS_MIN_SIZE", "0")
+
+    assert compress_body(BODY, "gzip") == (BODY, None)
+
+
+async def test_mcp_json_response_is_compressed_when_accepted(mcp):
+    request = {"jsonrpc": "2.0", "id": 1, "method": "tools/list"}
+
+    compressed = await mcp.post("/mcp", json=request, headers={"Accept-Encoding": "gzip"})
+    plain = await mcp.post("/mcp", json=request, headers={"Accept-Encoding": "identity"})
+
+    assert compressed.headers["content-encoding"] == "gzip"
+    assert "content-encoding" not in plain.headers
+    assert compressed.headers["vary"] == plain.headers["vary"] == "Accept-Encoding"
+    assert compressed.json() == plain.json()
+    assert int(compressed.headers["content-length"]) < int(plain.headers["content-length"])
+
+
+async def test_small_mcp_response_is_not_compressed(mcp):
+    response = await mcp.post("/mcp", json={"jsonrpc": "2.0", "id": 1, "method": "ping"},
+                              headers={"Accept-Encoding": "gzip"})
+
+    assert response.status_code == 200
+    assert "content-encoding" not in response.headers
+
+
+async def test_sse_tool_call_is_not_compressed(mcp):
+    response = await mcp.post("/mcp", json={
+        "jsonrpc": "2.0", "id": 1, "method": "tools/call",
+        "params": {"name": "sap_query_items", "arguments": {"top": 200}}
+    }, headers={"Accept": "application/json, text/event-stream", "Accept-Encoding": "gzip, br"})
+
+    assert response.headers["content-type"].startswith("text/event-stream")
+    assert "content-encoding" not in response.headers
+    assert response.text.startswith("event: message\ndata: ")
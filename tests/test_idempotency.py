@@ -0,0 +1,120 @@
+import asyncio
+
+import pytest
+
+from idempotency import IdempotencyConflictError, IdempotencyStore, idempotency_key, payload_fingerprint
+
+pytestmark = pytest.mark.anyio
+
+ORDER = {"CardCode": "C00001", "DocumentLines": [{"ItemCode": "A00001", "Quantity": "1"}]}
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class CountingOperation:
+    def __init__(self, result=None, delay: float = 0.0):
+        self.calls = 0
+        self.result = result
+        self.delay = delay
+
+    async def __call__(self):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        return self.result if self.result is not None else {"DocEntry": self.calls}
+
+
+def test_derived_key_ignores_field_order_and_explicit_key_wins():
+    reordered = {"DocumentLines": ORDER["DocumentLines"], "CardCode": "C00001"}
+
+    assert idempotency_key("op", ORDER) == idempotency_key("op", reordered)
+    assert idempotency_key("op", {**ORDER, "idempotency_key": "k1"}) == "op:key:k1"
+    assert payload_fingerprint({**ORDER, "idempotency_key": "k1"}) == payload_fingerprint(ORDER)
+
+
+async def test_replay_with_same_key_returns_stored_result():
+    store = IdempotencyStore(ttl=60, clock=FakeClock())
+    operation = CountingOperation()
+
+    first, replayed_first = await store.run("k", operation, payload_fingerprint(ORDER))
+    second, replayed_second = await store.run("k", operation, payload_fingerprint(ORDER))
+
+    assert (first, replayed_first) == ({"DocEntry": 1}, False)
+    assert (second, replayed_second) == ({"DocEntry": 1}, True)
+    assert operation.calls == 1
+
+
+async def test_concurrent_calls_share_the_operation_in_flight():
+    store = IdempotencyStore(ttl=60, clock=FakeClock())
+    operation = CountingOperation(delay=0.01)
+
+    results = await asyncio.gather(*(store.run("k", operation) for _ in range(5)))
+
+    assert operation.calls == 1
+    assert [replayed for _, replayed in results].count(False) == 1
+    assert store.stats()["coalesced"] == 4
+
+
+async def test_same_key_with_different_payload_is_rejected():
+    store = IdempotencyStore(ttl=60, clock=FakeClock())
+    operation = CountingOperation()
+    await store.run("k", operation, payload_fingerprint(ORDER))
+
+    other = {**ORDER, "CardCode": "C00002"}
+    with pytest.raises(IdempotencyConflictError):
+        await store.run("k", operation, payload_fingerprint(other))
+    assert operation.calls == 1
+
+
+async def test_same_key_with_different_payload_is_rejected_while_in_flight():
+    store = IdempotencyStore(ttl=60, clock=FakeClock())
+    operation = CountingOperation(delay=0.01)
+    first = asyncio.create_task(store.run("k", operation, payload_fingerprint(ORDER)))
+    await asyncio.sleep(0)
+
+    with pytest.raises(IdempotencyConflictError):
+        await store.run("k", operation, payload_fingerprint({**ORDER, "CardCode": "C00002"}))
+    await first
+    assert operation.calls == 1
+
+
+async def test_entries_expire_after_ttl():
+    clock = FakeClock()
+    store = IdempotencyStore(ttl=60, clock=clock)
+    operation = CountingOperation()
+    await store.run("k", operation)
+
+    clock.now += 59.9
+    assert (await store.run("k", operation))[1] is True
+    clock.now += 0.1
+    result, replayed = await store.run("k", operation)
+
+    assert (result, replayed) == ({"DocEntry": 2}, False)
+    assert operation.calls == 2
+
+
+async def test_failures_are_not_stored():
+    store = IdempotencyStore(ttl=60, clock=FakeClock())
+
+    async def fail():
+        raise ConnectionError("sin SAP")
+
+    with pytest.raises(ConnectionError):
+        await store.run("k", fail)
+    result, replayed = await store.run("k", CountingOperation())
+
+    assert (result, replayed) == ({"DocEntry": 1}, False)
+
+
+async def test_oldest_entries_are_evicted_over_max_entries():
+    store = IdempotencyStore(ttl=60, max_entries=2, clock=FakeClock())
+    for key in ("a", "b", "c"):
+        await store.run(key, CountingOperation())
+
+    assert store.stats()["stored"] == 2
+    assert (await store.run("a", CountingOperation(result={"DocEntry": 9})))[1] is False
@@ -0,0 +1,71 @@
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+def query_items(request_id, top=2) -> dict:
+    return {"jsonrpc": "2.0", "id": request_id, "method": "tools/call",
+            "params": {"name": "sap_query_items", "arguments": {"top": top}}}
+
+
+async def test_batch_answers_requests_in_order_and_skips_notifications(mcp):
+    response = await mcp.post("/mcp", json=[
+        {"jsonrpc": "2.0", "id": 1, "method": "tools/list"},
+        {"jsonrpc": "2.0", "method": "tools/list"},
+        query_items(2),
+        {"jsonrpc": "2.0", "method": "tools/call",
+         "params": {"name": "sap_query_items", "arguments": {"top": 1}}},
+        query_items("tres", top=3),
+    ])
+
+    replies = response.json()
+    assert response.status_code == 200
+    assert [reply["id"] for reply in replies] == [1, 2, "tres"]
+    assert replies[0]["result"]["tools"]
+    assert '"count":2' in replies[1]["result"]["content"][-1]["text"]
+    assert '"count":3' in replies[2]["result"]["content"][-1]["text"]
+
+
+async def test_batch_reports_errors_per_entry(mcp):
+    response = await mcp.post("/mcp", json=[
+        {"jsonrpc": "2.0", "id": 1, "method": "resources/list"},
+        "no es un objeto",
+        query_items(2),
+    ])
+
+    unknown, invalid, ok = response.json()
+    assert unknown["id"] == 1 and unknown["error"]["code"] == -32601
+    assert invalid["id"] is None and invalid["error"]["code"] == -32600
+    assert ok["id"] == 2 and "result" in ok
+
+
+async def test_batch_entry_rejected_by_open_circuit_does_not_fail_the_others(mcp):
+    server.sap_registry.guard._open()
+
+    response = await mcp.post("/mcp", json=[
+        {"jsonrpc": "2.0", "id": 1, "method": "tools/list"},
+        query_items(2),
+    ])
+
+    listed, rejected = response.json()
+    assert "result" in listed
+    assert rejected["error"]["code"] == server.SERVICE_UNAVAILABLE_CODE
+    assert rejected["error"]["data"]["retriable"] is True
+
+
+async def test_empty_batch_is_invalid_request(mcp):
+    response = await mcp.post("/mcp", json=[])
+
+    assert response.json()["error"]["code"] == -32600
+
+
+async def test_batch_of_notifications_returns_202_without_body(mcp):
+    response = await mcp.post("/mcp", json=[
+        {"jsonrpc": "2.0", "method": "notifications/initialized"},
+        {"jsonrpc": "2.0", "method": "tools/list"},
+    ])
+
+    assert response.status_code == 202
+    assert response.content == b""
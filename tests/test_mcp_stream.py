@@ -0,0 +1,109 @@
+import json
+
+import pytest
+
+import server
+from mcp_stream import _current_channel, emit_content, report_progress, stream_tool_call
+from sap_guard import ServiceUnavailableError
+
+pytestmark = pytest.mark.anyio
+
+
+def parse_sse(body: str) -> list:
+    """Eventos SSE como objetos JSON (une las líneas data: de cada evento)"""
+    events = []
+    for block in body.split("\n\n"):
+        data = [line[len("data: "):] for line in block.splitlines() if line.startswith("data: ")]
+        if data:
+            events.append(json.loads("\n".join(data)))
+    return events
+
+
+async def run_stream(call, progress_token=None) -> list:
+    chunks = [chunk async for chunk in stream_tool_call(1, progress_token, call, server.dump_content,
+                                                        server.error_reply)]
+    return parse_sse(b"".join(chunks).decode("utf-8"))
+
+
+async def test_progress_after_content_reaches_client():
+    async def tool():
+        await emit_content({"type": "text", "text": "encabezado"})
+        for done in (1, 2, 3):
+            await emit_content({"type": "text", "text": f"página {done}"})
+            await report_progress(done, 3)
+        return [{"type": "text", "text": "resumen"}]
+
+    events = await run_stream(tool, progress_token="tok")
+
+    assert [e["params"]["progress"] for e in events[:-1]] == [1, 2, 3]
+    assert all(e["method"] == "notifications/progress" for e in events[:-1])
+    assert [c["text"] for c in events[-1]["result"]["content"]] == [
+        "encabezado", "página 1", "página 2", "página 3", "resumen"]
+
+
+async def test_held_content_is_flushed_at_the_limit(monkeypatch):
+    monkeypatch.setenv("MCP_STREAM_MAX_PENDING", "3")
+    held = []
+
+    async def tool():
+        for done in range(1, 11):
+            await emit_content({"type": "text", "text": f"página {done}"})
+            held.append(len(_current_channel.get()._held))
+            await report_progress(done, 10)
+        return [{"type": "text", "text": "resumen"}]
+
+    events = await run_stream(tool, progress_token="tok")
+
+    assert max(held) == 3
+    # El avance llega hasta que se llena la retención; después sale el contenido
+    assert [e["params"]["progress"] for e in events[:-1]] == [1, 2, 3]
+    assert [c["text"] for c in events[-1]["result"]["content"]] == [
+        *(f"página {done}" for done in range(1, 11)), "resumen"]
+
+
+async def test_content_streams_without_progress_token():
+    async def tool():
+        await emit_content({"type": "text", "text": "a"})
+        await report_progress(1, 1)
+        return [{"type": "text", "text": "b"}]
+
+    events = await run_stream(tool)
+
+    assert len(events) == 1
+    assert [c["text"] for c in events[0]["result"]["content"]] == ["a", "b"]
+
+
+async def test_service_unavailable_before_content_is_jsonrpc_error():
+    async def tool():
+        raise ServiceUnavailableError("circuito abierto", 5.0, "circuit_open")
+
+    [event] = await run_stream(tool, progress_token="tok")
+
+    assert event["error"]["code"] == server.SERVICE_UNAVAILABLE_CODE
+    assert event["error"]["data"]["retriable"] is True
+
+
+async def test_error_after_content_sets_is_error():
+    async def tool():
+        await emit_content({"type": "text", "text": "parcial"})
+        raise RuntimeError("falló")
+
+    [event] = await run_stream(tool)
+
+    assert event["result"]["isError"] is True
+    assert event["result"]["content"][-1]["text"] == "Error: falló"
+
+
+async def test_query_tool_reports_progress_per_page(mcp, monkeypatch):
+    monkeypatch.setenv("SAP_PAGE_SIZE", "50")
+    response = await mcp.post("/mcp", headers={"Accept": "application/json, text/event-stream"}, json={
+        "jsonrpc": "2.0", "id": 1, "method": "tools/call",
+        "params": {"name": "sap_query_items", "arguments": {"top": 200},
+                   "_meta": {"progressToken": "items"}}
+    })
+
+    events = parse_sse(response.text)
+    progress = [e["params"]["progress"] for e in events if e.get("method") == "notifications/progress"]
+    assert progress == [50, 100, 150, 200]
+    assert events[-1]["id"] == 1
+    assert '"count":200' in events[-1]["result"]["content"][-1]["text"]
@@ -0,0 +1,16 @@
+import types
+
+import pytest
+
+import logging_setup
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_metrics_expose_dropped_log_records(mcp, monkeypatch):
+    monkeypatch.setattr(logging_setup, "_queue_handler", types.SimpleNamespace(dropped=7))
+
+    response = await mcp.get("/metrics")
+
+    assert response.status_code == 200
+    assert "\nlog_records_dropped 7\n" in response.text
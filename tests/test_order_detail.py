@@ -0,0 +1,81 @@
+import pytest
+
+from sap_cache import MasterDataCache
+from sap_client import SAPClient
+
+from conftest import SAP_URL, call_tool
+
+pytestmark = pytest.mark.anyio
+
+
+async def detail_client(sap_transport) -> SAPClient:
+    client = SAPClient(SAP_URL, transport=sap_transport, cache=MasterDataCache(ttl=60))
+    assert await client.login_from_env()
+    return client
+
+
+def order_with_lines(service_layer, lines: int) -> dict:
+    return next(order for order in service_layer.orders if len(order["DocumentLines"]) >= lines)
+
+
+async def test_detail_is_assembled_from_one_batched_lookup(fake_sap, sap_transport):
+    service_layer = fake_sap.state.service_layer
+    order = order_with_lines(service_layer, 3)
+    client = await detail_client(sap_transport)
+    service_layer.reset_stats()
+
+    detail = await client.get_order_detail(order["DocEntry"])
+
+    # Un GET de la orden y un $batch con el cliente y los artículos, sin un GET por línea
+    assert service_layer.stats()["by_endpoint"] == {"GET /Orders": 1, "POST /$batch": 1}
+    assert detail["BusinessPartner"]["CardCode"] == order["CardCode"]
+    assert [line["Item"]["ItemCode"] for line in detail["DocumentLines"]] == \
+        [line["ItemCode"] for line in order["DocumentLines"]]
+    await client.aclose()
+
+
+async def test_second_detail_reads_master_data_from_the_cache(fake_sap, sap_transport):
+    service_layer = fake_sap.state.service_layer
+    order = order_with_lines(service_layer, 2)
+    client = await detail_client(sap_transport)
+    await client.get_order_detail(order["DocEntry"])
+    service_layer.reset_stats()
+
+    detail = await client.get_order_detail(order["DocEntry"])
+
+    assert service_layer.stats()["by_endpoint"] == {"GET /Orders": 1}
+    assert all(line["Item"] is not None for line in detail["DocumentLines"])
+    await client.aclose()
+
+
+async def test_line_item_missing_in_sap_is_returned_as_none(fake_sap, sap_transport):
+    service_layer = fake_sap.state.service_layer
+    order = order_with_lines(service_layer, 2)
+    missing = order["DocumentLines"][0]["ItemCode"]
+    service_layer.items = [item for item in service_layer.items if item["ItemCode"] != missing]
+    client = await detail_client(sap_transport)
+
+    detail = await client.get_order_detail(order["DocEntry"])
+
+    lines = detail["DocumentLines"]
+    assert [line["ItemCode"] for line in lines] == [line["ItemCode"] for line in order["DocumentLines"]]
+    assert [line["Item"] is None for line in lines] == [line["ItemCode"] == missing for line in lines]
+    await client.aclose()
+
+
+async def test_missing_order_returns_none(sap_transport):
+    client = await detail_client(sap_transport)
+
+    assert await client.get_order_detail(999999) is None
+    await client.aclose()
+
+
+async def test_order_detail_tool(mcp, fake_sap):
+    order = fake_sap.state.service_layer.orders[0]
+
+    found = await call_tool(mcp, "sap_get_order_detail", {"doc_entry": str(order["DocEntry"])})
+    not_found = await call_tool(mcp, "sap_get_order_detail", {"doc_entry": 999999})
+
+    assert found.startswith(f"Sales Order {order['DocEntry']}:")
+    assert '"BusinessPartner"' in found
+    assert not_found == "Sales Order no encontrada: 999999"
@@ -0,0 +1,136 @@
+import json
+
+import httpx
+import pytest
+
+from sap_client import SAPClient, _batch_operation, _parse_multipart
+
+from conftest import SAP_URL
+
+pytestmark = pytest.mark.anyio
+
+CONTENT_TYPE = 'multipart/mixed; boundary="batchresponse_1"'
+
+# Respuesta de SAP a un $batch: un GET, un change-set aceptado, uno rechazado y una parte con 500
+BATCH_RESPONSE = "\r\n".join([
+    "--batchresponse_1",
+    "Content-Type: application/http",
+    "Content-Transfer-Encoding: binary",
+    "",
+    "HTTP/1.1 200 OK",
+    "Content-Type: application/json;odata=minimalmetadata;charset=utf-8",
+    "",
+    json.dumps({"value": [{"ItemCode": "A00001"}]}),
+    "--batchresponse_1",
+    "Content-Type: multipart/mixed;boundary=changesetresponse_1",
+    "",
+    "--changesetresponse_1",
+    "Content-Type: application/http",
+    "Content-Transfer-Encoding: binary",
+    "Content-ID: 1",
+    "",
+    "HTTP/1.1 201 Created",
+    "Content-Type: application/json",
+    "",
+    json.dumps({"DocEntry": 10, "DocNum": 110}),
+    "--changesetresponse_1",
+    "Content-Type: application/http",
+    "Content-Transfer-Encoding: binary",
+    "Content-ID: 2",
+    "",
+    "HTTP/1.1 204 No Content",
+    "",
+    "",
+    "--changesetresponse_1--",
+    "--batchresponse_1",
+    "Content-Type: application/http",
+    "Content-Transfer-Encoding: binary",
+    "",
+    "HTTP/1.1 400 Bad Request",
+    "Content-Type: application/json",
+    "",
+    json.dumps({"error": {"code": -5002, "message": {"lang": "en-us", "value": "Invalid item"}}}),
+    "--batchresponse_1",
+    "Content-Type: application/http",
+    "Content-Transfer-Encoding: binary",
+    "",
+    "HTTP/1.1 500 Internal Server Error",
+    "Content-Type: text/plain",
+    "",
+    "Service Layer error",
+    "--batchresponse_1--",
+    ""
+])
+
+
+def test_parse_multipart_keeps_part_order_and_statuses():
+    plain, changeset, rejected, failed = _parse_multipart(CONTENT_TYPE, BATCH_RESPONSE)
+
+    assert plain == {"status": 200, "body": {"value": [{"ItemCode": "A00001"}]}}
+    assert changeset == [{"status": 201, "body": {"DocEntry": 10, "DocNum": 110}},
+                         {"status": 204, "body": None}]
+    assert rejected["status"] == 400
+    assert rejected["body"]["error"]["code"] == -5002
+    assert failed == {"status": 500, "body": "Service Layer error"}
+
+
+def test_parse_multipart_ignores_text_after_closing_boundary():
+    text = BATCH_RESPONSE + "--batchresponse_1\r\nbasura\r\n"
+
+    assert len(_parse_multipart("multipart/mixed;boundary=batchresponse_1", text)) == 4
+
+
+def test_parse_multipart_requires_boundary():
+    with pytest.raises(Exception, match="sin boundary"):
+        _parse_multipart("multipart/mixed", BATCH_RESPONSE)
+
+
+def test_parse_multipart_rejects_invalid_status_line():
+    text = "--b\r\nContent-Type: application/http\r\n\r\nbasura\r\n--b--\r\n"
+
+    with pytest.raises(Exception, match="Línea de estado inválida"):
+        _parse_multipart("multipart/mixed;boundary=b", text)
+
+
+def test_batch_operation_lines():
+    lines = _batch_operation({"method": "post", "endpoint": "/Orders", "body": {"CardCode": "C00001"}},
+                             "/b1s/v1", content_id=3)
+
+    assert lines == ["Content-Type: application/http", "Content-Transfer-Encoding: binary", "Content-ID: 3",
+                     "", "POST /b1s/v1/Orders", "Content-Type: application/json", "",
+                     '{"CardCode": "C00001"}', ""]
+
+
+async def canned_client() -> SAPClient:
+    """Cliente cuyo $batch siempre recibe BATCH_RESPONSE"""
+    def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.path.endswith("/Login"):
+            return httpx.Response(200, json={"SessionId": "s1", "SessionTimeout": 30},
+                                  headers={"Set-Cookie": "B1SESSION=s1; path=/b1s"})
+        return httpx.Response(200, text=BATCH_RESPONSE, headers={"Content-Type": CONTENT_TYPE})
+
+    client = SAPClient(SAP_URL, transport=httpx.MockTransport(handler))
+    assert await client.login_from_env()
+    return client
+
+
+async def test_execute_batch_expands_rejected_changeset():
+    client = await canned_client()
+
+    get = {"method": "GET", "endpoint": "/Items?$top=1"}
+    post = {"method": "POST", "endpoint": "/Orders", "body": {}}
+    results = await client.execute_batch([[get], [post, post], [post, post], [post]])
+
+    assert [r["status"] for r in results[1]] == [201, 204]
+    # Un change-set rechazado vuelve como una sola respuesta para todas sus operaciones
+    assert [r["status"] for r in results[2]] == [400, 400]
+    assert results[3][0]["status"] == 500
+    await client.aclose()
+
+
+async def test_execute_batch_rejects_part_count_mismatch():
+    client = await canned_client()
+
+    with pytest.raises(Exception, match="4 partes para 1 grupos"):
+        await client.execute_batch([[{"method": "GET", "endpoint": "/Items"}]])
+    await client.aclose()
@@ -0,0 +1,129 @@
+import asyncio
+
+import httpx
+import pytest
+
+from deadlines import RetryPolicy
+from sap_client import SAPClient
+
+from conftest import SAP_URL
+
+pytestmark = pytest.mark.anyio
+
+ORDER = {"CardCode": "C00001", "DocDueDate": "2025-08-30",
+         "DocumentLines": [{"ItemCode": "A00001", "Quantity": 1}]}
+
+
+class FailingTransport(httpx.AsyncBaseTransport):
+    """Delega en el Service Layer simulado, salvo las requests que fail(request) haga fallar"""
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, fail):
+        self.transport = transport
+        self.fail = fail
+        self.calls = []
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        self.calls.append((request.method, request.url.path))
+        error = self.fail(request)
+        if error is not None:
+            raise error
+        return await self.transport.handle_async_request(request)
+
+
+def make_client(transport: httpx.AsyncBaseTransport) -> SAPClient:
+    return SAPClient(SAP_URL, transport=transport,
+                     retry_policy=RetryPolicy(max_attempts=3, base_delay=0.0, max_delay=0.0))
+
+
+def sent_to(transport: FailingTransport, method: str, path: str) -> int:
+    return sum(1 for call in transport.calls if call == (method, f"/b1s/v1{path}"))
+
+
+async def test_concurrent_401s_share_one_login(fake_sap, sap_transport):
+    service_layer = fake_sap.state.service_layer
+    client = make_client(sap_transport)
+    assert await client.login_from_env()
+
+    # SAP olvidó la sesión antes que el timeout local
+    service_layer.sessions.clear()
+    results = await asyncio.gather(*(client.make_request("GET", "/Items('A00001')") for _ in range(10)))
+
+    assert all(item["ItemCode"] == "A00001" for item in results)
+    assert service_layer.logins == 2
+    await client.aclose()
+
+
+async def test_iter_pages_follows_next_link(sap_transport):
+    client = make_client(sap_transport)
+    assert await client.login_from_env()
+
+    pages = [page async for page in client.iter_pages("/Items", select=["ItemCode"], page_size=40)]
+
+    assert [len(page) for page in pages] == [40] * 7 + [20]
+    codes = [row["ItemCode"] for page in pages for row in page]
+    assert len(set(codes)) == 300
+    await client.aclose()
+
+
+async def test_iter_pages_stops_at_top(fake_sap, sap_transport):
+    client = make_client(sap_transport)
+    assert await client.login_from_env()
+    fake_sap.state.service_layer.reset_stats()
+
+    pages = [page async for page in client.iter_pages("/Items", top=90, page_size=40)]
+
+    assert [len(page) for page in pages] == [40, 40, 10]
+    assert fake_sap.state.service_layer.stats()["by_endpoint"] == {"GET /Items": 3}
+    await client.aclose()
+
+
+async def test_post_is_not_retried_after_it_was_sent(sap_transport):
+    def fail(request):
+        if request.method == "POST" and request.url.path.endswith("/Orders"):
+            return httpx.ReadTimeout("sin respuesta", request=request)
+
+    transport = FailingTransport(sap_transport, fail)
+    client = make_client(transport)
+    assert await client.login_from_env()
+
+    with pytest.raises(httpx.ReadTimeout):
+        await client.create_sales_order(ORDER)
+
+    assert sent_to(transport, "POST", "/Orders") == 1
+    await client.aclose()
+
+
+async def test_post_is_retried_when_the_connection_failed(sap_transport):
+    failures = [httpx.ConnectError("conexión rechazada")]
+
+    def fail(request):
+        if request.method == "POST" and request.url.path.endswith("/Orders") and failures:
+            return failures.pop()
+
+    transport = FailingTransport(sap_transport, fail)
+    client = make_client(transport)
+    assert await client.login_from_env()
+
+    order = await client.create_sales_order(ORDER)
+
+    assert order["DocEntry"]
+    assert sent_to(transport, "POST", "/Orders") == 2
+    await client.aclose()
+
+
+async def test_get_is_retried_after_a_read_timeout(sap_transport):
+    failures = [httpx.ReadTimeout("sin respuesta")]
+
+    def fail(request):
+        if request.method == "GET" and failures:
+            return failures.pop()
+
+    transport = FailingTransport(sap_transport, fail)
+    client = make_client(transport)
+    assert await client.login_from_env()
+
+    item = await client.make_request("GET", "/Items('A00001')")
+
+    assert item["ItemCode"] == "A00001"
+    assert sent_to(transport, "GET", "/Items('A00001')") == 2
+    await client.aclose()
@@ -0,0 +1,90 @@
+import time
+
+import pytest
+
+from deadlines import DeadlineExceeded, deadline_scope
+from sap_guard import CLOSED, HALF_OPEN, OPEN, SAPGuard, ServiceUnavailableError
+
+pytestmark = pytest.mark.anyio
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def make_guard(clock: FakeClock) -> SAPGuard:
+    return SAPGuard(initial_limit=8, window=4, min_calls=4, failure_ratio=0.5, open_seconds=10.0, clock=clock)
+
+
+def trip(guard: SAPGuard):
+    for _ in range(4):
+        guard.record(0.01, failed=True)
+
+
+async def test_circuit_opens_then_half_open_probe_closes_it():
+    clock = FakeClock()
+    guard = make_guard(clock)
+
+    trip(guard)
+    assert guard.state == OPEN
+
+    clock.now += 4.0
+    with pytest.raises(ServiceUnavailableError) as rejected:
+        guard.check()
+    assert rejected.value.reason == "circuit_open"
+    assert rejected.value.retry_after == pytest.approx(6.0)
+
+    # Vencido el tiempo abierto pasa una sola request de prueba
+    clock.now += 6.0
+    assert await guard.acquire() is True
+    assert guard.state == HALF_OPEN
+    with pytest.raises(ServiceUnavailableError):
+        await guard.acquire()
+
+    await guard.release(0.01, failed=False, probe=True)
+    assert guard.state == CLOSED
+    assert await guard.acquire() is False
+    await guard.release(0.01, failed=False)
+
+
+async def test_failed_probe_reopens_circuit():
+    clock = FakeClock()
+    guard = make_guard(clock)
+
+    trip(guard)
+    clock.now += 10.0
+    assert await guard.acquire() is True
+    await guard.release(0.01, failed=True, probe=True)
+
+    assert guard.state == OPEN
+    with pytest.raises(ServiceUnavailableError) as rejected:
+        guard.check()
+    assert rejected.value.retry_after == pytest.approx(10.0)
+
+
+async def test_failures_below_ratio_keep_circuit_closed():
+    guard = make_guard(FakeClock())
+
+    for _ in range(4):
+        guard.record(0.01, failed=False)
+    guard.record(0.01, failed=True)
+
+    assert guard.state == CLOSED
+
+
+async def test_queue_wait_is_bounded_by_the_call_deadline():
+    guard = SAPGuard(initial_limit=1, queue_timeout=30.0)
+    assert await guard.acquire() is False
+
+    started = time.monotonic()
+    with deadline_scope(0.05):
+        with pytest.raises(DeadlineExceeded):
+            await guard.acquire()
+
+    assert time.monotonic() - started < 1.0
+    assert guard.in_flight == 1
+    await guard.release(0.01, failed=False)
@@ -0,0 +1,149 @@
+import asyncio
+import sqlite3
+import time
+
+import pytest
+
+from metrics import SAP_JOB_DOCUMENTS
+from sap_guard import ServiceUnavailableError
+from sap_jobs import STALE_AFTER, JobQueue
+
+pytestmark = pytest.mark.anyio
+
+ORDERS = [{"CardCode": "C00001", "DocumentLines": [{"ItemCode": f"A0000{i}", "Quantity": 1}]} for i in range(1, 4)]
+
+
+@pytest.fixture
+def queue_path(tmp_path):
+    return str(tmp_path / "jobs.sqlite")
+
+
+@pytest.fixture
+def queue(queue_path):
+    queue = JobQueue(queue_path, workers=1, timeout=5.0, poll_interval=0.01)
+    yield queue
+    queue.close()
+
+
+class FlakyExecutor:
+    """Lanza los errores de failures (uno por llamada) y luego crea los documentos"""
+
+    def __init__(self, *failures: BaseException):
+        self.failures = list(failures)
+        self.calls = 0
+        self.called = asyncio.Event()
+
+    async def __call__(self, job: dict, orders: list) -> list:
+        self.calls += 1
+        self.called.set()
+        if self.failures:
+            raise self.failures.pop(0)
+        return [{"status": "success", "DocEntry": self.calls * 100 + i, "DocNum": i} for i in range(len(orders))]
+
+
+async def wait_for_status(queue: JobQueue, job_id: str, *statuses: str) -> dict:
+    for _ in range(500):
+        status = await queue.status(job_id)
+        if status["status"] in statuses:
+            return status
+        await asyncio.sleep(0.01)
+    raise AssertionError(f"El trabajo quedó en {status['status']}")
+
+
+def age_heartbeat(path: str, owner: str, seconds: float):
+    """Simular un proceso que dejó de latir hace seconds segundos"""
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.execute("UPDATE job_workers SET heartbeat = ? WHERE owner = ?", (time.time() - seconds, owner))
+    conn.close()
+
+
+async def test_batch_is_requeued_and_retried_when_sap_is_unavailable(queue):
+    executor = FlakyExecutor(ServiceUnavailableError("Circuito abierto", retry_after=0.01, reason="circuit_open"))
+    job_id, _ = await queue.submit("orders", "SBODEMO", "manager", ORDERS, {"batch_size": 3})
+
+    worker = asyncio.create_task(queue.run(executor))
+    try:
+        status = await wait_for_status(queue, job_id, "success", "error")
+    finally:
+        worker.cancel()
+
+    assert executor.calls == 2
+    assert status["created"] == 3 and status["unknown"] == 0
+
+
+async def test_batch_is_back_in_the_queue_after_a_connection_error(queue):
+    executor = FlakyExecutor(ConnectionError("sin sesión SAP"))
+    job_id, _ = await queue.submit("orders", "SBODEMO", "manager", ORDERS, {"batch_size": 3})
+
+    worker = asyncio.create_task(queue.run(executor))
+    try:
+        await executor.called.wait()
+        # Mientras el worker espera para reintentar, los documentos están pendientes otra vez
+        status = await wait_for_status(queue, job_id, "queued")
+    finally:
+        worker.cancel()
+
+    assert status["pending"] == 3 and status["done"] == 0
+    assert queue.stats()["sending"] == 0
+
+
+async def test_sending_batch_of_a_dead_process_ends_unknown(queue_path, queue):
+    job_id, _ = await queue.submit("orders", "SBODEMO", "manager", ORDERS, {"batch_size": 3})
+    # El proceso toma el lote y termina sin registrar el resultado ni darse de baja
+    assert await queue.claim() is not None
+    age_heartbeat(queue_path, queue.owner, STALE_AFTER + 1)
+
+    other = JobQueue(queue_path, workers=1)
+    before = SAP_JOB_DOCUMENTS.value("unknown")
+    try:
+        assert await other.claim() is None
+    finally:
+        other.close()
+
+    status = await queue.status(job_id)
+    assert status["status"] == "error" and status["unknown"] == 3
+    assert status["finished_at"] is not None
+    assert "verificar en SAP" in status["results"][0]["error"]
+    assert SAP_JOB_DOCUMENTS.value("unknown") - before == 3
+
+
+async def test_live_heartbeat_keeps_the_sending_batch(queue_path, queue):
+    job_id, _ = await queue.submit("orders", "SBODEMO", "manager", ORDERS, {"batch_size": 3})
+    assert await queue.claim() is not None
+    age_heartbeat(queue_path, queue.owner, STALE_AFTER + 1)
+    await queue.heartbeat()
+
+    other = JobQueue(queue_path, workers=1)
+    try:
+        assert await other.claim() is None
+    finally:
+        other.close()
+
+    status = await queue.status(job_id)
+    assert status["status"] == "running" and status["pending"] == 3
+
+
+async def test_closed_process_leaves_its_sending_batch_unknown(queue_path):
+    first = JobQueue(queue_path, workers=1)
+    job_id, _ = await first.submit("orders", "SBODEMO", "manager", ORDERS[:1])
+    assert await first.claim() is not None
+    first.close()
+
+    second = JobQueue(queue_path, workers=1)
+    try:
+        assert await second.claim() is None
+        assert (await second.status(job_id))["unknown"] == 1
+    finally:
+        second.close()
+
+
+async def test_idempotency_key_returns_the_same_job(queue_path):
+    queue = JobQueue(queue_path, workers=1, dedupe_ttl=60.0)
+    try:
+        first = await queue.submit("orders", "SBODEMO", "manager", ORDERS, idempotency_key="k1")
+        second = await queue.submit("orders", "SBODEMO", "manager", ORDERS, idempotency_key="k1")
+    finally:
+        queue.close()
+
+    assert first[1] is False
+    assert second == (first[0], True)
@@ -0,0 +1,61 @@
+import asyncio
+
+import pytest
+
+from deadlines import DeadlineExceeded, deadline_scope
+from sap_client import SAPClient
+from sap_guard import SAPGuard, ServiceUnavailableError
+from sap_pool import SAPSessionPool
+
+from conftest import SAP_URL
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+async def pool(sap_transport):
+    guard = SAPGuard()
+    pool = SAPSessionPool(SAP_URL, min_size=0, max_size=1, guard=guard,
+                          client_factory=lambda: SAPClient(SAP_URL, transport=sap_transport, guard=guard))
+    pool.acquire_timeout = 0.05
+    yield pool
+    await pool.close()
+
+
+async def test_acquire_fails_fast_when_pool_is_exhausted(pool):
+    async with pool.acquire():
+        with pytest.raises(ServiceUnavailableError) as rejected:
+            async with pool.acquire():
+                pass
+        assert rejected.value.reason == "pool_exhausted"
+
+    # Liberada la sesión, se vuelve a entregar sin otro login
+    async with pool.acquire() as client:
+        assert client.session_id
+    assert pool.size == 1
+
+
+async def test_acquire_wait_is_bounded_by_the_call_deadline(pool):
+    pool.acquire_timeout = 30.0
+    async with pool.acquire():
+        with pytest.raises(DeadlineExceeded):
+            with deadline_scope(0.05):
+                async with pool.acquire():
+                    pass
+
+
+async def test_waiter_gets_the_session_released_in_time(pool):
+    pool.acquire_timeout = 1.0
+    released = asyncio.Event()
+
+    async def hold():
+        async with pool.acquire():
+            await asyncio.sleep(0.02)
+        released.set()
+
+    holder = asyncio.create_task(hold())
+    await asyncio.sleep(0)
+    async with pool.acquire() as client:
+        assert released.is_set()
+        assert client.session_id
+    await holder
@@ -0,0 +1,160 @@
+import pytest
+
+from sap_pricing import PricingEngine, QuoteError
+
+pytestmark = pytest.mark.anyio
+
+ITEMS = [
+    {"ItemCode": "A1", "SalesVATGroup": "IVA",
+     "ItemPrices": [{"PriceList": 1, "Price": 100.0, "Currency": "USD"},
+                    {"PriceList": 2, "Price": 90.0, "Currency": "USD"}]},
+    {"ItemCode": "A2", "SalesVATGroup": "IVA", "ItemPrices": [{"PriceList": 1, "Price": 50.0, "Currency": "USD"}]},
+    {"ItemCode": "A3", "SalesVATGroup": "EXE", "ItemPrices": [{"PriceList": 2, "Price": 10.0, "Currency": "USD"}]},
+]
+
+PARTNERS = [
+    {"CardCode": "C1", "CardType": "cCustomer", "PriceListNum": 1, "Currency": "USD", "VatGroup": "IVA"},
+    {"CardCode": "C2", "CardType": "cCustomer", "PriceListNum": 2, "Currency": "USD", "VatGroup": "IVA"},
+    {"CardCode": "S1", "CardType": "cSupplier", "PriceListNum": 1, "Currency": "USD", "VatGroup": "IVA"},
+]
+
+ROWS = {
+    "/PriceLists": [{"PriceListNo": 1, "IsGrossPrice": "tNO"}, {"PriceListNo": 2, "IsGrossPrice": "tYES"}],
+    "/SpecialPrices": [
+        # Precio especial de la lista 1 para A1, solo en el primer semestre
+        {"CardCode": "*1", "ItemCode": "A1", "Price": 95.0, "DiscountPercent": 5.0,
+         "ValidFrom": "2025-01-01", "ValidTo": "2025-06-30"},
+        # Precio especial de C1 para A2 con período y escalones de cantidad
+        {"CardCode": "C1", "ItemCode": "A2", "Price": 48.0, "DiscountPercent": 4.0,
+         "SpecialPriceDataAreas": [{
+             "DateFrom": "2025-01-01", "Dateto": "2025-12-31", "SpecialPrice": 45.0, "Discount": 10.0,
+             "SpecialPriceQuantityAreas": [{"Quantity": 10, "SpecialPrice": 40.0, "Discountin": 20.0},
+                                           {"Quantity": 50, "SpecialPrice": 35.0, "Discountin": 30.0}]}]},
+        {"CardCode": "C1", "ItemCode": "A3", "Price": 1.0, "Valid": "tNO"},
+    ],
+    "/SalesTaxCodes": [{"Code": "IVA", "Rate": 19.0, "Inactive": "tNO"}, {"Code": "EXE", "Rate": 0.0},
+                       {"Code": "OLD", "Rate": 10.0, "Inactive": "tYES"}],
+}
+
+
+class StaticMasterData:
+    async def load(self, pool, max_age: float = 0.0):
+        return ITEMS, PARTNERS
+
+
+class RowsPool:
+    """Pool que solo responde iter_rows con filas fijas por endpoint"""
+
+    async def iter_rows(self, endpoint: str, select=None):
+        for row in ROWS[endpoint]:
+            yield row
+
+
+@pytest.fixture
+async def engine():
+    engine = PricingEngine(master_data=StaticMasterData(), reconcile_rate=0)
+    await engine.refresh(RowsPool())
+    return engine
+
+
+def line_of(engine: PricingEngine, card_code: str, item_code: str, quantity, doc_date: str = "2025-08-01",
+            **fields) -> dict:
+    order = {"CardCode": card_code, "DocDate": doc_date,
+             "DocumentLines": [{"ItemCode": item_code, "Quantity": quantity, **fields}]}
+    return engine.quote(order)["DocumentLines"][0]
+
+
+async def test_refresh_keeps_customers_gross_lists_and_valid_special_prices(engine):
+    assert set(engine.partners) == {"C1", "C2"}
+    assert engine.gross_lists == {2}
+    assert ("C1", "A3") not in engine.special_prices
+    assert engine.tax_rates == {"IVA": 19.0, "EXE": 0.0}
+    assert engine.inactive_taxes == {"OLD"}
+
+
+async def test_price_list_price_with_tax(engine):
+    quote = engine.quote({"CardCode": "C1", "DocDate": "2025-08-01",
+                          "DocumentLines": [{"ItemCode": "A1", "Quantity": "2"}]})
+
+    line = quote["DocumentLines"][0]
+    assert (line["UnitPrice"], line["Price"], line["PriceSource"]) == (100.0, 100.0, "price_list")
+    assert (line["LineTotal"], line["TaxAmount"]) == (200.0, 38.0)
+    assert (quote["Subtotal"], quote["VatSum"], quote["DocTotal"]) == (200.0, 38.0, 238.0)
+    assert quote["DocCurrency"] == "USD" and quote["PriceList"] == 1
+
+
+async def test_list_special_price_applies_only_in_its_period(engine):
+    special = line_of(engine, "C1", "A1", 1, doc_date="2025-03-01")
+    regular = line_of(engine, "C1", "A1", 1, doc_date="2025-07-01")
+
+    assert (special["UnitPrice"], special["DiscountPercent"], special["Price"]) == (100.0, 5.0, 95.0)
+    assert special["PriceSource"] == "special_price"
+    assert regular["Price"] == 100.0 and regular["PriceSource"] == "price_list"
+
+
+async def test_customer_special_price_wins_over_the_list(engine):
+    assert line_of(engine, "C1", "A2", 1)["PriceSource"] == "special_price"
+    # Otro cliente de la misma lista no tiene el precio especial
+    assert line_of(engine, "C2", "A1", 1)["PriceSource"] == "price_list"
+
+
+@pytest.mark.parametrize("quantity,price,discount", [(1, 45.0, 10.0), (10, 40.0, 20.0), (49, 40.0, 20.0),
+                                                     (50, 35.0, 30.0), (200, 35.0, 30.0)])
+async def test_quantity_breaks(engine, quantity, price, discount):
+    line = line_of(engine, "C1", "A2", quantity)
+
+    assert (line["UnitPrice"], line["DiscountPercent"], line["Price"]) == (50.0, discount, price)
+    assert line["LineTotal"] == round(quantity * price, 2)
+
+
+async def test_special_price_outside_its_areas_uses_the_header_price(engine):
+    line = line_of(engine, "C1", "A2", 100, doc_date="2026-02-01")
+
+    assert (line["DiscountPercent"], line["Price"]) == (4.0, 48.0)
+
+
+async def test_line_discount_and_unit_price_override_the_calculated_price(engine):
+    discounted = line_of(engine, "C1", "A1", 1, DiscountPercent="10")
+    overridden = line_of(engine, "C1", "A1", 1, UnitPrice="80")
+
+    assert (discounted["Price"], discounted["PriceSource"]) == (90.0, "price_list+request")
+    assert (overridden["UnitPrice"], overridden["Price"], overridden["PriceSource"]) == (80.0, 80.0, "request")
+
+
+async def test_document_discount_applies_before_tax(engine):
+    quote = engine.quote({"CardCode": "C1", "DocDate": "2025-08-01", "DiscountPercent": 10,
+                          "DocumentLines": [{"ItemCode": "A1", "Quantity": 2}]})
+
+    assert (quote["Subtotal"], quote["TotalDiscount"], quote["VatSum"], quote["DocTotal"]) == \
+        (200.0, 20.0, 34.2, 214.2)
+
+
+async def test_gross_price_list_line_total_excludes_tax(engine):
+    line = line_of(engine, "C2", "A1", 2)
+
+    assert line["Price"] == 90.0
+    assert line["LineTotal"] == round(2 * 90.0 / 1.19, 2)
+
+
+async def test_item_without_price_in_the_list_is_quoted_at_zero_with_a_warning(engine):
+    quote = engine.quote({"CardCode": "C1", "DocumentLines": [{"ItemCode": "A3", "Quantity": 1}]})
+
+    assert quote["DocumentLines"][0]["PriceSource"] == "missing"
+    assert "no tiene precio en la lista 1" in quote["warnings"][0]
+
+
+async def test_invalid_lines_are_all_reported(engine):
+    with pytest.raises(QuoteError) as error:
+        engine.quote({"CardCode": "C1", "DocumentLines": [
+            {"ItemCode": "ZZ", "Quantity": 1},
+            {"ItemCode": "A1", "Quantity": 1, "TaxCode": "OLD"},
+            {"ItemCode": "A1", "Quantity": 1, "DiscountPercent": 150},
+        ]})
+
+    assert len(error.value.errors) == 3
+    assert "'ZZ' no existe" in error.value.errors[0]
+
+
+async def test_supplier_cannot_be_quoted(engine):
+    with pytest.raises(QuoteError, match="no existe o no es cliente"):
+        engine.quote({"CardCode": "S1", "DocumentLines": [{"ItemCode": "A1", "Quantity": 1}]})
@@ -0,0 +1,209 @@
+import json
+
+import httpx
+import pytest
+
+import sap_query
+from benchmarks.fake_service_layer import FakeConfig, create_app
+from sap_client import SAPClient
+from sap_query import QUERY_ENTITIES, aggregate_rows, iter_columnar, query_limit, resolve_aggregates
+
+from conftest import SAP_URL, call_tool
+
+pytestmark = pytest.mark.anyio
+
+ITEMS = QUERY_ENTITIES["sap_query_items"]
+
+
+class RecordingTransport(httpx.AsyncBaseTransport):
+    """Delega en el Service Layer simulado y guarda las requests recibidas"""
+
+    def __init__(self, transport: httpx.AsyncBaseTransport):
+        self.transport = transport
+        self.requests = []
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request)
+        return await self.transport.handle_async_request(request)
+
+
+async def query(mcp, name: str, arguments: dict):
+    """(encabezado, filas, resumen) de una herramienta sap_query_*"""
+    response = await mcp.post("/mcp", json={"jsonrpc": "2.0", "id": 1, "method": "tools/call",
+                                           "params": {"name": name, "arguments": arguments}})
+    blocks = [block["text"] for block in response.json()["result"]["content"]]
+    header, *pages, summary = blocks
+    rows = [json.loads(line) for page in pages for line in page.splitlines()]
+    return json.loads(header), rows, json.loads(summary)
+
+
+async def test_query_returns_header_and_one_array_per_row(mcp):
+    header, rows, summary = await query(mcp, "sap_query_items", {"top": 3})
+
+    assert header == {"entity": "Items", "columns": ITEMS.default_select}
+    assert [row[0] for row in rows] == ["A00001", "A00002", "A00003"]
+    assert all(len(row) == len(ITEMS.default_select) for row in rows)
+    assert summary == {"count": 3, "truncated": True}
+
+
+async def test_query_with_select_returns_only_those_columns_in_order(mcp):
+    header, rows, _ = await query(mcp, "sap_query_orders",
+                                  {"select": ["DocTotal", "DocEntry", "DocTotal"], "top": 2,
+                                   "filter": "CardCode ne 'X'"})
+
+    assert header["columns"] == ["DocTotal", "DocEntry"]
+    assert [len(row) for row in rows] == [2, 2]
+    assert rows[0][1] > rows[1][1]
+
+
+async def test_query_rejects_invalid_select(mcp):
+    response = await mcp.post("/mcp", json={"jsonrpc": "2.0", "id": 1, "method": "tools/call", "params": {
+        "name": "sap_query_items", "arguments": {"select": ["ItemCode,ItemName"]}}})
+
+    assert "Consulta inválida" in response.json()["result"]["content"][-1]["text"]
+
+
+async def test_query_is_truncated_at_max_rows(mcp, monkeypatch):
+    monkeypatch.setenv("SAP_QUERY_MAX_ROWS", "25")
+
+    _, rows, summary = await query(mcp, "sap_query_items", {"top": 500})
+
+    assert len(rows) == 25
+    assert summary == {"count": 25, "truncated": True}
+
+
+async def test_query_is_not_truncated_when_all_rows_fit(mcp):
+    _, rows, summary = await query(mcp, "sap_query_business_partners", {"top": 1000})
+
+    assert len(rows) == 50
+    assert summary == {"count": 50, "truncated": False}
+
+
+def test_query_limit_defaults_and_bounds(monkeypatch):
+    monkeypatch.setenv("SAP_QUERY_DEFAULT_TOP", "7")
+    monkeypatch.setenv("SAP_QUERY_MAX_ROWS", "100")
+
+    assert query_limit(None) == 7
+    assert query_limit(30) == 30
+    assert query_limit(5000) == 100
+    with pytest.raises(ValueError):
+        query_limit(-1)
+
+
+async def test_select_and_extra_row_are_passed_to_sap(sap_transport):
+    transport = RecordingTransport(sap_transport)
+    client = SAPClient(SAP_URL, transport=transport)
+    assert await client.login_from_env()
+
+    pages = [rows async for rows in iter_columnar(client, ITEMS, ["ItemCode", "QuantityOnStock"], 4)]
+
+    request = transport.requests[-1]
+    assert request.url.params["$select"] == "ItemCode,QuantityOnStock"
+    assert request.url.params["$orderby"] == ITEMS.default_orderby
+    # Una fila más que el límite indica si el resultado está truncado
+    assert request.url.params["$top"] == "5"
+    assert [len(row) for rows in pages for row in rows] == [2] * 5
+    await client.aclose()
+
+
+# --- Agregación ------------------------------------------------------------
+
+ORDERS = QUERY_ENTITIES["sap_query_orders"]
+
+
+@pytest.fixture
+def apply_unsupported(monkeypatch):
+    """Registro vacío de Service Layers sin $apply, restaurado al terminar"""
+    registry = set()
+    monkeypatch.setattr(sap_query, "_apply_unsupported", registry)
+    return registry
+
+
+async def orders_client(apply: bool = True):
+    """(cliente, transport que registra requests) contra un Service Layer simulado con o sin $apply"""
+    app = create_app(FakeConfig(latency=0.0, items=50, business_partners=10, orders=60, apply=apply))
+    transport = RecordingTransport(httpx.ASGITransport(app=app))
+    client = SAPClient(SAP_URL, transport=transport)
+    assert await client.login_from_env()
+    return client, transport
+
+
+def with_apply(transport: RecordingTransport) -> int:
+    return sum(1 for request in transport.requests if "$apply" in request.url.params)
+
+
+async def aggregate(client, filter_query=None):
+    rows, detail = await aggregate_rows(client, ORDERS, ["CardCode"],
+                                        resolve_aggregates(["count", "sum:DocTotal", "max:DocTotal"]),
+                                        filter_query)
+    return sorted(rows), detail
+
+
+async def test_aggregate_runs_in_sap_with_apply(apply_unsupported):
+    client, transport = await orders_client()
+
+    rows, detail = await aggregate(client, "DocTotal gt 1000")
+
+    assert detail == {"source": "$apply"}
+    assert with_apply(transport) == 1
+    assert transport.requests[-1].url.params["$apply"].startswith("filter(DocTotal gt 1000)/groupby((CardCode),")
+    assert all(len(row) == 4 for row in rows)
+    await client.aclose()
+
+
+async def test_scan_matches_apply(apply_unsupported, monkeypatch):
+    client, _ = await orders_client()
+    applied, _ = await aggregate(client, "DocTotal gt 1000")
+
+    monkeypatch.setenv("SAP_AGGREGATE_APPLY", "0")
+    scanned, detail = await aggregate(client, "DocTotal gt 1000")
+
+    assert detail["source"] == "scan" and detail["rows_scanned"] == sum(row[1] for row in scanned)
+    assert scanned == applied
+    await client.aclose()
+
+
+async def test_rejected_apply_falls_back_to_scan_and_is_remembered(apply_unsupported):
+    client, transport = await orders_client(apply=False)
+
+    rows, detail = await aggregate(client)
+    again, _ = await aggregate(client)
+
+    assert detail == {"source": "scan", "rows_scanned": 60}
+    assert sum(row[1] for row in rows) == 60
+    assert again == rows
+    # El segundo pedido ya no intenta $apply
+    assert with_apply(transport) == 1
+    assert apply_unsupported == {(client.base_url, client.company_db)}
+    await client.aclose()
+
+
+async def test_filter_rejected_by_the_scan_too_is_raised_without_disabling_apply(apply_unsupported):
+    client, transport = await orders_client(apply=False)
+
+    with pytest.raises(httpx.HTTPStatusError) as error:
+        await aggregate(client, "DocTotal mayor 1000")
+
+    assert error.value.response.status_code == 400
+    assert with_apply(transport) == 1
+    # El rechazo era del filtro, no de $apply: no se recuerda el Service Layer
+    assert apply_unsupported == set()
+    await client.aclose()
+
+
+async def test_aggregate_tool_sorts_and_limits_groups(mcp, apply_unsupported):
+    text = await call_tool(mcp, "sap_aggregate_orders", {"group_by": ["CardCode"],
+                                                         "aggregates": ["count", "sum:DocTotal"], "top": 3})
+
+    header, *rows, summary = [json.loads(line) for line in text.splitlines()]
+    assert header == {"entity": "Orders", "group_by": ["CardCode"],
+                      "columns": ["CardCode", "count", "DocTotal_sum"], "source": "$apply"}
+    assert len(rows) == 3
+    assert [row[2] for row in rows] == sorted((row[2] for row in rows), reverse=True)
+    assert summary["count"] == 3 and summary["truncated"] is (summary["groups"] > 3)
+
+
+async def test_aggregate_tool_rejects_orderby_outside_the_result(mcp):
+    text = await call_tool(mcp, "sap_aggregate_orders", {"orderby": "DocNum desc"})
+
+    assert text.startswith("Consulta inválida: orderby debe ser una columna del resultado")
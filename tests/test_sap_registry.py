@@ -0,0 +1,110 @@
+import asyncio
+
+import httpx
+import pytest
+
+from sap_client import SAPClient
+from sap_guard import SAPGuard
+from sap_pool import SAPSessionPool
+from sap_registry import SAPPoolRegistry
+
+from conftest import SAP_URL
+
+pytestmark = pytest.mark.anyio
+
+OTHER = ("SBOOTRA", "manager")
+
+
+class GatedLoginTransport(httpx.AsyncBaseTransport):
+    """Retiene los logins hasta que se abre la compuerta"""
+
+    def __init__(self, transport: httpx.AsyncBaseTransport):
+        self.transport = transport
+        self.gate = asyncio.Event()
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        if request.url.path.endswith("/Login"):
+            await self.gate.wait()
+        return await self.transport.handle_async_request(request)
+
+
+@pytest.fixture
+async def registry(sap_transport):
+    guard = SAPGuard()
+    transport = GatedLoginTransport(sap_transport)
+    registry = SAPPoolRegistry(
+        companies={OTHER: (*OTHER, "manager")},
+        idle_timeout=0.0,
+        pool_factory=lambda credentials: SAPSessionPool(
+            min_size=0, max_size=1, guard=guard, credentials=credentials,
+            client_factory=lambda: SAPClient(SAP_URL, transport=transport, guard=guard)
+        ),
+        guard=guard
+    )
+    registry.login_gate = transport.gate
+    yield registry
+    registry.login_gate.set()
+    await registry.close()
+
+
+async def test_pool_with_login_in_progress_is_not_evicted(registry):
+    async def use_other_company():
+        async with registry.get(*OTHER).acquire() as client:
+            return client.company_db
+
+    task = asyncio.create_task(use_other_company())
+    await asyncio.sleep(0.01)
+
+    assert registry.evict_idle() == 0
+    registry.login_gate.set()
+    assert await task == OTHER[0]
+
+    assert registry.evict_idle() == 1
+    assert OTHER not in registry.pools
+
+
+async def test_pool_with_waiting_caller_is_not_evicted(registry):
+    registry.login_gate.set()
+    pool = registry.get(*OTHER)
+    release = asyncio.Event()
+
+    async def hold():
+        async with pool.acquire():
+            await release.wait()
+
+    async def wait_for_session():
+        async with pool.acquire() as client:
+            return client.company_db
+
+    holder = asyncio.create_task(hold())
+    await asyncio.sleep(0.01)
+    waiter = asyncio.create_task(wait_for_session())
+    await asyncio.sleep(0.01)
+
+    # Al liberar la sesión el pool queda sin uso, pero con una llamada esperándola
+    release.set()
+    await holder
+    assert pool.busy
+    assert registry.evict_idle() == 0
+    assert await waiter == OTHER[0]
+
+
+async def test_pool_with_pending_acquire_survives_the_pool_limit(registry):
+    registry.max_pools = 1
+
+    async def use_other_company():
+        async with registry.get(*OTHER).acquire() as client:
+            return client.company_db
+
+    task = asyncio.create_task(use_other_company())
+    await asyncio.sleep(0.01)
+
+    # Abrir la compañía por defecto supera el límite, pero OTHER tiene un acquire() pendiente
+    registry.get()
+    assert OTHER in registry.pools
+    registry.login_gate.set()
+    assert await task == OTHER[0]
+
+    # Ya sin uso, el mantenimiento la cierra por exceder el límite
+    registry.evict_idle()
+    assert OTHER not in registry.pools
@@ -0,0 +1,73 @@
+import pytest
+
+from sap_client import SAPClient
+from sap_guard import SAPGuard
+from sap_pool import SAPSessionPool
+from sap_replica import MasterDataReplica
+
+from conftest import SAP_URL
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+async def pool(sap_transport, monkeypatch):
+    monkeypatch.setenv("SAP_PAGE_SIZE", "40")
+    guard = SAPGuard()
+    pool = SAPSessionPool(SAP_URL, min_size=0, max_size=1, guard=guard,
+                          client_factory=lambda: SAPClient(SAP_URL, transport=sap_transport, guard=guard))
+    yield pool
+    await pool.close()
+
+
+@pytest.fixture
+def replica(tmp_path):
+    replica = MasterDataReplica(str(tmp_path / "replica.sqlite"))
+    yield replica
+    replica.close()
+
+
+async def test_sync_releases_the_session_between_pages(pool, replica, monkeypatch):
+    in_use = []
+    upsert_page = replica._upsert_page
+
+    def record_upsert(*args):
+        in_use.append(pool.in_use)
+        return upsert_page(*args)
+
+    monkeypatch.setattr(replica, "_upsert_page", record_upsert)
+
+    assert await replica.sync(pool) == {"items": 300, "business_partners": 50}
+
+    # Mientras se escribe cada página la sesión ya volvió al pool
+    assert len(in_use) == 8 + 2
+    assert set(in_use) == {0}
+    assert replica.is_loaded()
+    assert replica.stats()["items"] == 300
+
+
+async def test_delta_sync_brings_only_changed_records(fake_sap, pool, replica):
+    await replica.sync(pool)
+    item = fake_sap.state.service_layer.items[0]
+    item.update(ItemName="Renombrado", UpdateDate="2099-01-01", UpdateTime="08:00:00")
+
+    await replica.sync(pool)
+
+    # La marca de agua avanzó: solo vuelve el registro de ese mismo segundo
+    assert (await replica.sync(pool))["items"] == 1
+    records = {record["ItemCode"]: record for record in replica.records("items")}
+    assert len(records) == 300
+    assert records[item["ItemCode"]]["ItemName"] == "Renombrado"
+    assert replica.stats()["watermarks"]["items"] == "2099-01-01 08:00:00"
+
+
+async def test_full_reload_drops_records_deleted_in_sap(fake_sap, pool, replica):
+    await replica.sync(pool)
+    service_layer = fake_sap.state.service_layer
+    removed = service_layer.items.pop()["ItemCode"]
+    replica.full_reload_hours = 0
+
+    await replica.sync(pool)
+
+    codes = {record["ItemCode"] for record in replica.records("items")}
+    assert len(codes) == 299 and removed not in codes
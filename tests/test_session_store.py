@@ -0,0 +1,124 @@
+import os
+import sqlite3
+import time
+
+import pytest
+
+from session_store import STALE_AFTER, SessionStore
+
+pytestmark = pytest.mark.anyio
+
+
+def session(session_id: str, ttl: float = 1800.0, company_db: str = "SBODEMO") -> dict:
+    return {"session_id": session_id, "b1session": f"cookie-{session_id}", "route_id": ".node1",
+            "company_db": company_db, "username": "manager", "timeout_minutes": 30,
+            "expires_at": time.time() + ttl}
+
+
+def age_heartbeat(path: str, owner: str, seconds: float):
+    """Simular un worker que dejó de latir hace seconds segundos"""
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.execute("UPDATE workers SET heartbeat = ? WHERE owner = ?", (time.time() - seconds, owner))
+    conn.close()
+
+
+@pytest.fixture
+def store_path(tmp_path):
+    return str(tmp_path / "store" / "sessions.sqlite")
+
+
+@pytest.fixture
+def stores(store_path):
+    """Dos workers sobre el mismo archivo"""
+    first, second = SessionStore(store_path, max_idle=2), SessionStore(store_path, max_idle=2)
+    yield first, second
+    first.close()
+    second.close()
+
+
+def test_file_is_opened_on_first_use(store_path):
+    store = SessionStore(store_path)
+
+    assert not os.path.exists(store_path)
+    store.close()
+
+
+async def test_released_session_is_adopted_by_the_other_worker(stores):
+    first, second = stores
+    await first.publish(session("s1"))
+
+    # En uso por el primer worker: nadie más la adopta
+    assert await second.claim("SBODEMO", "manager") is None
+    assert await first.release(session("s1"))
+    claimed = await second.claim("SBODEMO", "manager")
+
+    assert claimed["session_id"] == "s1" and claimed["b1session"] == "cookie-s1"
+    assert await first.claim("SBODEMO", "manager") is None
+    assert second.stats()["sessions"] == 1 and second.stats()["free"] == 0
+
+
+async def test_claim_matches_company_and_remaining_ttl(stores):
+    first, second = stores
+    await first.publish(session("other", company_db="SBOOTRA"))
+    await first.publish(session("short", ttl=30))
+    await first.release(session("other", company_db="SBOOTRA"))
+    await first.release(session("short", ttl=30))
+
+    assert await second.claim("SBODEMO", "manager", min_ttl=60) is None
+    assert (await second.claim("SBODEMO", "manager"))["session_id"] == "short"
+
+
+async def test_relogin_replaces_the_published_session(stores):
+    first, second = stores
+    await first.publish(session("s1"))
+    await first.publish(session("s2"), replaces="s1")
+    await first.release(session("s2"))
+
+    assert (await second.claim("SBODEMO", "manager"))["session_id"] == "s2"
+    assert await second.claim("SBODEMO", "manager") is None
+
+
+async def test_release_over_max_idle_is_refused(stores):
+    first, _ = stores
+    for session_id in ("s1", "s2", "s3"):
+        await first.publish(session(session_id))
+
+    assert await first.release(session("s1"))
+    assert await first.release(session("s2"))
+    # La tercera sobra: se quita del almacén y el worker hace logout
+    assert not await first.release(session("s3"))
+    assert first.stats()["sessions"] == 2
+
+
+async def test_sessions_of_a_worker_without_heartbeat_are_freed(store_path, stores):
+    first, second = stores
+    await first.publish(session("s1"))
+    age_heartbeat(store_path, first.owner, STALE_AFTER + 1)
+
+    claimed = await second.claim("SBODEMO", "manager")
+
+    assert claimed["session_id"] == "s1"
+    assert second.stats()["workers"] == 1
+
+
+async def test_heartbeat_keeps_the_sessions_owned(store_path, stores):
+    first, second = stores
+    await first.publish(session("s1"))
+    age_heartbeat(store_path, first.owner, STALE_AFTER + 1)
+    await first.heartbeat()
+
+    assert await second.claim("SBODEMO", "manager") is None
+    assert second.stats()["workers"] == 2
+
+
+async def test_last_worker_to_leave_gets_the_free_sessions(stores):
+    first, second = stores
+    await first.publish(session("s1"))
+    await second.publish(session("s2"))
+    await first.release(session("s1"))
+
+    assert await first.leave() == []
+    await second.release(session("s2"))
+    leftovers = await second.leave()
+
+    assert sorted(state["session_id"] for state in leftovers) == ["s1", "s2"]